@@ -0,0 +1,271 @@
+""" Time the things edgydata spends most of its time doing, on synthetic data
+(so no SolarEdge account or network is needed), and write the results as
+json, so that they can be compared between versions:
+
+    python benchmark.py --sites 2 --years 3 --output results.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+from timeit import default_timer
+
+import numpy
+
+from edgydata.aggregate import aggregate, group_by_day, iter_aggregate
+from edgydata.backend.aio import AsyncHybrid
+from edgydata.backend.archive import Archive
+from edgydata.backend.hybrid import Hybrid
+from edgydata.backend.local import Local
+from edgydata.backend.remote import parse_power_details
+from edgydata.constants import Combiners, LOG_FORMAT
+from edgydata.data import PowerPeriod
+from edgydata.metrics import METRICS
+from edgydata.standin import StandIn
+from edgydata.synthetic import (generate_power, make_sites,
+                                power_details_response)
+from edgydata.time import date_to_datetime
+
+
+def _time(function, repeat):
+    """ Run function repeat times. Returns the time each run took, and what
+    the last one returned
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = default_timer()
+        result = function()
+        times.append(default_timer() - start)
+    return times, result
+
+
+def _remove_db(path):
+    """ Remove a sqlite database, and its write-ahead log """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+class Benchmark(object):
+    """ Makes the data, runs each scenario, and keeps the results """
+    def __init__(self, sites, years, repeat, latency, workdir):
+        self._repeat = repeat
+        self._latency = latency
+        self._workdir = workdir
+        # End on a fixed date, so every run uses the same data
+        self.sites = make_sites(sites, years, end_date=date(2024, 12, 31))
+        self.series = dict((s.site_id, generate_power(s)) for s in self.sites)
+        self.results = []
+
+    def record(self, name, function, items, repeat=None):
+        """ Time a scenario. items is how many power periods it deals with,
+        to give a rate
+        """
+        times, result = _time(function, repeat or self._repeat)
+        best = min(times)
+        self.results.append(OrderedDict([
+            ("name", name), ("best", best), ("mean", sum(times) / len(times)),
+            ("times", times), ("items", items),
+            ("items_per_second", items / best if best else None)]))
+        print("%-30s %9.4fs  %12.0f/s" % (name, best,
+                                           items / best if best else 0))
+        return result
+
+    def _new_local(self, name):
+        path = os.path.join(self._workdir, name)
+        _remove_db(path)
+        local = Local(path=path)
+        local.create()
+        for site in self.sites:
+            local.add_site(site)
+        return local
+
+    def run(self, only=None):
+        scenarios = [("local", self.local), ("memory", self.memory),
+                     ("parse", self.parse), ("archive", self.archive),
+                     ("hybrid", self.hybrid)]
+        for name, scenario in scenarios:
+            if only is None or name in only:
+                scenario()
+
+    def local(self):
+        """ Putting power into, and getting it out of, the local database """
+        total = sum(len(s) for s in self.series.values())
+        state = {}
+
+        def add_power():
+            state["local"] = self._new_local("add_power.db")
+            for series in self.series.values():
+                state["local"].add_power(series)
+
+        self.record("local.add_power", add_power, total, repeat=1)
+        local = state["local"]
+        site_id = self.sites[0].site_id
+        count = len(self.series[site_id])
+        self.record("local.get_power",
+                    lambda: local.get_power(site_id=site_id), count)
+        self.record("local.get_power(as_series)",
+                    lambda: local.get_power(site_id=site_id,
+                                            as_series=True), count)
+        self.record("local.get_aggregate(daily)",
+                    lambda: local.get_aggregate(
+                        site_id=site_id, period_length=timedelta(days=1),
+                        as_series=True), count)
+        self.record("local.get_aggregate(no rollups)",
+                    lambda: local.get_aggregate(
+                        site_id=site_id, period_length=timedelta(days=1),
+                        as_series=True, use_rollups=False), count)
+
+    def memory(self):
+        """ Working on power that's already been loaded """
+        site_id = self.sites[0].site_id
+        series = self.series[site_id]
+        periods = series.to_periods()
+        count = len(series)
+        shuffled = list(periods)
+        random.Random(0).shuffle(shuffled)
+        self.record("PowerPeriod sorted()", lambda: sorted(shuffled), count)
+        self.record("PowerPeriod sorted(sort_key)",
+                    lambda: sorted(shuffled, key=PowerPeriod.sort_key),
+                    count)
+        one_day = timedelta(days=1)
+        self.record("aggregate(periods)",
+                    lambda: aggregate(periods, period_length=one_day), count)
+        self.record("aggregate(series)",
+                    lambda: aggregate(series, period_length=one_day), count)
+        self.record("aggregate(all combiners)",
+                    lambda: aggregate(series, period_length=one_day,
+                                      combination=list(Combiners)), count)
+        self.record("iter_aggregate(periods)",
+                    lambda: list(iter_aggregate(iter(periods), one_day)),
+                    count)
+        timezone = self.sites[0].timezone
+        self.record("group_by_day",
+                    lambda: group_by_day(periods, timezone=timezone), count)
+
+    def parse(self):
+        """ Decoding SolarEdge's responses """
+        site = self.sites[0]
+        start = date_to_datetime(site.start_date)
+        window = generate_power(site, start=start,
+                                end=start + timedelta(days=28))
+        raw = power_details_response(window)["powerDetails"]
+        self.record("parse_power_details",
+                    lambda: parse_power_details(raw, site.site_id),
+                    len(window))
+        self.record("parse_power_details(series)",
+                    lambda: parse_power_details(raw, site.site_id,
+                                                as_series=True), len(window))
+
+    def archive(self):
+        """ The memory mapped archive """
+        path = os.path.join(self._workdir, "archive")
+        total = sum(len(s) for s in self.series.values())
+
+        def fill():
+            shutil.rmtree(path, ignore_errors=True)
+            archive = Archive(path=path)
+            archive.create()
+            for site in self.sites:
+                archive.add_site(site)
+                archive.add_power(self.series[site.site_id])
+            return archive
+
+        archive = self.record("archive.add_power", fill, total, repeat=1)
+        site_id = self.sites[0].site_id
+        count = len(self.series[site_id])
+        self.record("archive.get_power(as_series)",
+                    lambda: archive.get_power(site_id=site_id,
+                                              as_series=True), count)
+        self.record("archive.get_aggregate(daily)",
+                    lambda: archive.get_aggregate(
+                        site_id=site_id, period_length=timedelta(days=1),
+                        as_series=True), count)
+
+    def hybrid(self):
+        """ Syncing everything from a stand-in for SolarEdge, into an empty
+        local database
+        """
+        total = sum(len(s) for s in self.series.values())
+        path = os.path.join(self._workdir, "hybrid.db")
+        with StandIn(sites=self.sites, latency=self._latency) as stand_in:
+            def sync():
+                _remove_db(path)
+                hybrid = Hybrid(api_key="benchmark", local_path=path,
+                                base_url=stand_in.base_url)
+                start = date_to_datetime(self.sites[0].start_date)
+                end = date_to_datetime(self.sites[0].end_date)
+                return hybrid.get_power_many(start=start, end=end,
+                                             as_series=True)
+
+            self.record("hybrid.get_power_many", sync, total, repeat=1)
+            self.results[-1]["calls"] = dict(stand_in.calls)
+
+            async def async_sync():
+                async with AsyncHybrid(api_key="benchmark", local_path=path,
+                                       base_url=stand_in.base_url) as hybrid:
+                    start = date_to_datetime(self.sites[0].start_date)
+                    end = date_to_datetime(self.sites[0].end_date)
+                    return await hybrid.get_power_many(start=start, end=end,
+                                                       as_series=True)
+
+            def run_async():
+                _remove_db(path)
+                return asyncio.run(async_sync())
+
+            self.record("aio.hybrid.get_power_many", run_async, total,
+                        repeat=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sites", type=int, default=1)
+    parser.add_argument("--years", type=float, default=2)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="How many times to run each scenario")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds each call to the stand-in takes")
+    parser.add_argument("--only", nargs="*",
+                        help="Only run these groups of scenarios (local, "
+                        "memory, parse, archive, hybrid)")
+    parser.add_argument("--output", help="Write the results to this file, "
+                        "as well as printing them")
+    args = parser.parse_args()
+    # The backends' own messages would get in the way of the results
+    logging.basicConfig(format=LOG_FORMAT, level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="edgydata_benchmark")
+    try:
+        benchmark = Benchmark(args.sites, args.years, args.repeat,
+                              args.latency, workdir)
+        benchmark.run(only=args.only)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    output = OrderedDict([
+        ("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("arguments", vars(args)),
+        ("python", sys.version.split()[0]), ("numpy", numpy.__version__),
+        ("sqlite", sqlite3.sqlite_version), ("platform", platform.platform()),
+        ("results", benchmark.results),
+        # What the backends counted and timed, over all the scenarios
+        ("metrics", METRICS.snapshot())])
+    if args.output is not None:
+        with open(args.output, "w") as file_handle:
+            json.dump(output, file_handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,9 +23,27 @@ Ways to convert a data set:
 """
 from __future__ import print_function
 
-from collections import Counter
-from edgydata.constants import Combiners
-from edgydata.lib import batch
+import logging
+from collections import Counter, OrderedDict
+from datetime import date, time, timedelta
+from itertools import chain
+
+import numpy
+
+from edgydata.constants import Combiners, DatePreset, POWER_TYPES
+from edgydata.data import PowerSeries
+from edgydata.time import datetime_to_int, int_to_datetime, utc_offsets
+
+LOGGER = logging.getLogger(__name__)
+# How many PowerPeriods iter_aggregate() gathers up before processing them
+STREAMCHUNKSIZE = 1000
+# The DatePresets that are a fixed length
+_PRESET_LENGTHS = {DatePreset.DAY: timedelta(days=1),
+                   DatePreset.WEEK: timedelta(weeks=1)}
+# The DatePresets that are calendar periods (in UTC), and the numpy
+# datetime64 unit that each power period's start is truncated to for them
+_PRESET_UNITS = {DatePreset.MONTH: "datetime64[M]",
+                 DatePreset.YEAR: "datetime64[Y]"}
 
 
 def _is_nearly_integer(number):
@@ -35,7 +53,7 @@ def _is_nearly_integer(number):
     threshold = 0.0001
     if number - int(number) < threshold:
         return True
-    if 1 + int(number) - number:
+    if 1 + int(number) - number < threshold:
         return True
     return False
 
@@ -44,15 +62,13 @@ def _has_duplicate_times(iterable):
     start_time_list = [a.start_time for a in iterable]
     if len(start_time_list) == len(set(start_time_list)):
         return False
-    print("Found duplicates")
     dups = [t for t in Counter(start_time_list).items() if t[1] > 1]
-    print(dups)
+    LOGGER.warning("Found duplicates: %s", dups)
     start_time, _ = dups[0]
     mylist = [a for a in iterable if a.start_time == start_time]
     for pp in mylist:
-        print(pp)
-        print(pp.consumed)
-        print(pp.exported)
+        LOGGER.warning("%s (consumed %s, exported %s)", pp, pp.consumed,
+                       pp.exported)
     return True
 
 
@@ -60,57 +76,468 @@ def _roundint(myfloat):
     return int(myfloat + 0.5)
 
 
-def combine_periods(power_periods, combiner):
-    if combiner == Combiners.SUM:
-        return sum(power_periods)
-    if combiner == Combiners.MEAN:
-        return sum(power_periods) / len(power_periods)
-    raise NotImplementedError
+def _series_has_duplicate_times(series):
+    """ The vectorized equivalent of _has_duplicate_times, for a PowerSeries
+    that is already sorted by start time
+    """
+    return bool(numpy.any(numpy.diff(series.start_time) == 0))
+
+
+def _batch_starts(start_times, period_seconds, origin):
+    """ Given sorted start times, return the index of the first entry of each
+    batch of length period_seconds (measured from origin)
+    """
+    if len(start_times) == 0:
+        return numpy.array([], dtype=numpy.int64)
+    buckets = (start_times - origin) // period_seconds
+    boundaries = numpy.flatnonzero(numpy.diff(buckets)) + 1
+    return numpy.concatenate(([0], boundaries)).astype(numpy.int64)
+
+
+def combine_batches(site_id, start_time, duration, counts, combiners,
+                    weighted=None, minimums=None, maximums=None,
+                    specifics=None):
+    """ Turn per-batch statistics into a PowerSeries for each of combiners.
+    site_id, start_time and duration (the span of each batch) and counts are
+    arrays with one entry per batch. The others are dictionaries of
+    {power type: array}, and are only needed for the combiners that use them:
+    weighted holds the sum of power * duration (for SUM and MEAN), minimums
+    and maximums are for MIN and MAX, and specifics for SPECIFIC.
+
+    Returns a dictionary of {combiner: PowerSeries}.
+    """
+    common = {"site_id": site_id, "start_time": start_time,
+              "duration": duration}
+    results = dict((c, dict(common)) for c in combiners)
+    for eachtype in POWER_TYPES:
+        if Combiners.SUM in combiners or Combiners.MEAN in combiners:
+            # These contain average powers, so they have been weighted by
+            # duration, and need dividing by the whole span of the batch
+            weight = weighted[eachtype]
+            if numpy.any((weight != 0) & (duration == 0)):
+                raise ValueError("Duration is zero but power is not")
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                total = numpy.where(duration == 0, 0.0, weight / duration)
+            if Combiners.SUM in combiners:
+                results[Combiners.SUM][eachtype] = total
+            if Combiners.MEAN in combiners:
+                results[Combiners.MEAN][eachtype] = total / counts
+        if Combiners.MIN in combiners:
+            results[Combiners.MIN][eachtype] = minimums[eachtype]
+        if Combiners.MAX in combiners:
+            results[Combiners.MAX][eachtype] = maximums[eachtype]
+        if Combiners.SPECIFIC in combiners:
+            results[Combiners.SPECIFIC][eachtype] = specifics[eachtype]
+    return dict((c, PowerSeries(**kwargs)) for c, kwargs in results.items())
+
+
+def _check_specific(counts, specific):
+    if numpy.any(counts <= specific):
+        msg = "Block %s requested, but some batches only have %s blocks"
+        raise ValueError(msg % (specific, counts.min()))
+
+
+def _reduce(series, starts, combiners, specific=0, total_duration=False):
+    """ Reduce each batch of series (the batches being delimited by the
+    indices in starts) with every one of combiners, in one pass over the
+    data. Returns a dictionary of {combiner: PowerSeries}.
+
+    As with PowerPeriod.__add__, the duration of each result runs from the
+    start of the first period to the end of the last one in the batch. If
+    the batches aren't made of consecutive periods, total_duration should be
+    True, and it's the total of the periods' durations instead.
+    """
+    if len(starts) == 0:
+        return dict((c, PowerSeries.empty()) for c in combiners)
+    ends = numpy.append(starts[1:], len(series))
+    counts = ends - starts
+    if numpy.any(numpy.minimum.reduceat(series.site_id, starts) !=
+                 numpy.maximum.reduceat(series.site_id, starts)):
+        raise ValueError("Can't combine PowerPeriods for different sites")
+    batch_start = series.start_time[starts]
+    if total_duration:
+        batch_duration = numpy.add.reduceat(series.duration, starts)
+    else:
+        batch_duration = numpy.maximum.reduceat(
+            series.start_time + series.duration, starts) - batch_start
+    if Combiners.SPECIFIC in combiners:
+        _check_specific(counts, specific)
+    stats = {"weighted": {}, "minimums": {}, "maximums": {}, "specifics": {}}
+    for eachtype in POWER_TYPES:
+        values = getattr(series, eachtype)
+        if Combiners.SUM in combiners or Combiners.MEAN in combiners:
+            stats["weighted"][eachtype] = numpy.add.reduceat(
+                values * series.duration, starts)
+        if Combiners.MIN in combiners:
+            stats["minimums"][eachtype] = numpy.minimum.reduceat(values,
+                                                                 starts)
+        if Combiners.MAX in combiners:
+            stats["maximums"][eachtype] = numpy.maximum.reduceat(values,
+                                                                 starts)
+        if Combiners.SPECIFIC in combiners:
+            stats["specifics"][eachtype] = values[starts + specific]
+    return combine_batches(series.site_id[starts], batch_start,
+                           batch_duration, counts, combiners, **stats)
+
+
+def combine_periods(power_periods, combiner, specific=0):
+    """ Combine an iterable of PowerPeriods into a single PowerPeriod, using
+    the given combiner. For Combiners.SPECIFIC, the result has the values of
+    block number `specific`.
+    """
+    series = PowerSeries.from_periods(power_periods).sorted()
+    starts = numpy.array([0], dtype=numpy.int64)
+    return _reduce(series, starts, [combiner], specific=specific)[combiner][0]
 
 
 def aggregate(input_, period_length=None, data_length=None,
-              combination=Combiners.SUM):
+              combination=Combiners.SUM, specific=0):
     """ Combine the data into more useful chunks
 
     We assume that all periods have the same length / separation. It would be
-    too confusing otherwise.
+    too confusing otherwise. Batches are measured from the start of the first
+    period.
+
+    combination can either be a single Combiners value, or a list of them, in
+    which case all of them are calculated in one pass and a dictionary of
+    {combiner: result} is returned. For Combiners.SPECIFIC, the values of
+    block number `specific` in each batch are used.
+
+    If input_ is a PowerSeries, the result is also a PowerSeries. Otherwise,
+    it is a list of PowerPeriods.
     """
-    sorted_input = sorted(input_)
-    first_period = sorted_input[0]
-    old_pl = first_period.duration
-    multiplier = period_length.total_seconds() / old_pl.total_seconds()
+    if isinstance(input_, PowerSeries):
+        is_series = True
+        series = input_.sorted()
+    else:
+        is_series = False
+        series = PowerSeries.from_periods(input_).sorted()
+    if isinstance(combination, Combiners):
+        combiners = [combination]
+    else:
+        combiners = list(combination)
+    if len(series) == 0:
+        raise ValueError("Nothing to aggregate")
+    old_pl = int(series.duration[0])
+    period_seconds = period_length.total_seconds()
+    multiplier = period_seconds / old_pl
     if not _is_nearly_integer(multiplier):
         msg = "Period length must be a multiple of the original (%s, %s)"
-        raise ValueError(msg % (period_length, old_pl))
-    multiplier = _roundint(multiplier)
-    return_list = []
-    if _has_duplicate_times(sorted_input):
-        raise ValueError
-    for eachbatch in batch(sorted_input, multiplier):
-        try:
-            total = combine_periods(eachbatch, combination)
-        except ValueError:
-            print(eachbatch)
-            raise
-        return_list.append(total)
-    return return_list
-
-
-def group_by_day(input):
-    current_day = None
-    output = set()
-    current_period = None
-    for p in sorted(input):
-        print("Looping: %s" % p)
-        if p.start_time.date() == current_day:
-            try:
-                current_period += p
-            except ValueError:
-                pass
+        raise ValueError(msg % (period_length, series[0].duration))
+    if _series_has_duplicate_times(series):
+        raise ValueError("Found duplicate start times")
+    starts = _batch_starts(series.start_time, _roundint(period_seconds),
+                           series.start_time[0])
+    results = _reduce(series, starts, combiners, specific=specific)
+    if not is_series:
+        results = dict((c, r.to_periods()) for c, r in results.items())
+    if isinstance(combination, Combiners):
+        return results[combination]
+    return results
+
+
+def _batch_keys(start_times, period_length, origin):
+    """ Number the batch that each of start_times falls into. Batches are
+    period_length long, measured from origin (a unix timestamp), or if
+    period_length is a DatePreset.MONTH or YEAR, calendar months or years
+    """
+    if period_length in _PRESET_UNITS:
+        as_dates = start_times.astype("datetime64[s]")
+        return as_dates.astype(_PRESET_UNITS[period_length]).astype(
+            numpy.int64)
+    period_length = _PRESET_LENGTHS.get(period_length, period_length)
+    return (start_times - origin) // _roundint(period_length.total_seconds())
+
+
+def aggregate_range(series, start=None, period_length=None,
+                    combination=Combiners.SUM, specific=0):
+    """ Combine a PowerSeries into batches the way the backends'
+    get_aggregate() does. Unlike aggregate(), the power can be for several
+    sites (each site is batched separately), batches are measured from
+    start (or the unix epoch, if it's None), period_length can be a
+    DatePreset, and if there's no power there are no batches.
+
+    The batches come out in start time order. Returns a PowerSeries, or a
+    dictionary of {combiner: PowerSeries} if combination is a list.
+    """
+    if isinstance(combination, Combiners):
+        combiners = [combination]
+    else:
+        combiners = list(combination)
+    origin = 0 if start is None else datetime_to_int(start)
+    series = series[numpy.lexsort((series.start_time, series.site_id))]
+    same_site = numpy.diff(series.site_id) == 0
+    if numpy.any(same_site & (numpy.diff(series.start_time) == 0)):
+        raise ValueError("Found duplicate start times")
+    keys = _batch_keys(series.start_time, period_length, origin)
+    boundaries = numpy.flatnonzero((numpy.diff(keys) != 0) | ~same_site)
+    if len(series):
+        starts = numpy.concatenate(([0], boundaries + 1)).astype(numpy.int64)
+    else:
+        starts = numpy.array([], dtype=numpy.int64)
+    results = _reduce(series, starts, combiners, specific=specific)
+    results = dict((c, r.sorted()) for c, r in results.items())
+    if isinstance(combination, Combiners):
+        return results[combination]
+    return results
+
+
+def _chunk_stream(input_, chunk_size):
+    """ Turn an iterable of PowerPeriods and/or PowerSeries into a stream of
+    PowerSeries, gathering PowerPeriods up into chunk_size lots
+    """
+    periods = []
+    for item in input_:
+        if isinstance(item, PowerSeries):
+            if periods:
+                yield PowerSeries.from_periods(periods)
+                periods = []
+            yield item
             continue
-        print("Finished %s" % current_day)
-        if current_period is not None:
-            output.add(current_period)
-        current_period = p
-        current_day = p.start_time.date()
-    return output
+        periods.append(item)
+        if len(periods) >= chunk_size:
+            yield PowerSeries.from_periods(periods)
+            periods = []
+    if periods:
+        yield PowerSeries.from_periods(periods)
+
+
+def _check_stream_order(series, previous_start):
+    """ Raise a ValueError if series (with previous_start, the start time of
+    whatever came before it) isn't strictly in time order for one site
+    """
+    if len(series) == 0:
+        return
+    if numpy.any(series.site_id != series.site_id[0]):
+        raise ValueError("Can't combine PowerPeriods for different sites")
+    start_times = series.start_time
+    if previous_start is not None:
+        start_times = numpy.concatenate(([previous_start], start_times))
+    steps = numpy.diff(start_times)
+    if numpy.any(steps == 0):
+        where = start_times[1:][steps == 0][0]
+        raise ValueError("Found duplicate start time: %s" %
+                         int_to_datetime(int(where)))
+    if numpy.any(steps < 0):
+        where = start_times[1:][steps < 0][0]
+        raise ValueError("Out of order: %s comes after a later start time" %
+                         int_to_datetime(int(where)))
+
+
+def iter_aggregate(input_, period_length, combination=Combiners.SUM,
+                   specific=0, origin=None, chunk_size=STREAMCHUNKSIZE):
+    """ The streaming equivalent of aggregate(). input_ is an iterable of
+    PowerPeriods (or PowerSeries chunks, such as
+    Local.iter_power(as_series=True)) for one site, that must already be in
+    time order. Each batch is yielded as soon as it is complete, so no more
+    than a batch and a chunk of the input is held at once.
+
+    Batches are measured from origin (a datetime), or the start of the
+    first period if it's None. Duplicates and out of order periods cause a
+    ValueError when they're reached.
+
+    Yields PowerPeriods, or a PowerSeries per chunk if the input is made of
+    PowerSeries. If combination is a list, dictionaries of
+    {combiner: result} are yielded instead.
+    """
+    if isinstance(combination, Combiners):
+        combiners = [combination]
+    else:
+        combiners = list(combination)
+    period_seconds = _roundint(period_length.total_seconds())
+    if origin is not None:
+        origin = datetime_to_int(origin)
+    # Whatever input_ is made of decides what comes out
+    input_ = iter(input_)
+    try:
+        first = next(input_)
+    except StopIteration:
+        return
+    as_series = isinstance(first, PowerSeries)
+    carry = PowerSeries.empty()
+    previous_start = None
+    for chunk in _chunk_stream(chain([first], input_), chunk_size):
+        if len(chunk) == 0:
+            continue
+        _check_stream_order(chunk, previous_start)
+        if len(carry) and chunk.site_id[0] != carry.site_id[0]:
+            raise ValueError("Can't combine PowerPeriods for different sites")
+        if previous_start is None:
+            old_pl = int(chunk.duration[0])
+            multiplier = period_length.total_seconds() / old_pl
+            if not _is_nearly_integer(multiplier):
+                msg = "Period length must be a multiple of the original "
+                msg += "(%s, %s)"
+                raise ValueError(msg % (period_length, chunk[0].duration))
+            if origin is None:
+                origin = int(chunk.start_time[0])
+        previous_start = int(chunk.start_time[-1])
+        series = PowerSeries.concatenate([carry, chunk])
+        starts = _batch_starts(series.start_time, period_seconds, origin)
+        # The last batch may carry on into the next chunk
+        carry = series[int(starts[-1]):]
+        if len(starts) > 1:
+            for result in _stream_output(series[:int(starts[-1])],
+                                         starts[:-1], combiners, combination,
+                                         specific, as_series):
+                yield result
+    if len(carry):
+        starts = numpy.array([0], dtype=numpy.int64)
+        for result in _stream_output(carry, starts, combiners, combination,
+                                     specific, as_series):
+            yield result
+
+
+def _stream_output(series, starts, combiners, combination, specific,
+                   as_series):
+    """ Reduce the complete batches of iter_aggregate(), and give the
+    results in the form it yields them
+    """
+    results = _reduce(series, starts, combiners, specific=specific)
+    if as_series:
+        if isinstance(combination, Combiners):
+            return [results[combination]]
+        return [results]
+    if isinstance(combination, Combiners):
+        return results[combination].to_periods()
+    periods = dict((c, r.to_periods()) for c, r in results.items())
+    return [dict((c, periods[c][i]) for c in combiners)
+            for i in range(len(starts))]
+
+
+def _local_calendar(start_times, timezone):
+    """ Get the local time (as a unix timestamp, shifted by the utc offset)
+    and the numpy datetime64 day, month and year of an array of unix
+    timestamps
+    """
+    local = start_times + utc_offsets(start_times, timezone)
+    days = (local // 86400).astype("datetime64[D]")
+    months = days.astype("datetime64[M]")
+    years = months.astype("datetime64[Y]")
+    return local, days, months, years
+
+
+# For each calendar key: a function that gives an integer code for each
+# local time (from _local_calendar()), and one that turns a code into the
+# value that's used in the results
+_CALENDAR_KEYS = {
+    "year": (lambda l, d, m, y: y.astype(numpy.int64) + 1970, int),
+    "month": (lambda l, d, m, y: (m - y).astype(numpy.int64) + 1, int),
+    "day": (lambda l, d, m, y: (d - m).astype(numpy.int64) + 1, int),
+    "weekday": (lambda l, d, m, y: (l // 86400 + 3) % 7, int),
+    "hour": (lambda l, d, m, y: l % 86400 // 3600, int),
+    "date": (lambda l, d, m, y: d.astype(numpy.int64),
+             lambda c: _EPOCH_DATE + timedelta(days=c)),
+    "time_of_day": (lambda l, d, m, y: l % 86400,
+                    lambda c: time(c // 3600, c % 3600 // 60, c % 60))}
+_EPOCH_DATE = date(1970, 1, 1)
+
+
+def _calendar_codes(series, key, timezone):
+    """ Work out the group that each element of series falls into. Returns
+    an array of the group number of each element, and the key of each
+    group, in order.
+    """
+    if callable(key):
+        # Anything goes, so it has to be done one at a time
+        groups = {}
+        codes = numpy.empty(len(series), dtype=numpy.int64)
+        for index, local_time in enumerate(
+                series.start_datetimes(timezone=timezone)):
+            codes[index] = groups.setdefault(key(local_time), len(groups))
+        keys = sorted(groups)
+        remap = numpy.empty(len(keys), dtype=numpy.int64)
+        for position, each_key in enumerate(keys):
+            remap[groups[each_key]] = position
+        return remap[codes], keys
+    names = (key,) if isinstance(key, str) else tuple(key)
+    for name in names:
+        if name not in _CALENDAR_KEYS:
+            msg = "Can't group by %s: expected a function or one of %s"
+            raise ValueError(msg % (name, sorted(_CALENDAR_KEYS)))
+    calendar = _local_calendar(series.start_time, timezone)
+    columns = [_CALENDAR_KEYS[n][0](*calendar) for n in names]
+    # Pack all the keys into one number, which sorts by the first key, then
+    # the second, and so on
+    combined = numpy.zeros(len(series), dtype=numpy.int64)
+    lowests = []
+    sizes = []
+    for column in columns:
+        lowest = int(column.min()) if len(column) else 0
+        size = int(column.max()) - lowest + 1 if len(column) else 1
+        combined = combined * size + (column - lowest)
+        lowests.append(lowest)
+        sizes.append(size)
+    unique, codes = numpy.unique(combined, return_inverse=True)
+    keys = []
+    for packed in unique.tolist():
+        values = []
+        for name, lowest, size in reversed(list(zip(names, lowests, sizes))):
+            packed, code = divmod(packed, size)
+            values.append(_CALENDAR_KEYS[name][1](code + lowest))
+        values.reverse()
+        keys.append(values[0] if isinstance(key, str) else tuple(values))
+    return codes.reshape(-1), keys
+
+
+def group_by(input_, key, timezone="UTC", combination=Combiners.SUM,
+             specific=0):
+    """ Combine the power periods that share a key in the calendar (in the
+    site's local timezone), in one pass. key can be one of:
+        "year", "month", "day" (of the month), "weekday" (0 is Monday),
+        "hour", "date" (a datetime.date), "time_of_day" (a datetime.time)
+    or a tuple of them (e.g. ("month", "weekday")), or a function that
+    takes a local datetime and gives a key.
+
+    Returns an OrderedDict of {key: PowerPeriod}, in key order (or
+    {key: PowerSeries} if input_ is a PowerSeries). If combination is a list
+    of Combiners, a dictionary of {combiner: those results} is returned.
+
+    The groups aren't generally made of consecutive periods, so the duration
+    of each result is the total duration of the periods in it. As with
+    aggregate(), a SUM is then the average power over the group (so its
+    energy is the total), and a MEAN's energy is the average for a period.
+    For Combiners.SPECIFIC, block number `specific` of each group (in time
+    order) is used.
+    """
+    if isinstance(input_, PowerSeries):
+        is_series = True
+        series = input_.sorted()
+    else:
+        is_series = False
+        series = PowerSeries.from_periods(input_).sorted()
+    if isinstance(combination, Combiners):
+        combiners = [combination]
+    else:
+        combiners = list(combination)
+    if len(series) and numpy.any(series.site_id != series.site_id[0]):
+        raise ValueError("Can't group PowerPeriods for different sites")
+    if _series_has_duplicate_times(series):
+        raise ValueError("Found duplicate start times")
+    codes, keys = _calendar_codes(series, key, timezone)
+    # A stable sort keeps each group in time order
+    order = numpy.argsort(codes, kind="stable")
+    grouped = series[order]
+    starts = numpy.flatnonzero(numpy.diff(codes[order])) + 1
+    if len(grouped):
+        starts = numpy.concatenate(([0], starts))
+    reduced = _reduce(grouped, starts.astype(numpy.int64), combiners,
+                      specific=specific, total_duration=True)
+    results = {}
+    for combiner, result in reduced.items():
+        if is_series:
+            results[combiner] = OrderedDict(
+                (k, result[i:i + 1]) for i, k in enumerate(keys))
+        else:
+            results[combiner] = OrderedDict(zip(keys, result.to_periods()))
+    if isinstance(combination, Combiners):
+        return results[combination]
+    return results
+
+
+def group_by_day(input_, timezone="UTC", combination=Combiners.SUM):
+    """ Combine the power periods of each (local) day. Returns a list of
+    PowerPeriods, in date order.
+    """
+    return list(group_by(input_, "date", timezone=timezone,
+                         combination=combination).values())
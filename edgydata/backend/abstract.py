@@ -1,5 +1,9 @@
 from abc import ABCMeta, abstractmethod
-import time
+import logging
+
+from edgydata.aggregate import aggregate_range
+from edgydata.constants import Combiners
+from edgydata.metrics import METRICS
 
 
 class Abstract(object):
@@ -9,27 +13,67 @@ class Abstract(object):
     """
     __metaclass__ = ABCMeta
 
-    def __init__(self, debug=True):
+    def __init__(self, debug=True, metrics=None):
         self._debug = debug
+        # Where the timings and counts go (see edgydata.metrics)
+        self.metrics = METRICS if metrics is None else metrics
+        self._logger = logging.getLogger(self.__class__.__module__)
 
-    def _print(self, msg):
-        print("[%s] %s" % (time.asctime(), msg))
-
-    def debug(self, msg):
+    # These use the standard logging module. Like its methods, they take the
+    # arguments for the message separately, so it's only formatted if it's
+    # going to be logged
+    def debug(self, msg, *args):
         if self._debug:
-            self._print(msg)
+            self._logger.debug(msg, *args)
 
-    def info(self, msg):
-        self._print(msg)
+    def info(self, msg, *args):
+        self._logger.info(msg, *args)
 
-    def warning(self, msg):
-        self._print("WARNING: %s" % msg)
+    def warning(self, msg, *args):
+        self._logger.warning(msg, *args)
 
     @abstractmethod
-    def get_power(self, site_id, start, end):
+    def get_power(self, site_id, start, end, as_series=False,
+                  date_filter=None):
         """ Get the list of PowerPeriod assets that cover the time period
-        from start to end.
+        from start to end. If as_series is True, return a PowerSeries
+        instead. If date_filter (an edgydata.datefilter.DateFilter) is given,
+        only return the ones that match it.
+        """
+
+    def get_power_many(self, site_ids=None, start=None, end=None,
+                       as_series=False, date_filter=None):
+        """ Get the power for several sites (or all of them, if site_ids is
+        None). Returns {site_id: power}. Backends that can do this more
+        efficiently than one site at a time should override this.
+        """
+        if site_ids is None:
+            site_ids = self.get_site_ids()
+        return dict((s, self.get_power(site_id=s, start=start, end=end,
+                                       as_series=as_series,
+                                       date_filter=date_filter))
+                    for s in site_ids)
+
+    def get_aggregate(self, site_id=None, start=None, end=None,
+                      period_length=None, combination=Combiners.SUM,
+                      specific=0, as_series=False, date_filter=None):
+        """ Get the power from start to end, combined into periods of
+        period_length (a timedelta, or a DatePreset). Batches are measured
+        from start (or the unix epoch, if start is None), and if there's no
+        power, nothing is returned. See edgydata.aggregate.aggregate() for
+        the meaning of the other arguments. Backends that can do this more
+        efficiently than fetching all the data should override this.
         """
+        power = self.get_power(site_id=site_id, start=start, end=end,
+                               as_series=True, date_filter=date_filter)
+        results = aggregate_range(power, start=start,
+                                  period_length=period_length,
+                                  combination=combination, specific=specific)
+        if as_series:
+            return results
+        if isinstance(combination, Combiners):
+            return results.to_periods()
+        return dict((c, r.to_periods()) for c, r in results.items())
 
     @abstractmethod
     def get_site(self, site_id):
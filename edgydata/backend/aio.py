@@ -0,0 +1,439 @@
+""" asyncio versions of the backends, for using edgydata from inside an event
+loop without holding it up:
+
+- AsyncRemote talks to SolarEdge with aiohttp (or, if that isn't
+  installed, makes its calls with requests on executor threads)
+- AsyncLocal does its sqlite work on executor threads
+- AsyncHybrid reads from the local database, after fetching whatever it's
+  missing from SolarEdge, all the missing parts at once
+
+They take the same arguments, and give back the same things, as the
+backends they're named after:
+
+    async with AsyncHybrid() as hybrid:
+        power = await hybrid.get_power(site_id, start, end)
+        async for site in hybrid.get_sites():
+            ...
+"""
+import asyncio
+import time
+from abc import ABCMeta, abstractmethod
+from functools import partial
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from edgydata.aggregate import aggregate_range
+from edgydata.backend.hybrid import Hybrid
+from edgydata.backend.local import Local
+from edgydata.backend.remote import (BACKOFF, BASE_URL, MAXCONCURRENCY,
+                                     RETRIES, TIMEOUT, Remote,
+                                     parse_power_details, parse_site_details)
+from edgydata.cache import SITETTL
+from edgydata.constants import Combiners
+from edgydata.pool import READERS
+from edgydata.time import date_to_datetime
+
+
+class AsyncAbstract(metaclass=ABCMeta):
+    """ The asyncio equivalent of edgydata.backend.abstract.Abstract.
+    Anything that would block is run in executor (or the event loop's
+    default executor, if that's None).
+    """
+    def __init__(self, executor=None):
+        self._executor = executor
+
+    async def _run(self, function, *args, **kwargs):
+        """ Call function on an executor thread, and wait for it """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          partial(function, *args, **kwargs))
+
+    async def close(self):
+        """ Let go of any connections """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @abstractmethod
+    async def get_power(self, site_id, start, end, as_series=False,
+                        date_filter=None):
+        """ See edgydata.backend.abstract.Abstract.get_power() """
+
+    async def get_power_many(self, site_ids=None, start=None, end=None,
+                             as_series=False, date_filter=None):
+        """ Get the power for several sites (or all of them, if site_ids is
+        None), all at once. Returns {site_id: power}
+        """
+        if site_ids is None:
+            site_ids = await self.get_site_ids()
+        site_ids = list(site_ids)
+        results = await asyncio.gather(*[
+            self.get_power(site_id=s, start=start, end=end,
+                           as_series=as_series, date_filter=date_filter)
+            for s in site_ids])
+        return dict(zip(site_ids, results))
+
+    async def get_aggregate(self, site_id=None, start=None, end=None,
+                            period_length=None, combination=Combiners.SUM,
+                            specific=0, as_series=False, date_filter=None):
+        """ See edgydata.backend.abstract.Abstract.get_aggregate() """
+        power = await self.get_power(site_id=site_id, start=start, end=end,
+                                     as_series=True, date_filter=date_filter)
+        results = await self._run(aggregate_range, power, start=start,
+                                  period_length=period_length,
+                                  combination=combination, specific=specific)
+        if as_series:
+            return results
+        if isinstance(combination, Combiners):
+            return results.to_periods()
+        return dict((c, r.to_periods()) for c, r in results.items())
+
+    @abstractmethod
+    async def get_site(self, site_id):
+        """ Get information about a site. """
+
+    @abstractmethod
+    async def get_site_ids(self):
+        """ Get all the site ids of all the sites.
+        """
+
+    async def get_sites(self):
+        """ Yield Site objects for all the sites. They're all asked for at
+        once, but come out in the order of get_site_ids().
+        """
+        site_ids = await self.get_site_ids()
+        tasks = [asyncio.ensure_future(self.get_site(s)) for s in site_ids]
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            # If we're not going to be asked for the rest, stop getting them
+            for task in tasks:
+                task.cancel()
+
+
+class AsyncLocal(AsyncAbstract):
+    """ The local database (see edgydata.backend.local.Local), with its sqlite
+    work done on executor threads. Local can be used by several threads at
+    once, so several queries can be running at the same time. An existing
+    Local can be given, instead of the arguments to make one.
+    """
+    def __init__(self, path=None, debug=False, metrics=None,
+                 readers=READERS, executor=None, local=None):
+        AsyncAbstract.__init__(self, executor=executor)
+        self._owns_local = local is None
+        if local is None:
+            local = Local(path=path, debug=debug, metrics=metrics,
+                          readers=readers)
+        self._local_be = local
+
+    async def close(self):
+        if self._owns_local:
+            await self._run(self._local_be.close)
+
+    async def get_power(self, site_id=None, start=None, end=None,
+                        as_series=False, date_filter=None):
+        return await self._run(self._local_be.get_power, site_id=site_id,
+                               start=start, end=end, as_series=as_series,
+                               date_filter=date_filter)
+
+    async def get_power_many(self, site_ids=None, start=None, end=None,
+                             as_series=False, date_filter=None):
+        # Local can do them all in one query
+        return await self._run(self._local_be.get_power_many,
+                               site_ids=site_ids, start=start, end=end,
+                               as_series=as_series, date_filter=date_filter)
+
+    async def get_aggregate(self, site_id=None, start=None, end=None,
+                            period_length=None, combination=Combiners.SUM,
+                            specific=0, as_series=False, use_rollups=True,
+                            date_filter=None):
+        return await self._run(self._local_be.get_aggregate, site_id=site_id,
+                               start=start, end=end,
+                               period_length=period_length,
+                               combination=combination, specific=specific,
+                               as_series=as_series, use_rollups=use_rollups,
+                               date_filter=date_filter)
+
+    async def get_site(self, site_id=None):
+        return await self._run(self._local_be.get_site, site_id)
+
+    async def get_site_ids(self):
+        return await self._run(self._local_be.get_site_ids)
+
+    async def get_time_limits(self, site_id=None):
+        return await self._run(self._local_be.get_time_limits,
+                               site_id=site_id)
+
+    async def get_missing(self, site_id, start, end):
+        return await self._run(self._local_be.get_missing, site_id, start,
+                               end)
+
+    async def add_site(self, site, **kwargs):
+        return await self._run(self._local_be.add_site, site, **kwargs)
+
+    async def add_power(self, power, **kwargs):
+        return await self._run(self._local_be.add_power, power, **kwargs)
+
+
+class AsyncRemote(AsyncAbstract):
+    """ Talks to the SolarEdge API (see edgydata.backend.remote.Remote)
+    without blocking. It should only be used from one event loop. An
+    existing Remote can be given, instead of the arguments to make one.
+
+    However many calls are waiting, only max_concurrency of them are made
+    at once, and that includes any the Remote is making from other threads.
+    """
+    def __init__(self, api_key=None, debug=False, base_url=BASE_URL,
+                 max_concurrency=MAXCONCURRENCY, timeout=TIMEOUT,
+                 retries=RETRIES, backoff=BACKOFF, site_cache=None,
+                 recording=None, metrics=None, executor=None, remote=None):
+        AsyncAbstract.__init__(self, executor=executor)
+        # The synchronous backend keeps the settings, the site cache and the
+        # limit on concurrent calls, and makes the calls if there's no
+        # aiohttp
+        if remote is None:
+            remote = Remote(api_key=api_key, debug=debug, base_url=base_url,
+                            max_concurrency=max_concurrency,
+                            timeout=timeout, retries=retries,
+                            backoff=backoff, site_cache=site_cache,
+                            recording=recording, metrics=metrics)
+        self._remote_be = remote
+        self.metrics = self._remote_be.metrics
+        # These have to be made inside the event loop
+        self._session = None
+        self._call_slots = None
+
+    def _get_session(self):
+        if self._session is None:
+            slots = max(self._remote_be._max_concurrency, 1)
+            self._call_slots = asyncio.Semaphore(slots)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=slots),
+                timeout=aiohttp.ClientTimeout(total=self._remote_be._timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _take_call_slot(self):
+        """ Wait (on an executor thread) for one of the Remote's call slots
+        """
+        slots = self._remote_be._call_slots
+        taken = asyncio.get_running_loop().run_in_executor(self._executor,
+                                                           slots.acquire)
+        try:
+            await asyncio.shield(taken)
+        except asyncio.CancelledError:
+            # It will still get the slot, so give it back when it does
+            taken.add_done_callback(lambda _: slots.release())
+            raise
+
+    async def _remote_call(self, sub_url, data=None):
+        """ The same as Remote._remote_call(), sharing all of it but the
+        http request itself
+        """
+        remote = self._remote_be
+        if aiohttp is None or remote._is_replaying():
+            # Replaying only reads files, but it still shouldn't block
+            return await self._run(remote._remote_call, sub_url, data)
+        url, params = remote._make_call(sub_url, data)
+        session = self._get_session()
+        attempt = 0
+        while True:
+            call_start = time.time()
+            retry_after = None
+            try:
+                # Only as many calls as there are slots wait on a thread for
+                # the Remote's
+                async with self._call_slots:
+                    await self._take_call_slot()
+                    try:
+                        async with session.get(url,
+                                               params=params) as response:
+                            content = await response.read()
+                    finally:
+                        remote._call_slots.release()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                remote._call_failed(sub_url, attempt,
+                                    time.time() - call_start, err)
+                reason = err
+            else:
+                if remote._check_response(sub_url, attempt,
+                                          time.time() - call_start,
+                                          response.status, response.reason,
+                                          content):
+                    # Saving it (if we're recording) writes a file
+                    return await self._run(remote._decode, sub_url, params,
+                                           content)
+                reason = response.reason
+                retry_after = response.headers.get("Retry-After")
+            await asyncio.sleep(remote._prepare_retry(sub_url, attempt,
+                                                      reason, retry_after))
+            attempt += 1
+
+    async def _get_site_id(self):
+        """ The only site id, if there is only one """
+        return self._remote_be._only_site_id(await self.get_site_ids())
+
+    async def get_site_ids(self):
+        data = await self._remote_call("sites/list")
+        return self._remote_be._parse_site_ids(data)
+
+    async def get_site(self, site_id=None):
+        if site_id is None:
+            site_id = await self._get_site_id()
+        site_cache = self._remote_be._site_cache
+        # The cache might have to look in the local database
+        site = await self._run(site_cache.lookup, site_id)
+        if site is None:
+            result = await self._remote_call(
+                self._remote_be._site_call(site_id))
+            site = parse_site_details(result["details"], site_id)
+            await self._run(site_cache.add, site)
+        return site
+
+    async def get_time_limits(self, site_id=None):
+        site = await self.get_site(site_id=site_id)
+        return (site.start_date, site.end_date)
+
+    async def get_power(self, site_id=None, start=None, end=None,
+                        as_series=False, date_filter=None):
+        remote = self._remote_be
+        with self.metrics.timer("remote.get_power"):
+            if site_id is None:
+                site_id = await self._get_site_id()
+            site = None
+            if remote._needs_site(start, end, date_filter):
+                site = await self.get_site(site_id)
+            windows = remote._plan_power(site, start, end)
+            results = await asyncio.gather(*[
+                self._fetch_window(site_id, *w) for w in windows])
+            return await self._run(remote._finish_power, results, site=site,
+                                   as_series=as_series,
+                                   date_filter=date_filter)
+
+    async def _fetch_window(self, site_id, start, end):
+        """ Retrieve the power for one window """
+        with self.metrics.timer("remote.fetch_window"):
+            result = await self._remote_call(
+                *self._remote_be._window_call(site_id, start, end))
+            # Decoding a window takes long enough to hold up the event loop
+            return await self._run(parse_power_details,
+                                   result["powerDetails"], site_id)
+
+
+class AsyncHybrid(AsyncAbstract):
+    """ The asyncio equivalent of edgydata.backend.hybrid.Hybrid: the power
+    comes from the local database, once whatever it's missing has been
+    fetched. All the missing parts (for every site asked for) are fetched
+    at once, and each is stored as soon as it arrives.
+    """
+    def __init__(self, api_key=None, local_path=None, debug=False,
+                 site_ttl=SITETTL, base_url=BASE_URL, recording=None,
+                 metrics=None, executor=None):
+        AsyncAbstract.__init__(self, executor=executor)
+        # The synchronous one works out what's missing, and looks after the
+        # local database and the site cache. Its Remote is shared, so that
+        # the calls it makes count towards the same limit as ours
+        self._hybrid = Hybrid(api_key=api_key, local_path=local_path,
+                              debug=debug, site_ttl=site_ttl,
+                              base_url=base_url, recording=recording,
+                              metrics=metrics)
+        self.site_cache = self._hybrid.site_cache
+        self.metrics = self._hybrid.metrics
+        self._local_be = AsyncLocal(local=self._hybrid._local_be,
+                                    executor=executor)
+        self._remote_be = AsyncRemote(remote=self._hybrid._remote_be,
+                                      executor=executor)
+
+    async def close(self):
+        await self._remote_be.close()
+        await self._run(self._hybrid._local_be.close)
+
+    async def _resolve_site_id(self, site_id=None):
+        """ If we haven't been given a site id, use the only one there is """
+        if site_id is not None:
+            return site_id
+        local_ids = await self._local_be.get_site_ids()
+        if len(local_ids) == 1:
+            return list(local_ids)[0]
+        return await self._remote_be._get_site_id()
+
+    async def _plan_update(self, site_id, start=None, end=None):
+        # Get the site here (which also puts it in the local database, ready
+        # for its power), so the planning doesn't ask SolarEdge
+        site = await self.get_site(site_id)
+        if start is None:
+            start = date_to_datetime(site.start_date)
+        return await self._run(self._hybrid._plan_update, site_id,
+                               start=start, end=end)
+
+    async def _fill_gap(self, site_id, gap_start, gap_end, covered_end):
+        self._hybrid.debug("Getting from %s to %s", gap_start, gap_end)
+        power = await self._remote_be.get_power(site_id=site_id,
+                                                start=gap_start, end=gap_end,
+                                                as_series=True)
+        await self._local_be.add_power(
+            power, coverage=[(site_id, gap_start, covered_end)])
+
+    async def _ensure_local(self, site_ids, start=None, end=None):
+        """ Make sure the local database has all the power from start to
+        end for each of site_ids, fetching whatever it's missing
+        """
+        Hybrid._check_timezones(start, end)
+        plans = await asyncio.gather(*[
+            self._plan_update(s, start=start, end=end) for s in site_ids])
+        fills = [self._fill_gap(site_id, *gap)
+                 for site_id, plan in zip(site_ids, plans) for gap in plan]
+        if fills:
+            await asyncio.gather(*fills)
+
+    async def get_power(self, site_id=None, start=None, end=None,
+                        as_series=False, date_filter=None):
+        with self.metrics.timer("hybrid.get_power"):
+            resolved = await self._resolve_site_id(site_id)
+            await self._ensure_local([resolved], start=start, end=end)
+            return await self._local_be.get_power(site_id=site_id,
+                                                  start=start, end=end,
+                                                  as_series=as_series,
+                                                  date_filter=date_filter)
+
+    async def get_power_many(self, site_ids=None, start=None, end=None,
+                             as_series=False, date_filter=None):
+        with self.metrics.timer("hybrid.get_power_many"):
+            if site_ids is None:
+                site_ids = await self.get_site_ids()
+            site_ids = list(site_ids)
+            await self._ensure_local(site_ids, start=start, end=end)
+            return await self._local_be.get_power_many(
+                site_ids=site_ids, start=start, end=end, as_series=as_series,
+                date_filter=date_filter)
+
+    async def get_aggregate(self, site_id=None, start=None, end=None,
+                            period_length=None, combination=Combiners.SUM,
+                            specific=0, as_series=False, date_filter=None):
+        """ Once the local database has the data, let it do the aggregation
+        """
+        with self.metrics.timer("hybrid.get_aggregate"):
+            resolved = await self._resolve_site_id(site_id)
+            await self._ensure_local([resolved], start=start, end=end)
+            return await self._local_be.get_aggregate(
+                site_id=site_id, start=start, end=end,
+                period_length=period_length, combination=combination,
+                specific=specific, as_series=as_series,
+                date_filter=date_filter)
+
+    async def get_site(self, site_id):
+        return await self._remote_be.get_site(site_id=site_id)
+
+    async def get_site_ids(self):
+        return await self._remote_be.get_site_ids()
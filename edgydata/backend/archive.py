@@ -0,0 +1,304 @@
+import json
+import os
+
+import numpy
+
+from edgydata.backend.abstract import Abstract as AbstractBE
+from edgydata.constants import POWER_TYPES, Conflict
+from edgydata.data import Site, PowerSeries
+from edgydata.metrics import timed
+from edgydata.time import (date_to_int, int_to_date, datetime_to_int,
+                           int_to_datetime)
+
+# Each power period is stored as one of these fixed width records
+RECORD_DTYPE = numpy.dtype([("start_time", "<i8"), ("duration", "<i8")] +
+                           [(t, "<f8") for t in sorted(POWER_TYPES)])
+# How many records apart the entries in the sparse time index are
+INDEXSTRIDE = 1024
+# How many records to give out at once when streaming
+CHUNKSIZE = 100000
+
+
+def get_archive_path():
+    """ Get the path to the directory the archive is kept in """
+    return os.path.join(os.environ["HOME"], "edgydata_archive")
+
+
+class Archive(AbstractBE):
+    """ A read-mostly copy of the power data, for fast scans. Each site's
+    power is kept in its own file of fixed width binary records (see
+    RECORD_DTYPE), in time order, which is memory mapped. Reading a time
+    range just slices the arrays, without copying anything, so
+    get_power(as_series=True) costs about the same however much it returns.
+
+    It's meant to be filled from the local database (see copy_from()), but
+    can be written to directly. Adding power that isn't after everything
+    that's already there means rewriting the site's file.
+    """
+    site_file = "sites.json"
+
+    def __init__(self, path=None, debug=False, metrics=None):
+        AbstractBE.__init__(self, debug=debug, metrics=metrics)
+        if path is None:
+            path = get_archive_path()
+        self._path = path
+        # The memory maps, and a sparse index into the start times of each,
+        # are kept until a site's file changes
+        self._maps = {}
+        self._indices = {}
+
+    def is_present(self):
+        return os.path.exists(os.path.join(self._path, self.site_file))
+
+    def create(self):
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+        if not self.is_present():
+            self._write_sites({})
+
+    def destroy(self):
+        if not self.is_present():
+            self.warning("No archive present at %s", self._path)
+            return
+        for site_id in self.get_site_ids():
+            if os.path.exists(self._get_power_path(site_id)):
+                os.remove(self._get_power_path(site_id))
+        os.remove(os.path.join(self._path, self.site_file))
+        self._maps = {}
+        self._indices = {}
+
+    def _get_power_path(self, site_id):
+        return os.path.join(self._path, "%d.power" % int(site_id))
+
+    def _read_sites(self):
+        with open(os.path.join(self._path, self.site_file)) as file_handle:
+            return json.load(file_handle)
+
+    def _write_sites(self, sites):
+        site_path = os.path.join(self._path, self.site_file)
+        with open(site_path + ".tmp", "w") as file_handle:
+            json.dump(sites, file_handle, indent=1, sort_keys=True)
+        os.rename(site_path + ".tmp", site_path)
+
+    def add_site(self, site, conflict=Conflict.REPLACE):
+        sites = self._read_sites()
+        if str(site.site_id) in sites:
+            if conflict == Conflict.KEEP:
+                return
+            if conflict == Conflict.ERROR:
+                raise ValueError("Site %s already in archive" % site.site_id)
+        details = {}
+        for attr in Site.list_attrs():
+            value = getattr(site, attr)
+            if attr in ("start_date", "end_date"):
+                value = date_to_int(value)
+            details[attr] = value
+        sites[str(site.site_id)] = details
+        self._write_sites(sites)
+
+    def get_site(self, site_id):
+        try:
+            details = dict(self._read_sites()[str(site_id)])
+        except KeyError:
+            raise ValueError("Site %s not found in archive" % site_id)
+        details["start_date"] = int_to_date(details["start_date"])
+        details["end_date"] = int_to_date(details["end_date"])
+        return Site(**details)
+
+    def get_site_ids(self):
+        return set(int(s) for s in self._read_sites())
+
+    def _get_records(self, site_id):
+        """ Get the (memory mapped) records for site_id """
+        if site_id not in self._maps:
+            power_path = self._get_power_path(site_id)
+            if not os.path.exists(power_path) or \
+                    os.path.getsize(power_path) == 0:
+                records = numpy.zeros(0, dtype=RECORD_DTYPE)
+            else:
+                records = numpy.memmap(power_path, dtype=RECORD_DTYPE,
+                                       mode="r")
+            self._maps[site_id] = records
+            self._indices[site_id] = numpy.array(
+                records["start_time"][::INDEXSTRIDE])
+        return self._maps[site_id]
+
+    def _forget(self, site_id):
+        self._maps.pop(site_id, None)
+        self._indices.pop(site_id, None)
+
+    def _find(self, site_id, timestamp, side):
+        """ Find where timestamp is (or would go) in site_id's records, using
+        the sparse index to narrow it down to a block first, so only that
+        block of the file needs to be read
+        """
+        start_times = self._get_records(site_id)["start_time"]
+        index = self._indices[site_id]
+        block = max(numpy.searchsorted(index, timestamp, side=side) - 1, 0)
+        first = block * INDEXSTRIDE
+        last = min(first + INDEXSTRIDE + 1, len(start_times))
+        return first + int(numpy.searchsorted(start_times[first:last],
+                                              timestamp, side=side))
+
+    def _to_series(self, site_id, records):
+        """ A PowerSeries that's a view onto records, not a copy """
+        kwargs = {"site_id": numpy.broadcast_to(numpy.int64(site_id),
+                                                len(records))}
+        for col in RECORD_DTYPE.names:
+            kwargs[col] = records[col]
+        return PowerSeries(**kwargs)
+
+    def _get_range(self, site_id, start=None, end=None):
+        """ The records of site_id from start to end (inclusive) """
+        records = self._get_records(site_id)
+        first = 0
+        last = len(records)
+        if start is not None:
+            first = self._find(site_id, datetime_to_int(start), "left")
+        if end is not None:
+            last = self._find(site_id, datetime_to_int(end), "right")
+        return records[first:last]
+
+    def iter_power(self, site_id=None, start=None, end=None,
+                   chunk_size=CHUNKSIZE, as_series=False, date_filter=None):
+        """ Stream the power for site_id (or every site, one after the
+        other) from start to end, chunk_size records at a time. If as_series
+        is True, yield a PowerSeries per chunk instead of individual
+        PowerPeriods.
+        """
+        if site_id is None:
+            site_ids = sorted(self.get_site_ids())
+        else:
+            site_ids = [site_id]
+        for each_id in site_ids:
+            records = self._get_range(each_id, start=start, end=end)
+            for index in range(0, len(records), chunk_size):
+                series = self._to_series(each_id,
+                                         records[index:index + chunk_size])
+                if date_filter is not None:
+                    series = date_filter.apply(
+                        series, timezone=self.get_site(each_id).timezone)
+                if as_series:
+                    yield series
+                else:
+                    for power_period in series:
+                        yield power_period
+
+    @timed("archive.get_power")
+    def get_power(self, site_id=None, start=None, end=None, as_series=False,
+                  date_filter=None):
+        if site_id is not None and date_filter is None:
+            series = self._to_series(site_id, self._get_range(site_id, start,
+                                                              end))
+        else:
+            series = PowerSeries.concatenate(
+                self.iter_power(site_id=site_id, start=start, end=end,
+                                as_series=True, date_filter=date_filter))
+        if as_series:
+            return series
+        return set(series)
+
+    @timed("archive.add_power")
+    def add_power(self, power, conflict=Conflict.KEEP):
+        """ Add an iterable of power periods (or a PowerSeries). If it's all
+        after what's already there, it's just appended to the site's file.
+        Otherwise, the file is rewritten, and what happens to periods that
+        are already in there is decided by conflict.
+
+        Returns a tuple of (number added, number skipped)
+        """
+        if not isinstance(power, PowerSeries):
+            power = PowerSeries.from_periods(power)
+        added = 0
+        skipped = 0
+        for site_id in numpy.unique(power.site_id).tolist():
+            site_power = power[power.site_id == site_id].sorted()
+            new = numpy.zeros(len(site_power), dtype=RECORD_DTYPE)
+            for col in RECORD_DTYPE.names:
+                new[col] = getattr(site_power, col)
+            site_added, site_skipped = self._add_records(site_id, new,
+                                                         conflict)
+            added += site_added
+            skipped += site_skipped
+        if skipped:
+            self.warning("%s power periods skipped as already present",
+                         skipped)
+        return (added, skipped)
+
+    def _add_records(self, site_id, new, conflict):
+        if numpy.any(numpy.diff(new["start_time"]) == 0):
+            raise ValueError("Found duplicate start times")
+        existing = self._get_records(site_id)
+        power_path = self._get_power_path(site_id)
+        if len(existing) == 0 or \
+                new["start_time"][0] > existing["start_time"][-1]:
+            self._forget(site_id)
+            with open(power_path, "ab") as file_handle:
+                new.tofile(file_handle)
+            return (len(new), 0)
+        present = numpy.isin(new["start_time"], existing["start_time"])
+        if conflict == Conflict.ERROR and numpy.any(present):
+            raise ValueError("%s power periods already present" %
+                             numpy.count_nonzero(present))
+        if conflict == Conflict.REPLACE:
+            keep = ~numpy.isin(existing["start_time"], new["start_time"])
+            merged = numpy.concatenate((existing[keep], new))
+            skipped = 0
+        else:
+            merged = numpy.concatenate((existing, new[~present]))
+            skipped = int(numpy.count_nonzero(present))
+        merged = merged[numpy.argsort(merged["start_time"], kind="stable")]
+        self._forget(site_id)
+        del existing
+        with open(power_path + ".tmp", "wb") as file_handle:
+            merged.tofile(file_handle)
+        os.rename(power_path + ".tmp", power_path)
+        return (len(new) - skipped, skipped)
+
+    def get_time_limits(self, site_id=None):
+        if site_id is None:
+            site_ids = self.get_site_ids()
+        else:
+            site_ids = [site_id]
+        starts = []
+        ends = []
+        for each_id in site_ids:
+            records = self._get_records(each_id)
+            if len(records):
+                starts.append(int(records["start_time"][0]))
+                ends.append(int(records["start_time"][-1] +
+                                records["duration"][-1]))
+        if not starts:
+            return (None, None)
+        return (int_to_datetime(min(starts)), int_to_datetime(max(ends)))
+
+    def copy_from(self, backend, site_ids=None, start=None, end=None):
+        """ Copy the sites and power (from start to end) from another
+        backend (usually a Local) into the archive
+        """
+        if not self.is_present():
+            self.create()
+        if site_ids is None:
+            site_ids = backend.get_site_ids()
+        for site_id in sorted(site_ids):
+            self.add_site(backend.get_site(site_id))
+            if hasattr(backend, "iter_power"):
+                for chunk in backend.iter_power(site_id=site_id, start=start,
+                                                end=end, as_series=True,
+                                                chunk_size=CHUNKSIZE):
+                    self.add_power(chunk)
+            else:
+                self.add_power(backend.get_power(site_id=site_id, start=start,
+                                                 end=end, as_series=True))
+
+    def copy_to(self, backend, site_ids=None, start=None, end=None):
+        """ Copy the sites and power (from start to end) in the archive into
+        another backend (usually a Local)
+        """
+        if site_ids is None:
+            site_ids = self.get_site_ids()
+        for site_id in sorted(site_ids):
+            backend.add_site(self.get_site(site_id), conflict=Conflict.KEEP)
+            for chunk in self.iter_power(site_id=site_id, start=start,
+                                         end=end, as_series=True):
+                backend.add_power(chunk)
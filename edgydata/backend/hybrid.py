@@ -1,8 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from edgydata.backend.abstract import Abstract as AbstractBE
-from edgydata.backend.remote import Remote as RemoteBE
+from edgydata.backend.remote import BASE_URL, Remote as RemoteBE
 from edgydata.backend.local import Local as LocalBE
-from edgydata.time import (get_current_datetime, get_midnight_after,
-                           get_midnight_before)
+from edgydata.cache import SITETTL, SiteCache
+from edgydata.constants import Combiners
+from edgydata.metrics import timed
+from edgydata.time import (date_to_datetime, get_current_datetime,
+                           get_midnight_after, get_midnight_before)
 
 
 class Hybrid(AbstractBE):
@@ -11,14 +16,26 @@ class Hybrid(AbstractBE):
     locally)
     """
 
-    def __init__(self, api_key=None, local_path=None, debug=False):
-        AbstractBE.__init__(self, debug=debug)
-        self._remote_be = RemoteBE(api_key=api_key, debug=debug)
-        self._local_be = LocalBE(path=local_path, debug=debug)
+    def __init__(self, api_key=None, local_path=None, debug=False,
+                 site_ttl=SITETTL, base_url=BASE_URL, recording=None,
+                 metrics=None):
+        AbstractBE.__init__(self, debug=debug, metrics=metrics)
+        self._local_be = LocalBE(path=local_path, debug=debug,
+                                 metrics=self.metrics)
         if not self._local_be.is_present():
             self._local_be.create()
+        # Site details are cached in the local database, and shared with the
+        # remote backend, so we only ask SolarEdge when they're out of date
+        self.site_cache = SiteCache(ttl=site_ttl, local=self._local_be,
+                                    metrics=self.metrics)
+        self._remote_be = RemoteBE(api_key=api_key, debug=debug,
+                                   base_url=base_url,
+                                   site_cache=self.site_cache,
+                                   metrics=self.metrics,
+                                   recording=recording)
 
-    def get_power(self, site_id=None, start=None, end=None):
+    @staticmethod
+    def _check_timezones(start, end):
         msg = "All datetimes must have a timezone"
         if start is not None and (start.tzinfo is None or
                                   start.tzinfo.utcoffset(start) is None):
@@ -26,50 +43,129 @@ class Hybrid(AbstractBE):
         if end is not None and (end.tzinfo is None or
                                 end.tzinfo.utcoffset(end) is None):
             raise ValueError(msg)
-        min_local, max_local = self._local_be.get_time_limits(site_id=site_id)
-        if start is not None and end is not None:
-            if min_local < start and max_local > end:
-                return self._local_be.get_power(site_id=site_id,
-                                                start=start, end=end)
+
+    def _ensure_local(self, site_id=None, start=None, end=None):
+        """ Make sure the local database has all the power from start to
+        end, fetching whatever it's missing from the remote
+        """
+        self._check_timezones(start, end)
         self._update_power(site_id=site_id, start=start, end=end)
-        return self._local_be.get_power(site_id=site_id, start=start, end=end)
 
-    def _update_power(self, site_id=None, start=None, end=None):
+    def _resolve_site_id(self, site_id=None):
+        """ If we haven't been given a site id, use the only one there is """
+        if site_id is not None:
+            return site_id
+        local_ids = self._local_be.get_site_ids()
+        if len(local_ids) == 1:
+            return list(local_ids)[0]
+        return self._remote_be._get_site_id()
+
+    @timed("hybrid.get_power")
+    def get_power(self, site_id=None, start=None, end=None, as_series=False,
+                  date_filter=None):
+        self._ensure_local(site_id=site_id, start=start, end=end)
+        return self._local_be.get_power(site_id=site_id, start=start, end=end,
+                                        as_series=as_series,
+                                        date_filter=date_filter)
+
+    @timed("hybrid.get_aggregate")
+    def get_aggregate(self, site_id=None, start=None, end=None,
+                      period_length=None, combination=Combiners.SUM,
+                      specific=0, as_series=False, date_filter=None):
+        """ Once the local database has the data, let it do the aggregation,
+        so only the aggregated rows come out of it
+        """
+        self._ensure_local(site_id=site_id, start=start, end=end)
+        return self._local_be.get_aggregate(site_id=site_id, start=start,
+                                            end=end,
+                                            period_length=period_length,
+                                            combination=combination,
+                                            specific=specific,
+                                            as_series=as_series,
+                                            date_filter=date_filter)
+
+    def _plan_update(self, site_id, start=None, end=None):
+        """ Work out which parts of start to end the local database is
+        missing for site_id. Returns a list of (start, end, covered_end),
+        where covered_end is how far that part can be recorded as complete.
+        """
         now = get_current_datetime()
+        # We only record whole days as being complete: the rest of today is
+        # still fetched, but will be fetched again next time
+        complete_until = get_midnight_before(now)
         # Let's get a round number of days, just to make things cleaner
-        if start is not None:
-            start = get_midnight_before(start)
-        if end is not None:
-            end = get_midnight_after(end)
-            # Don't get imcomplete days
-            if end > now:
-                end = get_midnight_before(end)
-        min_loc, max_loc = self._local_be.get_time_limits(site_id=site_id)
-        min_rem, max_rem = self._remote_be.get_time_limits(site_id=site_id)
-        retrieved = []
-        if start is None or start < min_loc:
-            self.debug("Getting from %s to %s" % (start, min_loc))
-            pp = self._remote_be.get_power(site_id=site_id,
-                                           start=start, end=min_loc)
-            retrieved.extend(pp)
-        # if min_loc is None and start is None, we already have
-        # everything there is to get
-        if (end is None or end > max_loc) and not \
-                (min_loc is None and start is None):
-            self.debug("Getting from %s to %s" % (max_loc, end))
-            pp = self._remote_be.get_power(site_id=site_id,
-                                           start=max_loc, end=end)
-            retrieved.extend(pp)
-        if retrieved:
-            self._local_be.add_power(retrieved)
+        if start is None:
+            start = date_to_datetime(self.get_site(site_id).start_date)
+        start = get_midnight_before(start)
+        if end is None:
+            end = now
+        else:
+            end = min(get_midnight_after(end), now)
+        if start >= end:
+            return []
+        gaps = self._local_be.get_missing(site_id, start, end)
+        if gaps:
+            # The site's timezone is needed to store its power, so make sure
+            # the site is in the local database first (the site cache puts
+            # it there when it's fetched)
+            self.get_site(site_id)
+        return [(s, e, min(e, complete_until)) for s, e in gaps]
+
+    def _fetch_gaps(self, site_id, plan):
+        """ Fetch each of the parts of a plan from the remote (without
+        storing them)
+        """
+        results = []
+        for gap_start, gap_end, covered_end in plan:
+            self.debug("Getting from %s to %s", gap_start, gap_end)
+            pp = self._remote_be.get_power(site_id=site_id, start=gap_start,
+                                           end=gap_end, as_series=True)
+            results.append((pp, [(site_id, gap_start, covered_end)]))
+        return results
+
+    def _store(self, fetched):
+        for pp, coverage in fetched:
+            self._local_be.add_power(pp, coverage=coverage)
+
+    def _update_power(self, site_id=None, start=None, end=None):
+        """ Fetch the power from the remote for every part of start to end
+        that the local database doesn't have
+        """
+        site_id = self._resolve_site_id(site_id)
+        plan = self._plan_update(site_id, start=start, end=end)
+        self._store(self._fetch_gaps(site_id, plan))
+
+    @timed("hybrid.get_power_many")
+    def get_power_many(self, site_ids=None, start=None, end=None,
+                       as_series=False, date_filter=None):
+        """ Get the power for several sites (or all of them, if site_ids is
+        None). Whatever is missing locally is fetched for all the sites
+        concurrently, sharing the remote's limit on concurrent calls.
+        Returns {site_id: power}
+        """
+        self._check_timezones(start, end)
+        if site_ids is None:
+            site_ids = self.get_site_ids()
+        plans = dict((s, self._plan_update(s, start=start, end=end))
+                     for s in site_ids)
+        to_fetch = [s for s in site_ids if plans[s]]
+
+        def fetch(site_id):
+            # The local database can be written to from any thread, so each
+            # site's power is stored as soon as it arrives
+            self._store(self._fetch_gaps(site_id, plans[site_id]))
+
+        if to_fetch:
+            workers = min(self._remote_be._max_concurrency, len(to_fetch))
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                # Go through the results, so that any exception is raised
+                list(executor.map(fetch, to_fetch))
+        return self._local_be.get_power_many(site_ids=site_ids, start=start,
+                                             end=end, as_series=as_series,
+                                             date_filter=date_filter)
 
     def get_site(self, site_id):
-        try:
-            site = self._local_be.get_site(site_id=site_id)
-        except Exception:
-            site = self._remote_be.get_site(site_id=site_id)
-            self._local_be.add_site(site)
-        return site
+        return self._remote_be.get_site(site_id=site_id)
 
     def get_site_ids(self):
         # I can't think of a better way to do this
@@ -1,21 +1,32 @@
 import os
-import sys
-
-import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta
+from functools import wraps
+
+import numpy
 
+from edgydata.aggregate import combine_batches
 from edgydata.backend.abstract import Abstract as AbstractBE
-from edgydata.constants import POWER_TYPES
-from edgydata.data import Site, PowerPeriod
-from edgydata.lib import batch
+from edgydata.constants import POWER_TYPES, Combiners, Conflict, DatePreset
+from edgydata.data import Site, PowerPeriod, PowerSeries
+from edgydata.datefilter import date_to_number
+from edgydata.metrics import timed
+from edgydata.pool import READERS, ConnectionPool
 from edgydata.time import (date_to_int, int_to_date,
                            datetime_to_int, int_to_datetime,
-                           timedelta_to_int, int_to_timedelta)
+                           timedelta_to_int, int_to_timedelta,
+                           utc_offset_ranges)
 
 _TYPE_LOOKUP = {str: "STRING", int: "INTEGER", float: "FLOAT",
                 date: "INTEGER", timedelta: "INTEGER"}
 
 INSERTBATCHSIZE = 100
+# How many rows to pull out of the database at once when streaming
+FETCHBATCHSIZE = 1000
+# If a DateFilter picks out at most this many days of the year, it's quicker
+# to use the month and day index than to read through the site's power
+MONTHDAYINDEXLIMIT = 31
 
 # The converters to use to put object types into and get them out of the
 # database. First element is to put them in, second to get them out
@@ -23,12 +34,38 @@ _CONVERTER = {date: (date_to_int, int_to_date),
               datetime: (datetime_to_int, int_to_datetime),
               timedelta: (timedelta_to_int, int_to_timedelta)}
 
+# The rollup tables of pre-aggregated power, and the sql that gives the
+# start of the period (in UTC) that each power period falls into
+_ROLLUP_BUCKETS = {
+    "hourly": "start_time - start_time % 3600",
+    "daily": "start_time - start_time % 86400",
+    "monthly": "CAST(strftime('%s', start_time, 'unixepoch', "
+               "'start of month') AS INTEGER)"}
+_YEAR_BUCKET = ("CAST(strftime('%s', start_time, 'unixepoch', "
+                "'start of year') AS INTEGER)")
+
+# Where each power period starts in the calendar, in the site's local time,
+# so that a DateFilter can be done in sql. local_date is yyyymmdd,
+# local_minute is the minute of the day, and local_weekday is 0 for Monday
+_CALENDAR_COLUMNS = ("local_date", "local_minute", "local_weekday")
+# The sql that works each of them out, from the local unix time
+_CALENDAR_SQL = {
+    "local_date": "CAST(strftime('%Y%m%d', start_time + ?, 'unixepoch') "
+                  "AS INTEGER)",
+    "local_minute": "(start_time + ?) % 86400 / 60",
+    "local_weekday": "((start_time + ?) / 86400 + 3) % 7"}
+
+# The sqlite conflict clause to use for each conflict policy
+_CONFLICT_CLAUSE = {Conflict.KEEP: "INSERT OR IGNORE",
+                    Conflict.REPLACE: "INSERT OR REPLACE",
+                    Conflict.ERROR: "INSERT OR ABORT"}
+
 
 def _check(mystr):
     """ Ensure a string isn't trying to inject any dodgy SQL """
     # Although the input strings are all self-generated atm, this could
     # change in future
-    if mystr != mystr.translate(None, ")(][;,"):
+    if any(char in mystr for char in ")(][;,"):
         raise RuntimeError("Input '%s' looks dodgy to me" % mystr)
     return mystr
 
@@ -38,32 +75,153 @@ def get_db_path():
     return os.path.join(os.environ["HOME"], "edgydata.db")
 
 
+def _reads(method):
+    """ A decorator for Local methods that read from the database: they get
+    a reader connection, unless the thread is already using one (or is in a
+    transaction)
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.reading():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _writes(method):
+    """ A decorator for Local methods that write to the database: they're
+    done in a transaction (or as part of the one the thread is already in)
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _rollup_range(rollup, first, last):
+    """ Get the start of the rollup period that the unix timestamp first is
+    in, and the start of the one after the period that last is in
+    """
+    if rollup == "monthly":
+        first_dt = int_to_datetime(first)
+        last_dt = int_to_datetime(last)
+        lower = first_dt.replace(day=1, hour=0, minute=0, second=0)
+        upper = last_dt.replace(day=1, hour=0, minute=0, second=0)
+        if upper.month == 12:
+            upper = upper.replace(year=upper.year + 1, month=1)
+        else:
+            upper = upper.replace(month=upper.month + 1)
+        return datetime_to_int(lower), datetime_to_int(upper)
+    seconds = {"hourly": 3600, "daily": 86400}[rollup]
+    return first - first % seconds, last - last % seconds + seconds
+
+
+def _is_rollup_start(rollup, timestamp):
+    """ Is the unix timestamp at the start of one of rollup's periods? """
+    return _rollup_range(rollup, timestamp, timestamp)[0] == timestamp
+
+
 class Local(AbstractBE):
     """ A local mirror of the solar power data, stored in a sqlite database.
     The intention is that the extraction API is the same as
     `edgydata.db.remote.Remote`, but there isn't any benefit to using
     inheritance here.
+
+    It can be used from several threads at once. The database is in WAL
+    mode, with one writer connection and a pool of reader connections (see
+    edgydata.pool), so reading doesn't wait for writing. Everything that
+    writes is done in a transaction, and transaction() can be used to make
+    several writes (e.g. some power, and how far it's been synced to) happen
+    all together, or not at all.
     """
     site_table = "site"
+    site_fetched_table = "site_fetched"
     power_table = "power"
+    coverage_table = "coverage"
+    sync_table = "sync_state"
 
-    def __init__(self, path=None, debug=False):
-        AbstractBE.__init__(self, debug=debug)
+    def __init__(self, path=None, debug=False, metrics=None,
+                 readers=READERS):
+        AbstractBE.__init__(self, debug=debug, metrics=metrics)
         # If we get given a path, use it, but we can make up our own
         if path is None:
             self._dbpath = get_db_path()
         else:
             self._dbpath = path
-        self._connect_db()
+        self._readers = readers
+        self._pool = ConnectionPool(self._dbpath, readers=readers)
+        # The cursor (and whether it's in a transaction) that each thread is
+        # currently using
+        self._state = threading.local()
+        if self.is_present():
+            self._upgrade()
 
-    def _connect_db(self):
-        self._conn = sqlite3.connect(self._dbpath)
-        self._cursor = self._conn.cursor()
+    def close(self):
+        """ Close all the connections to the database """
+        self._pool.close()
+
+    @property
+    def _cursor(self):
+        cursor = getattr(self._state, "cursor", None)
+        if cursor is None:
+            raise RuntimeError("Not reading from or writing to the database")
+        return cursor
+
+    @contextmanager
+    def reading(self):
+        """ A context manager that reads done inside are done with. They're
+        all in one (read only) transaction, so they see the database as it
+        was at one moment, whatever's being written meanwhile.
+        """
+        if getattr(self._state, "cursor", None) is not None:
+            yield
+            return
+        with self._pool.reader() as connection:
+            self._state.cursor = connection.cursor()
+            try:
+                self._state.cursor.execute("BEGIN")
+                try:
+                    yield
+                finally:
+                    self._state.cursor.execute("COMMIT")
+            finally:
+                self._state.cursor.close()
+                self._state.cursor = None
+
+    @contextmanager
+    def transaction(self):
+        """ A context manager for a transaction: everything written inside
+        is committed at the end, or rolled back if there's an exception.
+        Transactions inside transactions are part of the outer one.
+        """
+        if getattr(self._state, "in_transaction", False):
+            yield
+            return
+        outer = getattr(self._state, "cursor", None)
+        with self._pool.writer() as connection:
+            self._state.cursor = connection.cursor()
+            self._state.in_transaction = True
+            try:
+                # Take the write lock now, rather than at the first write,
+                # so that what's read in the transaction can't change
+                self._state.cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    yield
+                except BaseException:
+                    self._state.cursor.execute("ROLLBACK")
+                    raise
+                self._state.cursor.execute("COMMIT")
+            finally:
+                self._state.cursor.close()
+                self._state.cursor = outer
+                self._state.in_transaction = False
 
     def _execute(self, sql, variables=None, many=False):
-        """ Execute an sql query, after optionally printing it """
-        self.debug("Executing:")
-        self.debug(sql)
+        """ Execute an sql query, after optionally logging it. This has to
+        be done inside reading() or transaction().
+        """
+        self.debug("Executing: %s", sql)
+        self.metrics.increment("local.sql_statements")
         if variables is None:
             if many is True:
                 return_value = self._cursor.executemany(sql)
@@ -73,28 +231,44 @@ class Local(AbstractBE):
             # TODO: Check if it's a tuple / iterable
             if not isinstance(variables, list):
                 variables = [variables]
-            self.debug("Variables: %s" % (variables,))
             if many is True:
+                self.debug("Variables: %s rows", len(variables))
                 return_value = self._cursor.executemany(sql, variables)
             else:
                 return_value = self._cursor.execute(sql, variables)
-        self._conn.commit()
         return return_value
 
-    def is_present(self):
-        """ Check to see if the local database exists """
+    @_reads
+    def _has_table(self, table_name):
+        sql = "SELECT name FROM sqlite_master WHERE type='table' AND name = ?"
+        self._execute(sql, table_name)
+        return self._cursor.fetchone() is not None
+
+    @_reads
+    def _is_present(self):
         sql = "SELECT name FROM sqlite_master WHERE type='table'"
         self._execute(sql)
         if self._cursor.fetchall() == []:
             return False
         return True
 
+    def is_present(self):
+        """ Check to see if the local database exists """
+        # Don't make an empty one by looking
+        if self._dbpath != ":memory:" and not os.path.exists(self._dbpath):
+            return False
+        return self._is_present()
+
     def destroy(self):
         if self.is_present():
-            self._conn.close()
-            os.remove(self._dbpath)
+            self._pool.close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self._dbpath + suffix):
+                    os.remove(self._dbpath + suffix)
+            # Ready to create it again
+            self._pool = ConnectionPool(self._dbpath, readers=self._readers)
         else:
-            self.warning("No database present at %s" % self._dbpath)
+            self.warning("No database present at %s", self._dbpath)
 
     def _create_site_table(self):
         table_name = _check(self.site_table)
@@ -125,19 +299,130 @@ class Local(AbstractBE):
                      _check(self.site_table))
         return self._execute(sql)
 
+    def _create_power_index(self):
+        """ A covering index, so that reading a site's power for a time range
+        never needs to look at the table itself
+        """
+        columns = ", ".join(self._get_power_columns())
+        sql = "CREATE INDEX IF NOT EXISTS %s_site_time ON %s (%s)"
+        sql = sql % (_check(self.power_table), _check(self.power_table),
+                     columns)
+        return self._execute(sql)
+
+    def _add_calendar_columns(self):
+        """ Add the calendar columns (see _CALENDAR_COLUMNS) to the power
+        table, if it doesn't have them, and fill them in
+        """
+        sql = "PRAGMA table_info(%s)" % _check(self.power_table)
+        self._execute(sql)
+        existing = set(row[1] for row in self._cursor.fetchall())
+        missing = [c for c in _CALENDAR_COLUMNS if c not in existing]
+        for column in missing:
+            sql = "ALTER TABLE %s ADD COLUMN %s INTEGER"
+            self._execute(sql % (_check(self.power_table), column))
+        # Month and day are what's usually filtered on, so index them
+        sql = "CREATE INDEX IF NOT EXISTS %s_site_monthday ON %s "
+        sql += "(site_id, local_date %% 10000)"
+        sql = sql % (_check(self.power_table), _check(self.power_table))
+        self._execute(sql)
+        if missing:
+            self.rebuild_calendar()
+
+    def _create_site_fetched_table(self):
+        """ When each site's details were last fetched from SolarEdge """
+        sql = """ CREATE TABLE IF NOT EXISTS %s (
+                    site_id INTEGER,
+                    fetched_time FLOAT,
+                    PRIMARY KEY (site_id)
+            );""" % _check(self.site_fetched_table)
+        return self._execute(sql)
+
+    def _create_coverage_table(self):
+        """ The time ranges (start_time <= t < end_time) that we have
+        fetched all the power for, for each site
+        """
+        sql = """ CREATE TABLE IF NOT EXISTS %s (
+                    site_id INTEGER,
+                    start_time INTEGER,
+                    end_time INTEGER,
+                    PRIMARY KEY (site_id, start_time)
+            );""" % _check(self.coverage_table)
+        return self._execute(sql)
+
+    def _create_sync_table(self):
+        """ How far each site has been synced up to """
+        sql = """ CREATE TABLE IF NOT EXISTS %s (
+                    site_id INTEGER,
+                    high_water INTEGER,
+                    PRIMARY KEY (site_id)
+            );""" % _check(self.sync_table)
+        return self._execute(sql)
+
+    def _get_rollup_table(self, rollup):
+        return _check("%s_%s" % (self.power_table, rollup))
+
+    @classmethod
+    def _get_rollup_columns(cls):
+        results = ["site_id", "start_time", "first_start", "end_time",
+                   "count"]
+        for eachtype in sorted(POWER_TYPES):
+            for prefix in ("sum", "min", "max"):
+                results.append("%s_%s" % (prefix, eachtype))
+        return results
+
+    def _create_rollup_table(self, rollup):
+        """ A table of the power rolled up into hourly, daily or monthly
+        periods (see _ROLLUP_BUCKETS). For each period, it has the start of
+        the first power period, the end of the last one, how many there were,
+        and for each power type the sum of (power * duration), minimum and
+        maximum. That's enough to give the same results as get_aggregate().
+        """
+        columns = []
+        for col in self._get_rollup_columns():
+            col_type = "FLOAT" if col[:4] in ("sum_", "min_", "max_") \
+                else "INTEGER"
+            columns.append("%s %s" % (_check(col), col_type))
+        sql = """ CREATE TABLE IF NOT EXISTS %s (
+                    %s,
+                    PRIMARY KEY (site_id, start_time)
+            );""" % (self._get_rollup_table(rollup), ",\n".join(columns))
+        return self._execute(sql)
+
+    @_writes
+    def _upgrade(self):
+        """ Add anything that databases made by older versions are missing.
+        Everything in here must be safe to run more than once.
+        """
+        self._create_power_index()
+        self._add_calendar_columns()
+        self._create_site_fetched_table()
+        self._create_sync_table()
+        for rollup in sorted(_ROLLUP_BUCKETS):
+            if not self._has_table(self._get_rollup_table(rollup)):
+                self._create_rollup_table(rollup)
+                self.rebuild_rollups(rollups=[rollup])
+        if not self._has_table(self.coverage_table):
+            self._create_coverage_table()
+            # Make a best guess from the power that's already there
+            self.rebuild_coverage()
+
+    @_writes
     def create(self):
         """ Create the local database """
-        try:
-            assert not self.is_present()
-            self._create_site_table()
-            self._create_power_table()
-        except sqlite3.ProgrammingError:
-            # If we've just destroyed, we need to re-connect before
-            # recreating
-            self._connect_db()
-            self.create()
-
-    def add_site(self, site):
+        assert not self._is_present()
+        self._create_site_table()
+        self._create_power_table()
+        self._upgrade()
+
+    @_writes
+    def add_site(self, site, fetched_time=None, conflict=Conflict.ERROR):
+        """ Add a Site to the local database. If fetched_time (a unix
+        timestamp) is given, that is recorded as when its details were
+        fetched, and any existing details for the site are replaced.
+        """
+        if fetched_time is not None:
+            conflict = Conflict.REPLACE
+        old_timezone = self._get_site_timezone(site.site_id)
         results = []
         for key in self._get_site_columns():
             value = getattr(site, key)
@@ -145,10 +430,53 @@ class Local(AbstractBE):
                 results.append(_CONVERTER[value.__class__][0](value))
             else:
                 results.append(value)
-        sql = "INSERT INTO %s VALUES (?, ?, ?, ?, ?)"
+        sql = "%s INTO %s VALUES (%s)"
+        sql = sql % (_CONFLICT_CLAUSE[conflict], _check(self.site_table),
+                     ", ".join(["?"] * len(results)))
+        return_value = self._execute(sql, results)
+        if fetched_time is not None:
+            sql = "INSERT OR REPLACE INTO %s VALUES (?, ?)"
+            sql = sql % _check(self.site_fetched_table)
+            self._execute(sql, [site.site_id, fetched_time])
+        if self._get_site_timezone(site.site_id) != old_timezone:
+            self.rebuild_calendar(site.site_id)
+        return return_value
+
+    @_reads
+    def _get_site_timezone(self, site_id):
+        """ The timezone of site_id, or None if we don't have the site """
+        sql = "SELECT timezone FROM %s WHERE site_id = ?"
         sql = sql % _check(self.site_table)
-        return self._execute(sql, results)
+        self._execute(sql, site_id)
+        result = self._cursor.fetchone()
+        if result is None:
+            return None
+        return result[0]
 
+    @_reads
+    def get_site_fetched_time(self, site_id):
+        """ When the details of site_id were last fetched (as a unix
+        timestamp), or None if we don't know
+        """
+        sql = "SELECT fetched_time FROM %s WHERE site_id = ?"
+        sql = sql % _check(self.site_fetched_table)
+        self._execute(sql, site_id)
+        result = self._cursor.fetchone()
+        if result is None:
+            return None
+        return result[0]
+
+    @_writes
+    def clear_site_fetched_time(self, site_id=None):
+        """ Forget when site_id (or every site, if None) was fetched, so that
+        its details are treated as out of date
+        """
+        sql = "DELETE FROM %s" % _check(self.site_fetched_table)
+        if site_id is not None:
+            sql += " WHERE site_id = ?"
+        return self._execute(sql, site_id)
+
+    @_reads
     def get_site(self, site_id=None):
         sql = "SELECT * FROM %s WHERE site_id = ?"
         sql = sql % _check(self.site_table)
@@ -164,10 +492,9 @@ class Local(AbstractBE):
         tmp_dict = dict(zip(columns, raw_tuple))
         tmp_dict["start_date"] = int_to_date(tmp_dict["start_date"])
         tmp_dict["end_date"] = int_to_date(tmp_dict["end_date"])
-        print("tmp_dict")
-        print(tmp_dict)
         return Site(**tmp_dict)
 
+    @_reads
     def get_site_ids(self):
         sql = "SELECT DISTINCT(site_id) FROM %s"
         sql = sql % _check(self.site_table)
@@ -185,64 +512,602 @@ class Local(AbstractBE):
         results.extend(sorted(POWER_TYPES))
         return results
 
-    def _has_power(self, power):
-        if self.get_power(site_id=power.site_id, start=power.start_time,
-                          end=power.start_time):
-            return True
-        return False
-
-    def add_power(self, power):
-        """ Add an interable of power periods to the local database. Skip them
-        if they're already in there.
-        """
-        msg = "Adding %s power periods to the local database" % len(power)
-        self.info(msg)
-        sorted_power = sorted(power)
-        start = sorted_power[0].start_time
-        end = sorted_power[-1].start_time + sorted_power[-1].duration
-        msg = "From %s to %s" % (start, end)
-        self.info(msg)
-        for powerbatch in batch(power, INSERTBATCHSIZE):
-            rows = []
-            for eachpower in powerbatch:
-                if self._has_power(eachpower):
-                    self.warning("%s skipped as already present" % eachpower)
-                    continue
-                power_row = [eachpower.site_id,
-                             datetime_to_int(eachpower.start_time),
-                             timedelta_to_int(eachpower.duration)]
-                for col in sorted(POWER_TYPES):
-                    value = getattr(eachpower, col)
-                    power_row.append(value)
-                rows.append(power_row)
-            sql = "INSERT INTO %s VALUES (?, ?, ?, %s)"
-            more_args = ", ".join(["?"] * len(POWER_TYPES))
-            sql = sql % (_check(self.power_table), more_args)
-            print(sql)
-            self._execute(sql, rows, many=True)
-
-    def get_power(self, site_id=None, start=None, end=None):
-        if start is None:
-            start = 0
+    @classmethod
+    def _get_power_rows(cls, power):
+        """ Convert power periods (or a PowerSeries) into rows for the power
+        table
+        """
+        if isinstance(power, PowerSeries):
+            return list(power.to_rows())
+        rows = []
+        for eachpower in power:
+            power_row = [eachpower.site_id, eachpower.start_timestamp,
+                         timedelta_to_int(eachpower.duration)]
+            for col in sorted(POWER_TYPES):
+                power_row.append(getattr(eachpower, col))
+            rows.append(tuple(power_row))
+        return rows
+
+    @timed("local.add_power")
+    @_writes
+    def add_power(self, power, conflict=Conflict.KEEP, coverage=None):
+        """ Add an interable of power periods (or a PowerSeries) to the local
+        database, in a single transaction. What happens to periods that are
+        already in there is decided by conflict: they can be kept, replaced,
+        or cause an error (in which case nothing is added).
+
+        coverage is an optional list of (site_id, start, end) time ranges
+        that this is all of the power for, which are recorded (see
+        get_missing()) in the same transaction.
+
+        Returns a tuple of (number added, number skipped)
+        """
+        rows = self._get_power_rows(power)
+        self.info("Adding %s power periods to the local database", len(rows))
+        columns = self._get_power_columns()
+        sql = "%s INTO %s (%s) VALUES (%s)"
+        sql = sql % (_CONFLICT_CLAUSE[conflict], _check(self.power_table),
+                     ", ".join(columns), ", ".join(["?"] * len(columns)))
+        connection = self._cursor.connection
+        changes_before = connection.total_changes
+        # The order they go in doesn't matter (and a PowerSeries is already
+        # in time order), so just slice them up, without sorting
+        for index in range(0, len(rows), INSERTBATCHSIZE):
+            self._execute(sql, rows[index:index + INSERTBATCHSIZE],
+                          many=True)
+        added = connection.total_changes - changes_before
+        site_ranges = {}
+        for row in rows:
+            first, last = site_ranges.get(row[0], (row[1], row[1]))
+            site_ranges[row[0]] = (min(first, row[1]), max(last, row[1]))
+        for site_id, (first, last) in site_ranges.items():
+            self._update_calendar(site_id, first, last)
+            self._update_rollups(site_id, first, last)
+        for site_id, start, end in coverage or []:
+            self._add_coverage(site_id, datetime_to_int(start),
+                               datetime_to_int(end))
+        skipped = len(rows) - added
+        self.metrics.increment("local.rows_written", added)
+        if skipped:
+            self.metrics.increment("local.rows_skipped", skipped)
+            self.warning("%s power periods skipped as already present",
+                         skipped)
+        return (added, skipped)
+
+    def _update_calendar(self, site_id, first, last):
+        """ Work out the calendar columns of site_id's power starting from
+        first to last (unix timestamps)
+        """
+        timezone = self._get_site_timezone(site_id)
+        if timezone is None:
+            # add_site() works them out again, once we know the timezone
+            self.warning("Site %s is not in the local database, so its "
+                         "calendar is in UTC until it's added", site_id)
+            timezone = "UTC"
+        assignments = ", ".join("%s = %s" % (c, _CALENDAR_SQL[c])
+                                for c in _CALENDAR_COLUMNS)
+        sql = "UPDATE %s SET %s WHERE site_id = ? AND start_time >= ? "
+        sql += "AND start_time <= ?"
+        sql = sql % (_check(self.power_table), assignments)
+        for range_first, range_last, offset in utc_offset_ranges(first, last,
+                                                                 timezone):
+            variables = [offset] * len(_CALENDAR_COLUMNS)
+            variables.extend([site_id, range_first, range_last])
+            self._execute(sql, variables)
+
+    @_writes
+    def rebuild_calendar(self, site_id=None):
+        """ Work out the calendar columns again for all of site_id's power
+        (or every site's), e.g. if its timezone has changed
+        """
+        sql = "SELECT site_id, MIN(start_time), MAX(start_time) FROM %s"
+        sql = sql % _check(self.power_table)
+        if site_id is not None:
+            sql += " WHERE site_id = ?"
+        sql += " GROUP BY site_id"
+        self._execute(sql, site_id)
+        for each_id, first, last in self._cursor.fetchall():
+            self._update_calendar(each_id, first, last)
+
+    def _rollup_sql(self, rollup, where):
+        """ The sql that rolls up the rows of the power table picked out by
+        the where clause into rollup's periods
+        """
+        bucket = _ROLLUP_BUCKETS[rollup]
+        columns = ["site_id", bucket, "MIN(start_time)",
+                   "MAX(start_time + duration)", "COUNT(*)"]
+        for eachtype in sorted(POWER_TYPES):
+            eachtype = _check(eachtype)
+            columns.append("SUM(%s * duration)" % eachtype)
+            columns.append("MIN(%s)" % eachtype)
+            columns.append("MAX(%s)" % eachtype)
+        # The bucket sql has % signs in it, so can't go through % formatting
+        sql = "INSERT INTO %s SELECT %s FROM %s %s GROUP BY site_id, "
+        sql = sql % (self._get_rollup_table(rollup), ", ".join(columns),
+                     _check(self.power_table), where)
+        return sql + bucket
+
+    def _update_rollups(self, site_id, first, last):
+        """ Recalculate the rollups of every period touched by power starting
+        from first to last (unix timestamps) for site_id
+        """
+        for rollup in sorted(_ROLLUP_BUCKETS):
+            lower, upper = _rollup_range(rollup, first, last)
+            where = "WHERE site_id = ? AND start_time >= ? AND start_time < ?"
+            sql = "DELETE FROM %s %s" % (self._get_rollup_table(rollup),
+                                         where)
+            self._execute(sql, [site_id, lower, upper])
+            sql = self._rollup_sql(rollup, where)
+            self._execute(sql, [site_id, lower, upper])
+
+    @_writes
+    def rebuild_rollups(self, site_id=None, rollups=None):
+        """ Throw away the rollup tables (or just those named in rollups) and
+        recalculate them from the power table, for site_id (or every site)
+        """
+        if rollups is None:
+            rollups = sorted(_ROLLUP_BUCKETS)
+        where = ""
+        if site_id is not None:
+            where = "WHERE site_id = ?"
+        for rollup in rollups:
+            sql = "DELETE FROM %s %s" % (self._get_rollup_table(rollup),
+                                         where)
+            self._execute(sql, site_id)
+            sql = self._rollup_sql(rollup, where)
+            self._execute(sql, site_id)
+
+    def _add_coverage(self, site_id, start, end):
+        """ Record that we have all the power for site_id from start to end
+        (unix timestamps), merging it with any ranges that it overlaps or
+        touches
+        """
+        if end <= start:
+            return
+        sql = "SELECT MIN(start_time), MAX(end_time) FROM %s WHERE "
+        sql += "site_id = ? AND start_time <= ? AND end_time >= ?"
+        sql = sql % _check(self.coverage_table)
+        self._execute(sql, [site_id, end, start])
+        min_start, max_end = self._cursor.fetchone()
+        if min_start is not None:
+            start = min(start, min_start)
+            end = max(end, max_end)
+        sql = "DELETE FROM %s WHERE "
+        sql += "site_id = ? AND start_time <= ? AND end_time >= ?"
+        sql = sql % _check(self.coverage_table)
+        self._execute(sql, [site_id, end, start])
+        sql = "INSERT INTO %s VALUES (?, ?, ?)" % _check(self.coverage_table)
+        self._execute(sql, [site_id, start, end])
+
+    @_writes
+    def add_coverage(self, site_id, start, end):
+        """ Record that the database has all the power for site_id from start
+        to end
+        """
+        self._add_coverage(site_id, datetime_to_int(start),
+                           datetime_to_int(end))
+
+    @_reads
+    def get_coverage(self, site_id):
+        """ Get the list of (start, end) time ranges that the database has
+        all the power for, for site_id
+        """
+        sql = "SELECT start_time, end_time FROM %s WHERE site_id = ? "
+        sql += "ORDER BY start_time"
+        sql = sql % _check(self.coverage_table)
+        self._execute(sql, site_id)
+        return [(int_to_datetime(s), int_to_datetime(e))
+                for s, e in self._cursor.fetchall()]
+
+    @_reads
+    def get_missing(self, site_id, start, end):
+        """ Get the list of (start, end) time ranges between start and end
+        that the database doesn't have all the power for
+        """
+        start_int = datetime_to_int(start)
+        end_int = datetime_to_int(end)
+        sql = "SELECT start_time, end_time FROM %s WHERE site_id = ? AND "
+        sql += "start_time < ? AND end_time > ? ORDER BY start_time"
+        sql = sql % _check(self.coverage_table)
+        self._execute(sql, [site_id, end_int, start_int])
+        missing = []
+        position = start_int
+        for covered_start, covered_end in self._cursor.fetchall():
+            if covered_start > position:
+                missing.append((position, covered_start))
+            position = max(position, covered_end)
+        if position < end_int:
+            missing.append((position, end_int))
+        return [(int_to_datetime(s), int_to_datetime(e)) for s, e in missing]
+
+    @_writes
+    def rebuild_coverage(self, site_id=None):
+        """ Throw away the record of which time ranges we have, and work it
+        out again from the power in the database: each run of consecutive
+        power periods is taken to be complete.
+        """
+        sql = "SELECT site_id, start_time, duration FROM %s"
+        sql = sql % _check(self.power_table)
+        delete_sql = "DELETE FROM %s" % _check(self.coverage_table)
+        if site_id is not None:
+            sql += " WHERE site_id = ?"
+            delete_sql += " WHERE site_id = ?"
+        sql += " ORDER BY site_id, start_time"
+        self._execute(sql, site_id)
+        runs = []
+        for this_site, start, duration in self._cursor.fetchall():
+            if runs and runs[-1][0] == this_site and runs[-1][2] == start:
+                runs[-1][2] = start + duration
+            else:
+                runs.append([this_site, start, start + duration])
+        self._execute(delete_sql, site_id)
+        insert_sql = "INSERT INTO %s VALUES (?, ?, ?)"
+        insert_sql = insert_sql % _check(self.coverage_table)
+        if runs:
+            self._execute(insert_sql, [tuple(r) for r in runs], many=True)
+
+    @_reads
+    def get_high_water_mark(self, site_id):
+        """ Get the time that site_id has been synced up to, or None if it
+        never has been
+        """
+        sql = "SELECT high_water FROM %s WHERE site_id = ?"
+        sql = sql % _check(self.sync_table)
+        self._execute(sql, site_id)
+        result = self._cursor.fetchone()
+        if result is None:
+            return None
+        return int_to_datetime(result[0])
+
+    @_writes
+    def set_high_water_mark(self, site_id, high_water):
+        sql = "INSERT OR REPLACE INTO %s VALUES (?, ?)"
+        sql = sql % _check(self.sync_table)
+        return self._execute(sql, [site_id, datetime_to_int(high_water)])
+
+    @staticmethod
+    def _filter_conditions(date_filter):
+        """ Turn a DateFilter into a list of sql conditions on the calendar
+        columns. The numbers are all checked ints, and there can be too many
+        of them for sql variables, so they go straight into the sql.
+        """
+        conditions = []
+        month_days = date_filter.month_days()
+        if month_days is not None:
+            # This is the expression in the power_site_monthday index
+            conditions.append("local_date % 10000 IN (" +
+                              ", ".join("%d" % m for m in sorted(month_days))
+                              + ")")
+        if date_filter.dates is not None:
+            numbers = sorted(date_to_number(d) for d in date_filter.dates)
+            conditions.append("local_date IN (" +
+                              ", ".join("%d" % n for n in numbers) + ")")
+        if date_filter.weekdays is not None:
+            conditions.append("local_weekday IN (" +
+                              ", ".join("%d" % w for w in
+                                        sorted(date_filter.weekdays)) + ")")
+        minute_ranges = date_filter.minute_ranges()
+        if minute_ranges is not None:
+            ranges = ["(local_minute >= %d AND local_minute < %d)" % r
+                      for r in minute_ranges]
+            conditions.append("(" + " OR ".join(ranges) + ")")
+        return conditions
+
+    def _power_query(self, site_id=None, start=None, end=None,
+                     date_filter=None):
+        """ Build the sql (and the variables to go with it) that selects the
+        power between start and end, in start_time order. site_id can also
+        be a list of site ids, and date_filter a DateFilter.
+        """
+        conditions = []
+        variables = []
+        if isinstance(site_id, (list, tuple, set, frozenset)):
+            site_ids = sorted(site_id)
+            placeholders = ", ".join(["?"] * len(site_ids))
+            conditions.append("site_id IN (%s)" % placeholders)
+            variables.extend(site_ids)
+        elif site_id is not None:
+            conditions.append("site_id = ?")
+            variables.append(site_id)
+        if start is not None:
+            conditions.append("start_time >= ?")
+            variables.append(datetime_to_int(start))
+        if end is not None:
+            conditions.append("start_time <= ?")
+            variables.append(datetime_to_int(end))
+        index = None
+        if date_filter is not None:
+            conditions.extend(self._filter_conditions(date_filter))
+            month_days = date_filter.month_days()
+            # Without statistics, sqlite would rather use the primary key so
+            # it doesn't have to sort, even if only a few days are wanted
+            if site_id is not None and month_days is not None and \
+                    len(month_days) <= MONTHDAYINDEXLIMIT:
+                index = "%s_site_monthday" % _check(self.power_table)
+        sql = "SELECT %s FROM %s" % (", ".join(self._get_power_columns()),
+                                     _check(self.power_table))
+        if index is not None:
+            sql += " INDEXED BY %s" % index
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY start_time, site_id"
+        return sql, variables
+
+    def _iter_power_rows(self, site_id=None, start=None, end=None,
+                         chunk_size=FETCHBATCHSIZE, date_filter=None):
+        """ Yield lists of up to chunk_size raw rows from the power table """
+        sql, variables = self._power_query(site_id=site_id, start=start,
+                                           end=end, date_filter=date_filter)
+        self.debug("Executing: %s", sql)
+        self.metrics.increment("local.sql_statements")
+        # Use our own cursor, so that other queries made while this is
+        # being consumed don't interfere with it. Unless this thread is in
+        # the middle of something (so should see what it's written), that's
+        # on a reader of our own, since whatever the thread does between
+        # chunks can't share it
+        outer = getattr(self._state, "cursor", None)
+        if outer is not None:
+            for raw_tuples in self._fetch_chunks(outer.connection, sql,
+                                                 variables, chunk_size):
+                yield raw_tuples
+            return
+        with self._pool.reader() as connection:
+            for raw_tuples in self._fetch_chunks(connection, sql, variables,
+                                                 chunk_size):
+                yield raw_tuples
+
+    def _fetch_chunks(self, connection, sql, variables, chunk_size):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql, variables)
+            while True:
+                raw_tuples = cursor.fetchmany(chunk_size)
+                if not raw_tuples:
+                    break
+                self.metrics.increment("local.rows_read", len(raw_tuples))
+                yield raw_tuples
+        finally:
+            cursor.close()
+
+    def iter_power(self, site_id=None, start=None, end=None,
+                   chunk_size=FETCHBATCHSIZE, as_series=False,
+                   date_filter=None):
+        """ Stream the power periods between start and end, in start_time
+        order, without holding more than chunk_size rows in memory. If
+        as_series is True, yield a PowerSeries per chunk instead of
+        individual PowerPeriods. If date_filter (a DateFilter) is given,
+        only the power that matches it is read.
+        """
+        columns = self._get_power_columns()
+        # There are only ever a few different durations, so share the
+        # timedelta objects between PowerPeriods
+        durations = {}
+        for raw_tuples in self._iter_power_rows(site_id=site_id, start=start,
+                                                end=end,
+                                                chunk_size=chunk_size,
+                                                date_filter=date_filter):
+            if as_series:
+                yield PowerSeries.from_rows(raw_tuples)
+                continue
+            for each_tuple in raw_tuples:
+                # PowerPeriod takes the start time as a unix timestamp, and
+                # only makes the datetime if it's needed
+                tmp_dict = dict(zip(columns, each_tuple))
+                seconds = tmp_dict["duration"]
+                if seconds not in durations:
+                    durations[seconds] = int_to_timedelta(seconds)
+                tmp_dict["duration"] = durations[seconds]
+                yield PowerPeriod(**tmp_dict)
+
+    @timed("local.get_power")
+    def get_power(self, site_id=None, start=None, end=None, as_series=False,
+                  date_filter=None):
+        if as_series:
+            return PowerSeries.concatenate(
+                self.iter_power(site_id=site_id, start=start, end=end,
+                                as_series=True, date_filter=date_filter))
+        return set(self.iter_power(site_id=site_id, start=start, end=end,
+                                   date_filter=date_filter))
+
+    @timed("local.get_power_many")
+    def get_power_many(self, site_ids=None, start=None, end=None,
+                       as_series=False, date_filter=None):
+        """ Get the power for several sites (or all of them, if site_ids is
+        None) with one query. Returns {site_id: power}
+        """
+        if site_ids is None:
+            site_ids = self.get_site_ids()
+        site_ids = list(site_ids)
+        if as_series:
+            series = self.get_power(site_id=site_ids, start=start, end=end,
+                                    as_series=True, date_filter=date_filter)
+            return dict((s, series[series.site_id == s]) for s in site_ids)
+        results = dict((s, set()) for s in site_ids)
+        for power_period in self.iter_power(site_id=site_ids, start=start,
+                                            end=end,
+                                            date_filter=date_filter):
+            results[power_period.site_id].add(power_period)
+        return results
+
+    @staticmethod
+    def _get_bucket(period_length, origin):
+        """ Get the sql that puts each power period into a batch for
+        get_aggregate(), and the name of the rollup table that has those
+        batches already worked out (or None, if there isn't one)
+        """
+        if period_length == DatePreset.MONTH:
+            return _ROLLUP_BUCKETS["monthly"], "monthly"
+        if period_length == DatePreset.YEAR:
+            return _YEAR_BUCKET, None
+        if period_length == DatePreset.DAY:
+            period_length = timedelta(days=1)
+        elif period_length == DatePreset.WEEK:
+            period_length = timedelta(weeks=1)
+        period_seconds = int(period_length.total_seconds())
+        bucket = "(start_time - %d) / %d" % (origin, period_seconds)
+        rollup = None
+        if origin % period_seconds == 0:
+            rollup = {3600: "hourly", 86400: "daily"}.get(period_seconds)
+        return bucket, rollup
+
+    def _aggregate_query(self, bucket, combiners, site_id=None, start=None,
+                         end=None, date_filter=None):
+        """ Build the sql (and the variables to go with it) that groups the
+        power into batches using the bucket sql, and calculates the
+        statistics needed for combiners over each batch
+        """
+        inner_sql, variables = self._power_query(site_id=site_id,
+                                                 start=start, end=end,
+                                                 date_filter=date_filter)
+        if Combiners.SPECIFIC in combiners:
+            # Number each block within its batch, so we can pick one out
+            sql = "SELECT *, ROW_NUMBER() OVER (PARTITION BY site_id, %s "
+            sql += "ORDER BY start_time) - 1 AS block FROM (%s)"
+            inner_sql = sql % (bucket, inner_sql)
+        columns = ["site_id", "MIN(start_time)",
+                   "MAX(start_time + duration) - MIN(start_time)",
+                   "COUNT(*)"]
+        for eachtype in sorted(POWER_TYPES):
+            eachtype = _check(eachtype)
+            if Combiners.SUM in combiners or Combiners.MEAN in combiners:
+                columns.append("SUM(%s * duration)" % eachtype)
+            if Combiners.MIN in combiners:
+                columns.append("MIN(%s)" % eachtype)
+            if Combiners.MAX in combiners:
+                columns.append("MAX(%s)" % eachtype)
+            if Combiners.SPECIFIC in combiners:
+                columns.append("MAX(CASE WHEN block = ? THEN %s END)" %
+                               eachtype)
+        sql = "SELECT %s FROM (%s) GROUP BY site_id, %s"
+        sql = sql % (", ".join(columns), inner_sql, bucket)
+        sql += " ORDER BY MIN(start_time), site_id"
+        return sql, variables
+
+    def _rollup_query(self, rollup, combiners, site_id=None, start=None,
+                      end=None):
+        """ The equivalent of _aggregate_query(), reading from a rollup
+        table. end is exclusive.
+        """
+        columns = ["site_id", "first_start", "end_time - first_start",
+                   "count"]
+        for eachtype in sorted(POWER_TYPES):
+            eachtype = _check(eachtype)
+            if Combiners.SUM in combiners or Combiners.MEAN in combiners:
+                columns.append("sum_%s" % eachtype)
+            if Combiners.MIN in combiners:
+                columns.append("min_%s" % eachtype)
+            if Combiners.MAX in combiners:
+                columns.append("max_%s" % eachtype)
+        conditions = []
+        variables = []
+        if site_id is not None:
+            conditions.append("site_id = ?")
+            variables.append(site_id)
+        if start is not None:
+            conditions.append("start_time >= ?")
+            variables.append(datetime_to_int(start))
+        if end is not None:
+            conditions.append("start_time < ?")
+            variables.append(datetime_to_int(end))
+        sql = "SELECT %s FROM %s" % (", ".join(columns),
+                                     self._get_rollup_table(rollup))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY first_start, site_id"
+        return sql, variables
+
+    @_reads
+    def _fetch_table(self, sql, variables, width):
+        self._execute(sql, variables)
+        raw_tuples = self._cursor.fetchall()
+        self.metrics.increment("local.rows_read", len(raw_tuples))
+        if not raw_tuples:
+            return numpy.zeros((0, width))
+        return numpy.array(raw_tuples, dtype=numpy.float64)
+
+    @timed("local.get_aggregate")
+    @_reads
+    def get_aggregate(self, site_id=None, start=None, end=None,
+                      period_length=None, combination=Combiners.SUM,
+                      specific=0, as_series=False, use_rollups=True,
+                      date_filter=None):
+        """ The equivalent of edgydata.aggregate.aggregate(), but done inside
+        the database, so only the aggregated rows are read. Batches are
+        measured from start (or the unix epoch, if start is None, so daily
+        batches run from midnight UTC). As well as a timedelta,
+        period_length can be a DatePreset, for calendar months or years.
+
+        Hourly, daily and monthly batches that line up with the rollup
+        tables are read straight from them (unless use_rollups is False, or
+        there's a date_filter, which only the power that matches it goes
+        into).
+
+        Returns a list of PowerPeriods (or a PowerSeries, if as_series is
+        True), or a dictionary of them if combination is a list.
+        """
+        if isinstance(combination, Combiners):
+            combiners = [combination]
         else:
-            start = datetime_to_int(start)
-        if end is None:
-            end = sys.maxint
+            combiners = list(combination)
+        origin = 0 if start is None else datetime_to_int(start)
+        bucket, rollup = self._get_bucket(period_length, origin)
+        per_type = len(set(combiners) - set([Combiners.MEAN]))
+        if Combiners.MEAN in combiners and Combiners.SUM not in combiners:
+            per_type += 1
+        width = 4 + per_type * len(POWER_TYPES)
+        if rollup is not None and use_rollups and date_filter is None and \
+                Combiners.SPECIFIC not in combiners and \
+                (start is None or _is_rollup_start(rollup, origin)) and \
+                (end is None or _is_rollup_start(rollup,
+                                                 datetime_to_int(end))):
+            sql, variables = self._rollup_query(rollup, combiners,
+                                                site_id=site_id, start=start,
+                                                end=end)
+            table = self._fetch_table(sql, variables, width)
+            if end is not None:
+                # end is inclusive, so there may be power starting right at
+                # the end, which is a batch of its own
+                sql, variables = self._aggregate_query(bucket, combiners,
+                                                       site_id=site_id,
+                                                       start=end, end=end)
+                tail = self._fetch_table(sql, variables, width)
+                table = numpy.concatenate((table, tail))
         else:
-            end = datetime_to_int(end)
-        sql = "SELECT * FROM %s WHERE start_time >= %s AND start_time <= %s"
-        sql = sql % (_check(self.power_table), start, end)
-        self._execute(sql)
-        raw_tuples = self._cursor.fetchall()
-        return_set = set()
-        columns = self._get_power_columns()
-        for each_tuple in raw_tuples:
-            tmp_dict = dict(zip(columns, each_tuple))
-            tmp_dict["start_time"] = int_to_datetime(tmp_dict["start_time"])
-            tmp_dict["duration"] = int_to_timedelta(tmp_dict["duration"])
-            return_set.add(PowerPeriod(**tmp_dict))
-        return return_set
+            sql, variables = self._aggregate_query(bucket, combiners,
+                                                   site_id=site_id,
+                                                   start=start, end=end,
+                                                   date_filter=date_filter)
+            if Combiners.SPECIFIC in combiners:
+                variables = [specific] * len(POWER_TYPES) + variables
+            table = self._fetch_table(sql, variables, width)
+        counts = table[:, 3].astype(numpy.int64)
+        if Combiners.SPECIFIC in combiners and len(table):
+            if numpy.any(counts <= specific):
+                msg = "Block %s requested, but some batches only have %s "
+                msg += "blocks"
+                raise ValueError(msg % (specific, counts.min()))
+        stats = {"weighted": {}, "minimums": {}, "maximums": {},
+                 "specifics": {}}
+        index = 4
+        for eachtype in sorted(POWER_TYPES):
+            if Combiners.SUM in combiners or Combiners.MEAN in combiners:
+                stats["weighted"][eachtype] = table[:, index]
+                index += 1
+            for combiner, name in ((Combiners.MIN, "minimums"),
+                                   (Combiners.MAX, "maximums"),
+                                   (Combiners.SPECIFIC, "specifics")):
+                if combiner in combiners:
+                    stats[name][eachtype] = table[:, index]
+                    index += 1
+        results = combine_batches(table[:, 0], table[:, 1], table[:, 2],
+                                  counts, combiners, **stats)
+        if not as_series:
+            results = dict((c, r.to_periods()) for c, r in results.items())
+        if isinstance(combination, Combiners):
+            return results[combination]
+        return results
 
+    @_reads
     def _get_min_time(self, site_id=None):
         sql = "SELECT MIN(start_time) FROM %s" % _check(self.power_table)
         if site_id is not None:
@@ -253,6 +1118,7 @@ class Local(AbstractBE):
             return None
         return int_to_datetime(as_int)
 
+    @_reads
     def _get_max_time(self, site_id=None):
         sql = "SELECT MAX(start_time), duration FROM %s"
         if site_id is not None:
@@ -265,6 +1131,7 @@ class Local(AbstractBE):
             return None
         return int_to_datetime(start_time + duration)
 
+    @_reads
     def get_time_limits(self, site_id=None):
         return (self._get_min_time(site_id=site_id),
                 self._get_max_time(site_id=site_id))
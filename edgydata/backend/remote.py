@@ -1,17 +1,38 @@
+import json
 import os
-from copy import deepcopy
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
+import numpy
 import requests
+from requests.adapters import HTTPAdapter
 
-from edgydata.data import Site, PowerPeriod
-from edgydata.constants import POWER
+from edgydata.data import Site, PowerPeriod, PowerSeries
+from edgydata.constants import POWER, POWER_TYPES, RecordMode
 from edgydata.backend.abstract import Abstract as AbstractBE
+from edgydata.cache import SiteCache
+from edgydata.metrics import timed
 from edgydata.time import (date_to_datetime, string_to_date,
-                           string_to_datetime, datetime_to_string,
-                           get_current_datetime)
+                           strings_to_ints, datetime_to_string,
+                           timedelta_to_int, get_current_datetime)
 
 BASE_URL = "https://monitoringapi.solaredge.com"
+# The longest time period that SolarEdge will give power details for in one
+# call
+MAXWINDOWDAYS = 28
+# How many calls to make to SolarEdge at once, by default
+MAXCONCURRENCY = 4
+# How long to wait for SolarEdge to respond (in seconds), by default
+TIMEOUT = 30
+# How many times to retry a call that failed in a way that might not happen
+# next time, and the base delay (in seconds) before the first retry. Each
+# retry waits twice as long as the last one.
+RETRIES = 3
+BACKOFF = 1.0
+RETRYSTATUSES = set([429, 500, 502, 503, 504])
 # SolarEdge returns its values in a strange way. These next globals help us
 # decode those
 # Number of minutes in the listed time units
@@ -26,10 +47,118 @@ class ResponseError(IOError):
     """ The response from SolarEdge was not in the form we expected """
 
 
+def parse_power_details(raw, site_id, as_series=False):
+    """ Decode the "powerDetails" part of a response from SolarEdge's
+    powerDetails.json into a list of PowerPeriods (or a PowerSeries, if
+    as_series is True), in time order. This makes a single pass over the
+    values of each meter.
+    """
+    power_types = sorted(POWER_TYPES)
+    duration = timedelta(hours=TIMEUNITS[raw["timeUnit"]])
+    units = POWERUNITS[raw["unit"]]
+    # {date string: [value for each of power_types]}
+    datedata = {}
+    found = set()
+    for meter in raw["meters"]:
+        if meter["type"] not in LOOKUP:
+            continue
+        found.add(meter["type"])
+        column = power_types.index(LOOKUP[meter["type"]].name)
+        for datum in meter["values"]:
+            row = datedata.get(datum["date"])
+            if row is None:
+                # For some reason, SolarEdge don't give a value when it's
+                # zero, so that's the default
+                row = [0] * len(power_types)
+                datedata[datum["date"]] = row
+            if "value" in datum:
+                # Convert value into Watts, in case it's not already
+                row[column] = datum["value"] * units
+    missing = set(LOOKUP) - found
+    if missing:
+        msg = "No data for meters %s" % ", ".join(sorted(missing))
+        raise ResponseError(msg)
+    # This date format sorts into time order
+    dates = sorted(datedata)
+    start_times = strings_to_ints(dates)
+    if as_series:
+        kwargs = {"site_id": numpy.full(len(dates), site_id),
+                  "start_time": start_times,
+                  "duration": numpy.full(len(dates),
+                                         timedelta_to_int(duration))}
+        for column, eachtype in enumerate(power_types):
+            kwargs[eachtype] = [datedata[d][column] for d in dates]
+        return PowerSeries(**kwargs)
+    return_data = []
+    # PowerPeriods are happy with unix timestamps, and only make the
+    # datetime if it's needed
+    for date, start_time in zip(dates, start_times.tolist()):
+        kwargs = dict(zip(power_types, datedata[date]))
+        return_data.append(PowerPeriod(site_id, start_time, duration,
+                                       **kwargs))
+    return return_data
+
+
+def parse_site_details(raw, site_id):
+    """ Decode the "details" part of a response from SolarEdge's
+    details.json into a Site
+    """
+    kwargs = {"site_id": site_id,
+              "name": raw["name"],
+              "start_date": string_to_date(raw["installationDate"]),
+              "end_date": string_to_date(raw["lastUpdateTime"]),
+              "country": raw["location"]["country"],
+              "timezone": raw["location"]["timeZone"],
+              "peak_power": raw["peakPower"]}
+    return Site(**kwargs)
+
+
+def merge_windows(results):
+    """ Join up the lists of PowerPeriods fetched for consecutive windows.
+    Neighbouring windows share their boundary, so make sure we only keep one
+    period for each time.
+    """
+    return_data = []
+    seen = set()
+    for window_data in results:
+        for power_period in sorted(window_data, key=PowerPeriod.sort_key):
+            if power_period.start_timestamp in seen:
+                continue
+            seen.add(power_period.start_timestamp)
+            return_data.append(power_period)
+    return return_data
+
+
 class Remote(AbstractBE):
     """ The backend object that talks to the SolarEdge API directly """
-    def __init__(self, api_key=None, debug=False):
-        AbstractBE.__init__(self, debug=debug)
+    def __init__(self, api_key=None, debug=False, base_url=BASE_URL,
+                 max_concurrency=MAXCONCURRENCY, timeout=TIMEOUT,
+                 retries=RETRIES, backoff=BACKOFF, site_cache=None,
+                 recording=None, metrics=None):
+        AbstractBE.__init__(self, debug=debug, metrics=metrics)
+        # Site details can be shared with other backends
+        if site_cache is None:
+            site_cache = SiteCache(metrics=self.metrics)
+        self._site_cache = site_cache
+        # base_url can be changed to point at a stand-in server for testing
+        # (see edgydata.standin), and a Recording can save or play back the
+        # calls (see edgydata.recording)
+        self._base_url = base_url
+        self._recording = recording
+        self._max_concurrency = max_concurrency
+        # However many threads are making calls (fetching windows, sites, or
+        # both), only this many calls are made at once
+        self._call_slots = threading.BoundedSemaphore(max(max_concurrency, 1))
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        # Keep the connections open between calls, with enough of them for
+        # all our concurrent calls
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=max(max_concurrency, 1))
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
         if api_key is None:
             try:
                 self._api_key = os.environ["SOLAREDGEAPI"]
@@ -38,134 +167,272 @@ class Remote(AbstractBE):
         else:
             self._api_key = api_key
 
+    def _retry_delay(self, attempt, retry_after=None):
+        """ How long to wait before retrying: exponential backoff, with some
+        jitter so that concurrent calls don't all retry at once. If
+        SolarEdge told us how long to wait (retry_after, the Retry-After
+        header), do that instead.
+        """
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return self._backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    # The parts of making a call that don't depend on how the http request
+    # is made, which are shared with edgydata.backend.aio.AsyncRemote
+    def _make_call(self, sub_url, data=None):
+        """ The url and parameters for a call """
+        url = "%s/%s" % (self._base_url, sub_url)
+        params = {"api_key": self._api_key}
+        if data is not None:
+            params.update(data)
+        return url, params
+
+    def _is_replaying(self):
+        return self._recording is not None and \
+            self._recording.mode == RecordMode.REPLAY
+
+    def _replay(self, sub_url, data=None):
+        _, params = self._make_call(sub_url, data)
+        result = self._recording.load(sub_url, params)
+        self.metrics.increment("remote.replayed_calls")
+        if result is None:
+            raise ResponseError("No recorded response for %s %s" %
+                                (sub_url, data))
+        return result
+
+    def _call_failed(self, sub_url, attempt, took, err):
+        """ Note that a call didn't get a response, raising a ResponseError
+        if it isn't going to be retried
+        """
+        self.metrics.observe("remote.call", took)
+        self.metrics.increment("remote.errors")
+        if attempt >= self._retries:
+            raise ResponseError("API call failed: %s" % err)
+
+    def _check_response(self, sub_url, attempt, took, status, reason,
+                        content):
+        """ Note the response to a call. Returns True if it succeeded, or
+        False if it should be retried; raises a ResponseError if it failed
+        for good.
+        """
+        self.metrics.increment("remote.calls")
+        self.metrics.increment("remote.bytes", len(content))
+        self.metrics.observe("remote.call", took)
+        if status < 400:
+            return True
+        if status not in RETRYSTATUSES or attempt >= self._retries:
+            self.metrics.increment("remote.errors")
+            self.warning("%s", content)
+            raise ResponseError("API call failed: %s" % reason)
+        return False
+
+    def _decode(self, sub_url, params, content):
+        """ Decode a successful response, saving it if we're recording """
+        result = json.loads(content.decode("utf-8"))
+        if self._recording is not None:
+            self._recording.save(sub_url, params, result)
+        return result
+
+    def _prepare_retry(self, sub_url, attempt, reason, retry_after=None):
+        """ Returns how long to wait before retrying a call """
+        delay = self._retry_delay(attempt, retry_after)
+        self.metrics.increment("remote.retries")
+        self.warning("Call to %s failed (%s), retrying in %.1fs", sub_url,
+                     reason, delay)
+        return delay
+
     def _remote_call(self, sub_url, data=None):
-        if data is None:
-            data = {}
-        url = "%s/%s" % (BASE_URL, sub_url)
-        data_with_api = deepcopy(data)
-        data_with_api.update({"api_key": self._api_key})
-        response = requests.get(url, params=data_with_api)
-        if not response.ok:
-            self.warning(response.content)
-            raise ResponseError("API call failed: %s" % response.reason)
-        return response.json()
+        if self._is_replaying():
+            return self._replay(sub_url, data)
+        url, params = self._make_call(sub_url, data)
+        attempt = 0
+        while True:
+            call_start = time.time()
+            retry_after = None
+            try:
+                with self._call_slots:
+                    response = self._session.get(url, params=params,
+                                                 timeout=self._timeout)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                self._call_failed(sub_url, attempt, time.time() - call_start,
+                                  err)
+                reason = err
+            else:
+                if self._check_response(sub_url, attempt,
+                                        time.time() - call_start,
+                                        response.status_code,
+                                        response.reason, response.content):
+                    return self._decode(sub_url, params, response.content)
+                reason = response.reason
+                retry_after = response.headers.get("Retry-After")
+            time.sleep(self._prepare_retry(sub_url, attempt, reason,
+                                           retry_after))
+            attempt += 1
 
-    def _get_site_id(self):
-        """ A convenience method to select the only site id if there is only
-        one. If there are more than one, raises an exception.
+    def get_latency_stats(self):
+        """ Summarise the time taken by the calls (whether they got a
+        response or not) recorded in our metrics
+        """
+        latency = self.metrics.get_latency("remote.call")
+        if not latency["count"]:
+            return {"calls": 0}
+        return {"calls": latency["count"], "mean": latency["mean"],
+                "max": latency["max"], "total": latency["sum"]}
+
+    @staticmethod
+    def _only_site_id(ids):
+        """ The only one of a list of site ids. If there are more than one,
+        raises an exception.
         """
-        ids = self.get_site_ids()
         if len(ids) == 1:
             return ids[0]
         msg = "More than one site found: please use get_sites() and choose"
         raise ValueError(msg)
 
+    def _get_site_id(self):
+        """ A convenience method to select the only site id if there is only
+        one. If there are more than one, raises an exception.
+        """
+        return self._only_site_id(self.get_site_ids())
+
+    @staticmethod
+    def _parse_site_ids(data):
+        # Return this as a list, in the same order as the API gives them
+        return [a["id"] for a in data["sites"]["site"]]
+
     def get_site_ids(self):
         """ Get all the site ids of all the sites connected with this SolarEdge
         account
         """
-        data = self._remote_call("sites/list")
-        ids = [a["id"] for a in data["sites"]["site"]]
-        # Return this as a list, in the same order as the API gives them
-        return ids
+        return self._parse_site_ids(self._remote_call("sites/list"))
 
     def get_site(self, site_id=None):
         """ Return a Site object from a given site id, by querying the details
-        from the SolarEdge API
+        from the SolarEdge API (unless they are already cached)
         """
         if site_id is None:
             site_id = self._get_site_id()
-        sub_url = "site/%s/details.json" % site_id
-        result = self._remote_call(sub_url)
-        raw = result["details"]
-        raw_start = raw["installationDate"]
-        raw_end = raw["lastUpdateTime"]
-        kwargs = {"site_id": site_id,
-                  "name": raw["name"],
-                  "start_date": string_to_date(raw_start),
-                  "end_date": string_to_date(raw_end),
-                  "country": raw["location"]["country"],
-                  "timezone": raw["location"]["timeZone"],
-                  "peak_power": raw["peakPower"]}
-        return Site(**kwargs)
+        return self._site_cache.get(site_id, self._fetch_site)
+
+    def _fetch_site(self, site_id):
+        result = self._remote_call(self._site_call(site_id))
+        return parse_site_details(result["details"], site_id)
+
+    @staticmethod
+    def _site_call(site_id):
+        return "site/%s/details.json" % site_id
 
     def get_time_limits(self, site_id=None):
         site = self.get_site(site_id=site_id)
         return (site.start_date, site.end_date)
 
-    def get_power(self, site_id=None, start=None, end=None):
-        # This is just a wrapper around the private _get_usage that
-        # sanitizes the parameters
-        if site_id is None:
-            site_id = self._get_site_id()
-        site = self.get_site(site_id)
+    @staticmethod
+    def _needs_site(start, end, date_filter):
+        """ Whether get_power() needs to know about the site """
+        return start is None or end is None or date_filter is not None
+
+    def _plan_power(self, site, start, end):
+        """ Fill in start and end (from site, if they're None), and split the
+        time between them into windows to fetch
+        """
         if start is None:
             start = date_to_datetime(site.start_date)
         if end is None:
             # Don't get an extra day: it will just give you empty data
             end = date_to_datetime(site.end_date)
-        return self._get_usage(site_id, start, end)
-
-    def _get_usage(self, site_id, start, end):
-        now = get_current_datetime()
-        if end > now:
-            end = now
-        return_data = []
-        numdays = (end - start).days
-        if numdays > 28:
-            self.info("%s days is too many, splitting" % numdays)
-            middle = end - timedelta(days=27)
-            return_data = self._get_usage(site_id, start, middle)
-        else:
-            middle = start
-        data = {"startTime": datetime_to_string(middle),
+        end = min(end, get_current_datetime())
+        windows = self._plan_windows(start, end)
+        if len(windows) > 1:
+            numdays = (end - start).days
+            self.info("%s days is too many, splitting into %s", numdays,
+                      len(windows))
+        return windows
+
+    @staticmethod
+    def _finish_power(results, site=None, as_series=False, date_filter=None):
+        """ Turn the power fetched for each window into what get_power()
+        returns
+        """
+        usage = merge_windows(results)
+        if date_filter is not None:
+            # SolarEdge can't do this for us
+            usage = date_filter.apply(usage, timezone=site.timezone)
+        if as_series:
+            return PowerSeries.from_periods(usage)
+        return usage
+
+    @timed("remote.get_power")
+    def get_power(self, site_id=None, start=None, end=None, as_series=False,
+                  date_filter=None):
+        if site_id is None:
+            site_id = self._get_site_id()
+        site = None
+        if self._needs_site(start, end, date_filter):
+            site = self.get_site(site_id)
+        windows = self._plan_power(site, start, end)
+        return self._finish_power(self._fetch_windows(site_id, windows),
+                                  site=site, as_series=as_series,
+                                  date_filter=date_filter)
+
+    @timed("remote.get_power_many")
+    def get_power_many(self, site_ids=None, start=None, end=None,
+                       as_series=False, date_filter=None):
+        """ Get the power for several sites (or all of them, if site_ids is
+        None), fetching them concurrently. Returns {site_id: power}
+        """
+        if site_ids is None:
+            site_ids = self.get_site_ids()
+        site_ids = list(site_ids)
+
+        def fetch(site_id):
+            return self.get_power(site_id=site_id, start=start, end=end,
+                                  as_series=as_series,
+                                  date_filter=date_filter)
+
+        workers = max(min(self._max_concurrency, len(site_ids)), 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(site_ids, executor.map(fetch, site_ids)))
+
+    @classmethod
+    def _plan_windows(cls, start, end):
+        """ Split the time from start to end into a list of consecutive
+        (start, end) windows, each short enough to be retrieved in one call
+        """
+        windows = []
+        window_start = start
+        while True:
+            window_end = window_start + timedelta(days=MAXWINDOWDAYS)
+            if window_end >= end:
+                windows.append((window_start, end))
+                return windows
+            windows.append((window_start, window_end))
+            window_start = window_end
+
+    def _fetch_windows(self, site_id, windows):
+        """ Fetch the power for each window, a few at a time. Returns a list
+        of the PowerPeriods in each.
+        """
+        def fetch(window):
+            return self._fetch_window(site_id, *window)
+
+        if len(windows) == 1 or self._max_concurrency < 2:
+            return [fetch(w) for w in windows]
+        workers = min(self._max_concurrency, len(windows))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map gives the results back in the order of the windows
+            return list(executor.map(fetch, windows))
+
+    def _window_call(self, site_id, start, end):
+        """ The sub url and data of the call for one window, which must be
+        short enough to get in one call
+        """
+        self.info("Retrieving data for %s - %s", start, end)
+        data = {"startTime": datetime_to_string(start),
                 "endTime": datetime_to_string(end)}
-        sub_url = "site/%s/powerDetails.json" % site_id
-        self.info("Retrieving data for %s - %s" % (middle, end))
-        raw = self._remote_call(sub_url, data)["powerDetails"]
-        meters = [m["type"] for m in raw["meters"]]
-        # This next sorry section is just to get a list of all times in
-        # the data. I could probably just get them from one of the
-        # meters, but I've always been one for obsessive over-caution.
-        alldump = []
-        for dump in [m["values"] for m in raw["meters"]]:
-            alldump.extend(dump)
-        dates = set([d["date"] for d in alldump])
-
-        duration = TIMEUNITS[raw["timeUnit"]]
-        units = POWERUNITS[raw["unit"]]
-
-        datedata = {}
-        for eachdate in dates:
-            datedata[eachdate] = {}
-            for eachm in meters:
-                meterdata = [r for r in raw["meters"] if r["type"] == eachm][0]
-                datum = [m for m in meterdata["values"] if
-                         m["date"] == eachdate][0]
-                if "value" in datum:
-                    # Convert value into Watts, in case it's not already
-                    datum = datum["value"] * units
-                else:
-                    # For some reason, SolarEdge don't give a value when
-                    # it's zero
-                    datum = 0
-                datedata[eachdate][eachm] = datum
-        for date, data in datedata.items():
-            kwargs = {"site_id": site_id}
-            kwargs["start_time"] = string_to_datetime(date)
-            kwargs["duration"] = timedelta(hours=duration)
-            for start_, end_ in LOOKUP.items():
-                try:
-                    kwargs[end_.name] = data[start_]
-                except Exception:
-                    self.debug(date)
-                    self.debug(data)
-                    self.debug(start_)
-                    self.debug(end_)
-                    raise
-            try:
-                return_data.append(PowerPeriod(**kwargs))
-            except Exception:
-                self.debug(kwargs)
-                raise
-        return return_data
+        return "site/%s/powerDetails.json" % site_id, data
+
+    @timed("remote.fetch_window")
+    def _fetch_window(self, site_id, start, end):
+        """ Retrieve the power for one window """
+        raw = self._remote_call(*self._window_call(site_id, start, end))
+        return parse_power_details(raw["powerDetails"], site_id)
@@ -0,0 +1,91 @@
+""" Caches of data that is slow (or expensive) to get hold of """
+import threading
+import time
+
+from edgydata.metrics import METRICS
+
+# How long (in seconds) site details are trusted for, by default
+SITETTL = 60 * 60
+
+
+class SiteCache(object):
+    """ A cache of Site objects, so that we don't have to keep asking the
+    SolarEdge API for details that rarely change (and count against the daily
+    request limit). Sites are kept in memory and, if a Local backend is
+    given, in its database too, so they survive between runs. Either way,
+    they are only trusted for ttl seconds.
+
+    One of these can be shared between backends. Hits and misses are also
+    counted in metrics (METRICS, unless another registry is given).
+    """
+    def __init__(self, ttl=SITETTL, local=None, metrics=None):
+        self._ttl = ttl
+        self._local = local
+        self._metrics = METRICS if metrics is None else metrics
+        # {site_id: (time fetched, Site)}
+        self._sites = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _is_fresh(self, fetched_time):
+        return time.time() - fetched_time < self._ttl
+
+    def get(self, site_id, fetch):
+        """ Get the Site for site_id, calling fetch(site_id) to get it if we
+        don't have an up to date copy
+        """
+        site = self.lookup(site_id)
+        if site is None:
+            site = fetch(site_id)
+            self.add(site)
+        return site
+
+    def lookup(self, site_id):
+        """ Get the Site for site_id if we have an up to date copy, or None
+        if it needs fetching (and adding)
+        """
+        with self._lock:
+            if site_id in self._sites:
+                fetched_time, site = self._sites[site_id]
+                if self._is_fresh(fetched_time):
+                    self.hits += 1
+                    self._metrics.increment("cache.site.hits")
+                    return site
+            if self._local is not None:
+                fetched_time = self._local.get_site_fetched_time(site_id)
+                if fetched_time is not None and self._is_fresh(fetched_time):
+                    site = self._local.get_site(site_id)
+                    self._sites[site_id] = (fetched_time, site)
+                    self.hits += 1
+                    self._metrics.increment("cache.site.hits")
+                    return site
+            self.misses += 1
+            self._metrics.increment("cache.site.misses")
+        return None
+
+    def add(self, site, fetched_time=None):
+        """ Put a freshly fetched Site into the cache """
+        if fetched_time is None:
+            fetched_time = time.time()
+        with self._lock:
+            self._sites[site.site_id] = (fetched_time, site)
+            if self._local is not None:
+                self._local.add_site(site, fetched_time=fetched_time)
+
+    def invalidate(self, site_id=None):
+        """ Forget about site_id (or all sites, if it's None), so it is
+        fetched again next time it's asked for
+        """
+        with self._lock:
+            if site_id is None:
+                self._sites.clear()
+            else:
+                self._sites.pop(site_id, None)
+            if self._local is not None:
+                self._local.clear_site_fetched_time(site_id=site_id)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._sites)}
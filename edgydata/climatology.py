@@ -0,0 +1,307 @@
+"""
+Statistics for each day of the year, over all the years of data:
+    (e.g. maximum output for 15 December over all years, or
+     the day of the year that gives the highest average generation)
+and for each time of day within those days:
+    (e.g. average consumption at 18:00 on 15 December)
+
+Days are those of the site's local timezone. They are matched up by month
+and day, so 29 February is a day of its own (with fewer years of data), and
+every other date lines up across leap and non-leap years.
+"""
+from __future__ import division
+
+import json
+from collections import OrderedDict
+from datetime import date, time, timedelta
+
+import numpy
+
+from edgydata.constants import POWER_TYPES, Combiners
+from edgydata.data import Energy, PowerPeriod, PowerSeries
+from edgydata.time import utc_offsets
+
+# One for each day of a leap year
+DAYSINYEAR = 366
+# How many PowerPeriods to gather up before processing them
+CHUNKSIZE = 10000
+
+_ORDERED_TYPES = sorted(POWER_TYPES)
+# Which day of a leap year each month starts on
+_MONTH_STARTS = numpy.array([date(2000, m, 1).timetuple().tm_yday - 1
+                             for m in range(1, 13)])
+
+
+def _day_keys():
+    """ The (month, day) of every day of a leap year, in order """
+    first = date(2000, 1, 1)
+    days = [first + timedelta(days=d) for d in range(DAYSINYEAR)]
+    return [(d.month, d.day) for d in days]
+
+
+def _day_index(month, day):
+    return date(2000, month, day).timetuple().tm_yday - 1
+
+
+def _local_days(start_times, timezone):
+    """ Get the local day number (days since 1970-01-01) and the seconds
+    since local midnight of each of an array of unix timestamps
+    """
+    local = start_times + utc_offsets(start_times, timezone)
+    return local // 86400, local % 86400
+
+
+def _days_to_index(day_numbers):
+    """ Convert day numbers (days since 1970-01-01) to the index of that
+    month and day in a leap year
+    """
+    days = day_numbers.astype("datetime64[D]")
+    months = days.astype("datetime64[M]")
+    month_index = (months.astype(numpy.int64) % 12)
+    day_of_month = (days - months).astype(numpy.int64)
+    return _MONTH_STARTS[month_index] + day_of_month
+
+
+class _SiteStats(object):
+    """ The running statistics for one site """
+    def __init__(self, slots):
+        types = len(_ORDERED_TYPES)
+        # Daily energy totals (kWh), for each day of the year
+        self.day_count = numpy.zeros(DAYSINYEAR, dtype=numpy.int64)
+        self.day_sum = numpy.zeros((DAYSINYEAR, types))
+        self.day_min = numpy.full((DAYSINYEAR, types), numpy.inf)
+        self.day_max = numpy.full((DAYSINYEAR, types), -numpy.inf)
+        # Power (kW), for each time slot of each day of the year
+        self.slot_count = numpy.zeros((DAYSINYEAR, slots), dtype=numpy.int64)
+        self.slot_sum = numpy.zeros((DAYSINYEAR, slots, types))
+        self.slot_min = numpy.full((DAYSINYEAR, slots, types), numpy.inf)
+        self.slot_max = numpy.full((DAYSINYEAR, slots, types), -numpy.inf)
+        # The last start time we've taken into account, and the day that's
+        # still being added up (as we can't be sure it's complete yet)
+        self.high_water = None
+        self.pending_day = None
+        self.pending_energy = numpy.zeros(types)
+
+    _arrays = ("day_count", "day_sum", "day_min", "day_max", "slot_count",
+               "slot_sum", "slot_min", "slot_max", "pending_energy")
+
+    def finish_day(self):
+        if self.pending_day is None:
+            return
+        index = _days_to_index(numpy.array([self.pending_day]))[0]
+        self.day_count[index] += 1
+        self.day_sum[index] += self.pending_energy
+        self.day_min[index] = numpy.minimum(self.day_min[index],
+                                            self.pending_energy)
+        self.day_max[index] = numpy.maximum(self.day_max[index],
+                                            self.pending_energy)
+        self.pending_day = None
+        self.pending_energy = numpy.zeros(len(_ORDERED_TYPES))
+
+
+class Climatology(object):
+    """ Works out per-site statistics for each day of the year, and each
+    time of day within them, across all years, in one streaming pass over
+    the power. It can be updated as new data arrives, and saved to (and
+    loaded from) a file so that it doesn't have to start from scratch.
+
+    A day's total only counts once a later day has been seen (or flush() is
+    called), as until then we can't be sure we have all of it.
+    """
+    def __init__(self, timezone="UTC", slot_length=timedelta(minutes=15)):
+        # timezone can be a name, or a dictionary of {site_id: name}
+        self._timezone = timezone
+        self._slot_seconds = int(slot_length.total_seconds())
+        if 86400 % self._slot_seconds:
+            raise ValueError("slot_length must divide into a day")
+        self._sites = {}
+
+    def _get_timezone(self, site_id):
+        if isinstance(self._timezone, dict):
+            return self._timezone.get(site_id, "UTC")
+        return self._timezone
+
+    def _get_site(self, site_id):
+        if site_id not in self._sites:
+            self._sites[site_id] = _SiteStats(86400 // self._slot_seconds)
+        return self._sites[site_id]
+
+    def _chunks(self, power):
+        """ Turn power (a PowerSeries, or an iterable of PowerPeriods and/or
+        PowerSeries) into a stream of PowerSeries
+        """
+        if isinstance(power, PowerSeries):
+            yield power
+            return
+        periods = []
+        for item in power:
+            if isinstance(item, PowerPeriod):
+                periods.append(item)
+                if len(periods) >= CHUNKSIZE:
+                    yield PowerSeries.from_periods(periods)
+                    periods = []
+                continue
+            if periods:
+                yield PowerSeries.from_periods(periods)
+                periods = []
+            yield item
+        if periods:
+            yield PowerSeries.from_periods(periods)
+
+    def update(self, power):
+        """ Take power (a PowerSeries, or an iterable of PowerPeriods or
+        PowerSeries, such as Local.iter_power()) into account. For each site
+        it should be in time order, and anything that isn't later than what
+        we've already seen is ignored, so it's safe to give overlapping data.
+        """
+        for chunk in self._chunks(power):
+            for site_id in numpy.unique(chunk.site_id).tolist():
+                site_chunk = chunk[chunk.site_id == site_id]
+                self._update_site(site_id, site_chunk)
+
+    def _update_site(self, site_id, series):
+        stats = self._get_site(site_id)
+        if stats.high_water is not None:
+            series = series[series.start_time > stats.high_water]
+        if len(series) == 0:
+            return
+        if numpy.any(numpy.diff(series.start_time) <= 0):
+            raise ValueError("Power for site %s is not in time order" %
+                             site_id)
+        day_numbers, seconds = _local_days(series.start_time,
+                                           self._get_timezone(site_id))
+        day_index = _days_to_index(day_numbers)
+        slot = seconds // self._slot_seconds
+        values = numpy.column_stack([getattr(series, t)
+                                     for t in _ORDERED_TYPES])
+        # Each time of day is straightforward
+        numpy.add.at(stats.slot_count, (day_index, slot), 1)
+        numpy.add.at(stats.slot_sum, (day_index, slot), values)
+        numpy.minimum.at(stats.slot_min, (day_index, slot), values)
+        numpy.maximum.at(stats.slot_max, (day_index, slot), values)
+        # Days need totalling up first, then each one (apart from the last,
+        # which may not be finished) goes in with the others
+        energy = values * (series.duration / 3600.0)[:, None]
+        starts = numpy.flatnonzero(numpy.diff(day_numbers)) + 1
+        starts = numpy.concatenate(([0], starts))
+        day_totals = numpy.add.reduceat(energy, starts)
+        for day_number, total in zip(day_numbers[starts].tolist(),
+                                     day_totals):
+            if day_number != stats.pending_day:
+                stats.finish_day()
+                stats.pending_day = day_number
+            stats.pending_energy = stats.pending_energy + total
+        stats.high_water = int(series.start_time[-1])
+
+    def flush(self, site_id=None):
+        """ Count the day that's still being added up for site_id (or every
+        site), as we know it's complete
+        """
+        site_ids = list(self._sites) if site_id is None else [site_id]
+        for each_id in site_ids:
+            self._sites[each_id].finish_day()
+
+    def site_ids(self):
+        return sorted(self._sites)
+
+    @staticmethod
+    def _combine(count, total, minimum, maximum, combiner):
+        if combiner == Combiners.SUM:
+            return total
+        if combiner == Combiners.MEAN:
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                return total / count[..., None]
+        if combiner == Combiners.MIN:
+            return minimum
+        if combiner == Combiners.MAX:
+            return maximum
+        msg = "Can't combine days with %s: only SUM, MEAN, MIN and MAX are "
+        msg += "supported"
+        raise ValueError(msg % combiner)
+
+    def by_day(self, site_id, combiner=Combiners.MEAN):
+        """ Get the combined daily energy (kWh) for each day of the year that
+        we have data for, as an OrderedDict of {(month, day): Energy}
+        """
+        stats = self._sites[site_id]
+        result = self._combine(stats.day_count, stats.day_sum, stats.day_min,
+                               stats.day_max, combiner)
+        output = OrderedDict()
+        for index, key in enumerate(_day_keys()):
+            if stats.day_count[index]:
+                output[key] = Energy(**dict(zip(_ORDERED_TYPES,
+                                                result[index].tolist())))
+        return output
+
+    def by_time_of_day(self, site_id, month=None, day=None,
+                       combiner=Combiners.MEAN):
+        """ Get the combined power (kW) for each time of day, on the given
+        day of the year (or over all days, if month and day are None), as an
+        OrderedDict of {datetime.time: Energy}
+        """
+        stats = self._sites[site_id]
+        if month is None:
+            count = stats.slot_count.sum(axis=0)
+            total = stats.slot_sum.sum(axis=0)
+            minimum = stats.slot_min.min(axis=0)
+            maximum = stats.slot_max.max(axis=0)
+        else:
+            index = _day_index(month, day)
+            count = stats.slot_count[index]
+            total = stats.slot_sum[index]
+            minimum = stats.slot_min[index]
+            maximum = stats.slot_max[index]
+        result = self._combine(count, total, minimum, maximum, combiner)
+        output = OrderedDict()
+        for slot in range(len(count)):
+            if count[slot]:
+                seconds = slot * self._slot_seconds
+                key = time(seconds // 3600, seconds % 3600 // 60,
+                           seconds % 60)
+                output[key] = Energy(**dict(zip(_ORDERED_TYPES,
+                                                result[slot].tolist())))
+        return output
+
+    def extreme_days(self, site_id, power_type="generated",
+                     combiner=Combiners.MEAN):
+        """ Get the (month, day) with the lowest, and the one with the
+        highest, combined daily energy of power_type
+        """
+        by_day = self.by_day(site_id, combiner=combiner)
+        ordered = sorted(by_day, key=lambda k: by_day[k][power_type])
+        return ordered[0], ordered[-1]
+
+    def save(self, path):
+        """ Save everything to a file, to be loaded again with load() """
+        arrays = {}
+        meta = {"timezone": self._timezone,
+                "slot_seconds": self._slot_seconds, "sites": {}}
+        if isinstance(self._timezone, dict):
+            meta["timezone"] = dict((str(k), v)
+                                    for k, v in self._timezone.items())
+        for site_id, stats in self._sites.items():
+            meta["sites"][str(site_id)] = {"high_water": stats.high_water,
+                                           "pending_day": stats.pending_day}
+            for name in _SiteStats._arrays:
+                arrays["%s_%s" % (site_id, name)] = getattr(stats, name)
+        arrays["meta"] = numpy.array(json.dumps(meta))
+        with open(path, "wb") as file_handle:
+            numpy.savez_compressed(file_handle, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """ Load a Climatology that was saved with save() """
+        with numpy.load(path) as arrays:
+            meta = json.loads(str(arrays["meta"]))
+            timezone = meta["timezone"]
+            if isinstance(timezone, dict):
+                timezone = dict((int(k), v) for k, v in timezone.items())
+            result = cls(timezone=timezone,
+                         slot_length=timedelta(seconds=meta["slot_seconds"]))
+            for site_id, site_meta in meta["sites"].items():
+                stats = result._get_site(int(site_id))
+                stats.high_water = site_meta["high_water"]
+                stats.pending_day = site_meta["pending_day"]
+                for name in _SiteStats._arrays:
+                    setattr(stats, name, arrays["%s_%s" % (site_id, name)])
+        return result
@@ -6,6 +6,8 @@ POWER = Enum("power", " ".join(sorted(POWER_TYPES)))
 
 SE_DATE_FORMAT = "%Y-%m-%d"
 SE_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# How the scripts set up logging (the same as messages used to be printed)
+LOG_FORMAT = "[%(asctime)s] %(levelname)s %(name)s: %(message)s"
 
 
 class DatePreset(Enum):
@@ -21,3 +23,16 @@ class Combiners(Enum):
     MIN = 3
     MAX = 4
     SPECIFIC = 5
+
+
+class Conflict(Enum):
+    """ What to do when adding data that is already present """
+    KEEP = 1
+    REPLACE = 2
+    ERROR = 3
+
+
+class RecordMode(Enum):
+    """ Whether a Recording saves calls to SolarEdge, or plays them back """
+    RECORD = 1
+    REPLAY = 2
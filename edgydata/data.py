@@ -1,7 +1,16 @@
 from __future__ import division, print_function
 
+import logging
 from datetime import date
+
+import numpy
+
 from edgydata.constants import POWER_TYPES
+from edgydata.time import (datetime_to_int, int_to_datetime,
+                           ints_to_datetimes, timedelta_to_int,
+                           int_to_timedelta)
+
+LOGGER = logging.getLogger(__name__)
 
 
 class Site(object):
@@ -56,21 +65,46 @@ class Energy(dict):
         return Energy(**kwargs)
 
 
+# The power types in the order they are stored (and compared) in
+_ORDERED_TYPES = tuple(sorted(POWER_TYPES))
+# Where things are in PowerPeriod._key
+_KEY_START = 0
+_KEY_SITE = len(_ORDERED_TYPES) + 1
+_KEY_DURATION = len(_ORDERED_TYPES) + 2
+
+
 class PowerPeriod(object):
     """ An object that represents a single entry of electricity generation /
     usage data.
     The default is average POWER (kW) over the power period. To convert to
     energy (kWh), use PowerPeriod.energy
+
+    There are a lot of these, so they are kept small: everything is held in
+    one flat tuple, which is also the key that they are compared and hashed
+    by. The start time is held in there as a unix timestamp, and the
+    datetime is only made when it's asked for. They are immutable.
     """
+    __slots__ = ("_key", "_start_time")
+
     def __init__(self, site_id, start_time, duration, **kwargs):
-        self.site_id = site_id
-        self.start_time = start_time
-        self.duration = duration
-        for eachtype in POWER_TYPES:
+        # start_time can be a datetime or a unix timestamp
+        if isinstance(start_time, int):
+            start = start_time
+            self._start_time = None
+        else:
+            start = datetime_to_int(start_time)
+            self._start_time = start_time
+        key = [start]
+        for eachtype in _ORDERED_TYPES:
             if eachtype not in kwargs:
                 msg = "%s not provided: expected all of %s"
                 raise ValueError(msg % (eachtype, POWER_TYPES))
-            setattr(self, eachtype, kwargs[eachtype])
+            key.append(kwargs[eachtype])
+        # Order by start time, then the power values (as we always have), and
+        # only then the rest, so that __eq__ and __hash__ can use it too
+        key.append(site_id)
+        key.append(duration)
+        self._key = tuple(key)
 
     @classmethod
     def _types(cls):
@@ -78,37 +112,65 @@ class PowerPeriod(object):
         # copy of it
         return set(POWER_TYPES)
 
+    @staticmethod
+    def sort_key(power_period):
+        """ For use as the key argument of sorted(): this gives the same
+        order as sorting PowerPeriods directly, but much faster
+        """
+        return power_period._key
+
+    @property
+    def site_id(self):
+        return self._key[_KEY_SITE]
+
+    @property
+    def duration(self):
+        return self._key[_KEY_DURATION]
+
+    @property
+    def start_time(self):
+        if self._start_time is None:
+            self._start_time = int_to_datetime(self._key[_KEY_START])
+        return self._start_time
+
+    @property
+    def start_timestamp(self):
+        """ The start time, as a unix timestamp """
+        return self._key[_KEY_START]
+
     @property
     def energy(self):
+        # To convert from average kW to kWh
+        hours = self.duration.total_seconds() / 60 / 60
         energydict = {}
-        for eachtype in self._types():
-            # To convert from average kW to kWh
-            hours = self.duration.total_seconds() / 60 / 60
-            energydict[eachtype] = getattr(self, eachtype) * hours
+        for index, eachtype in enumerate(_ORDERED_TYPES):
+            energydict[eachtype] = self._key[index + 1] * hours
         return Energy(**energydict)
 
     def __lt__(self, other):
-        if self.start_time < other.start_time:
-            return True
-        elif self.start_time > other.start_time:
-            return False
-        for eachtype in sorted(self._types()):
-            if getattr(self, eachtype) < getattr(other, eachtype):
-                return True
-            if getattr(self, eachtype) > getattr(other, eachtype):
-                return False
-        return False
+        return self._key < other._key
+
+    def __le__(self, other):
+        return self._key <= other._key
 
     def __gt__(self, other):
-        return other.__lt__(self)
+        return self._key > other._key
+
+    def __ge__(self, other):
+        return self._key >= other._key
 
     def __eq__(self, other):
-        if self.start_time != other.start_time:
-            return False
-        for eachtype in sorted(self._types()):
-            if getattr(self, eachtype) != getattr(other, eachtype):
-                return False
-        return True
+        if not isinstance(other, PowerPeriod):
+            return NotImplemented
+        return self._key == other._key
+
+    def __ne__(self, other):
+        if not isinstance(other, PowerPeriod):
+            return NotImplemented
+        return self._key != other._key
+
+    def __hash__(self):
+        return hash(self._key)
 
     def __radd__(self, other):
         return self.__add__(other)
@@ -157,9 +219,8 @@ class PowerPeriod(object):
         if a.start_time + a.duration == b.start_time:
             duration = duration_sum
         else:
-            print("Warning: These two PowerPeriods are not consecutive")
-            print(a)
-            print(b)
+            LOGGER.warning("These two PowerPeriods are not consecutive: "
+                           "%s, %s", a, b)
             # When they're not consecutive, the duration goes from the
             # start of the first to the end of the last (so includes any
             # gap)
@@ -172,15 +233,11 @@ class PowerPeriod(object):
             total = (getattr(a, type_) * a.duration.total_seconds() +
                      getattr(b, type_) * b.duration.total_seconds())
             if total != 0 and duration_sum.total_seconds() == 0:
-                msg = "Duration is zero but power is not"
-                print(type_)
-                print(a)
-                print(getattr(a, type_))
-                print(a.duration)
-                print(b)
-                print(getattr(b, type_))
-                print(b.duration)
-                raise ValueError(msg)
+                msg = "Duration is zero but power is not (%s: %s %s over %s, "
+                msg += "%s %s over %s)"
+                raise ValueError(msg % (type_, a, getattr(a, type_),
+                                        a.duration, b, getattr(b, type_),
+                                        b.duration))
             mytypes[type_] = total / duration_sum.total_seconds()
         result = PowerPeriod(**mytypes)
         return result
@@ -188,3 +245,147 @@ class PowerPeriod(object):
     def __repr__(self):
         hours = 24 * self.duration.days + self.duration.seconds / 60 / 60
         return "<PowerPeriod for %sh from %s>" % (hours, self.start_time)
+
+
+class PowerSeries(object):
+    """ A columnar container for many power periods. Rather than holding one
+    PowerPeriod object per entry, the site ids, start times (unix timestamps)
+    and durations (seconds) are held in contiguous numpy arrays, along with
+    one array per power type. PowerPeriod objects are only built when they
+    are asked for.
+    """
+    _int_columns = ("site_id", "start_time", "duration")
+
+    def __init__(self, site_id, start_time, duration, **kwargs):
+        self.site_id = numpy.asarray(site_id, dtype=numpy.int64)
+        self.start_time = numpy.asarray(start_time, dtype=numpy.int64)
+        self.duration = numpy.asarray(duration, dtype=numpy.int64)
+        length = len(self.start_time)
+        for eachtype in POWER_TYPES:
+            if eachtype not in kwargs:
+                msg = "%s not provided: expected all of %s"
+                raise ValueError(msg % (eachtype, POWER_TYPES))
+            setattr(self, eachtype,
+                    numpy.asarray(kwargs[eachtype], dtype=numpy.float64))
+        for eachcol in self.columns():
+            if len(getattr(self, eachcol)) != length:
+                msg = "Column %s has length %s, expected %s"
+                raise ValueError(msg % (eachcol, len(getattr(self, eachcol)),
+                                        length))
+
+    @classmethod
+    def columns(cls):
+        """ The names of the columns, in the order used by to_rows() and
+        from_rows() (which is also the order of the local database)
+        """
+        results = list(cls._int_columns)
+        results.extend(sorted(POWER_TYPES))
+        return results
+
+    @classmethod
+    def empty(cls):
+        return cls(**dict((col, []) for col in cls.columns()))
+
+    @classmethod
+    def from_periods(cls, power_periods):
+        """ Build a PowerSeries from an iterable of PowerPeriod objects """
+        power_periods = list(power_periods)
+        kwargs = {"site_id": [p.site_id for p in power_periods],
+                  "start_time": [p.start_timestamp for p in power_periods],
+                  "duration": [timedelta_to_int(p.duration)
+                               for p in power_periods]}
+        for eachtype in POWER_TYPES:
+            kwargs[eachtype] = [getattr(p, eachtype) for p in power_periods]
+        return cls(**kwargs)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Build a PowerSeries from an iterable of tuples, each in the order
+        given by columns()
+        """
+        columns = cls.columns()
+        table = numpy.array(list(rows), dtype=numpy.float64)
+        if len(table) == 0:
+            return cls.empty()
+        kwargs = {}
+        for index, col in enumerate(columns):
+            kwargs[col] = table[:, index]
+        return cls(**kwargs)
+
+    @classmethod
+    def concatenate(cls, series_list):
+        series_list = list(series_list)
+        if not series_list:
+            return cls.empty()
+        kwargs = {}
+        for col in cls.columns():
+            kwargs[col] = numpy.concatenate([getattr(s, col)
+                                             for s in series_list])
+        return cls(**kwargs)
+
+    def __len__(self):
+        return len(self.start_time)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, numpy.integer)):
+            return self._make_period(index)
+        # Slices and index arrays give another PowerSeries. For slices,
+        # these are views onto the same arrays, so are cheap to make
+        kwargs = {}
+        for col in self.columns():
+            kwargs[col] = getattr(self, col)[index]
+        return PowerSeries(**kwargs)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._make_period(index)
+
+    def _make_period(self, index):
+        kwargs = {"site_id": int(self.site_id[index]),
+                  "start_time": int(self.start_time[index]),
+                  "duration": int_to_timedelta(int(self.duration[index]))}
+        for eachtype in POWER_TYPES:
+            kwargs[eachtype] = float(getattr(self, eachtype)[index])
+        return PowerPeriod(**kwargs)
+
+    def to_periods(self):
+        """ Convert to a list of PowerPeriod objects """
+        return list(self)
+
+    def to_rows(self):
+        """ Yield a tuple per entry, in the order given by columns() """
+        int_columns = [getattr(self, col).tolist()
+                       for col in self._int_columns]
+        float_columns = [getattr(self, col).tolist()
+                         for col in sorted(POWER_TYPES)]
+        return zip(*(int_columns + float_columns))
+
+    def sorted(self):
+        """ Return a copy of this series, sorted by start time (then site) """
+        order = numpy.lexsort((self.site_id, self.start_time))
+        return self[order]
+
+    def start_datetimes(self, timezone="UTC"):
+        return ints_to_datetimes(self.start_time, timezone=timezone)
+
+    @property
+    def energy(self):
+        """ The energy (kWh) of each entry, as an Energy of arrays """
+        hours = self.duration / 60.0 / 60.0
+        energydict = {}
+        for eachtype in POWER_TYPES:
+            energydict[eachtype] = getattr(self, eachtype) * hours
+        return Energy(**energydict)
+
+    def __repr__(self):
+        return "<PowerSeries of %s power periods>" % len(self)
+
+
+def _power_property(index):
+    def getter(self):
+        return self._key[index]
+    return property(getter)
+
+
+for _index, _type in enumerate(_ORDERED_TYPES):
+    setattr(PowerPeriod, _type, _power_property(_index + 1))
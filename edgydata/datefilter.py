@@ -0,0 +1,157 @@
+""" Picking out power by where it falls in the calendar (e.g. "keep only
+blocks where the date is 25/12/*", or "weekdays between 17:00 and 19:00").
+Everything is in the site's local time.
+
+The local backend turns a DateFilter into sql, so that only the power that
+matches is read from the database. DateFilter.apply() does the same thing to
+power that's already been loaded.
+"""
+from __future__ import division
+
+from datetime import date
+
+import numpy
+
+from edgydata.data import PowerSeries
+from edgydata.time import utc_offsets
+
+
+def _int_set(values, name, lowest, highest):
+    if values is None:
+        return None
+    results = frozenset(int(v) for v in values)
+    for value in results:
+        if not lowest <= value <= highest:
+            msg = "%s must be between %s and %s, not %s"
+            raise ValueError(msg % (name, lowest, highest, value))
+    return results
+
+
+def date_to_number(mydate):
+    """ Convert a date to the yyyymmdd integer used by DateFilter """
+    return mydate.year * 10000 + mydate.month * 100 + mydate.day
+
+
+class DateFilter(object):
+    """ A set of conditions on the local date and time a power period starts
+    at. Every condition that's given has to match:
+        months: months of the year (1 to 12)
+        days: days of the month (1 to 31)
+        weekdays: days of the week (0 is Monday, to 6, Sunday)
+        hours: a (first, last) range of hours, last not included. If first
+            is after last, it wraps round midnight, so (22, 6) is overnight
+        dates: specific datetime.dates
+    """
+    def __init__(self, months=None, days=None, weekdays=None, hours=None,
+                 dates=None):
+        self.months = _int_set(months, "months", 1, 12)
+        self.days = _int_set(days, "days", 1, 31)
+        self.weekdays = _int_set(weekdays, "weekdays", 0, 6)
+        if hours is not None:
+            first, last = (int(h) for h in hours)
+            if not (0 <= first <= 24 and 0 <= last <= 24):
+                raise ValueError("hours must be between 0 and 24")
+            hours = (first, last)
+        self.hours = hours
+        if dates is not None:
+            dates = frozenset(dates)
+            for mydate in dates:
+                if not isinstance(mydate, date):
+                    raise TypeError("dates must be datetime.dates")
+        self.dates = dates
+
+    def __repr__(self):
+        parts = []
+        for attr in ("months", "days", "weekdays", "hours", "dates"):
+            value = getattr(self, attr)
+            if value is not None:
+                if isinstance(value, frozenset):
+                    value = sorted(value)
+                parts.append("%s=%s" % (attr, value))
+        return "DateFilter(%s)" % ", ".join(parts)
+
+    def month_days(self):
+        """ The (month * 100 + day) numbers that can match, or None if any
+        can. Dates that can never match (like 31 February) can be included.
+        """
+        if self.dates is not None:
+            results = set(date_to_number(d) % 10000 for d in self.dates)
+        elif self.months is None and self.days is None:
+            return None
+        else:
+            results = set(m * 100 + d
+                          for m in (self.months or range(1, 13))
+                          for d in (self.days or range(1, 32)))
+        if self.months is not None:
+            results = set(r for r in results if r // 100 in self.months)
+        if self.days is not None:
+            results = set(r for r in results if r % 100 in self.days)
+        return frozenset(results)
+
+    def minute_ranges(self):
+        """ The hours, as a list of (first, last) minutes of the day, last
+        not included. None if there's no condition on the time of day.
+        """
+        if self.hours is None:
+            return None
+        first, last = (h * 60 for h in self.hours)
+        if first <= last:
+            return [(first, last)]
+        return [(first, 24 * 60), (0, last)]
+
+    def mask(self, start_times, timezone="UTC"):
+        """ Get a boolean array of which of an array of unix timestamps
+        match
+        """
+        start_times = numpy.asarray(start_times, dtype=numpy.int64)
+        local = start_times + utc_offsets(start_times, timezone)
+        days = (local // 86400).astype("datetime64[D]")
+        months = days.astype("datetime64[M]")
+        years = months.astype("datetime64[Y]")
+        local_date = ((years.astype(numpy.int64) + 1970) * 10000 +
+                      (months - years).astype(numpy.int64) * 100 + 100 +
+                      (days - months).astype(numpy.int64) + 1)
+        result = numpy.ones(len(start_times), dtype=bool)
+        month_days = self.month_days()
+        if month_days is not None:
+            result &= numpy.isin(local_date % 10000, list(month_days))
+        if self.dates is not None:
+            result &= numpy.isin(local_date,
+                                 [date_to_number(d) for d in self.dates])
+        if self.weekdays is not None:
+            weekdays = (local // 86400 + 3) % 7
+            result &= numpy.isin(weekdays, list(self.weekdays))
+        minute_ranges = self.minute_ranges()
+        if minute_ranges is not None:
+            minutes = local % 86400 // 60
+            in_range = numpy.zeros(len(start_times), dtype=bool)
+            for first, last in minute_ranges:
+                in_range |= (minutes >= first) & (minutes < last)
+            result &= in_range
+        return result
+
+    def matches(self, power_period, timezone="UTC"):
+        """ Does one PowerPeriod match """
+        return bool(self.mask([power_period.start_timestamp],
+                              timezone=timezone)[0])
+
+    def apply(self, power, timezone="UTC"):
+        """ Keep only the power that matches. power can be a PowerSeries
+        (which gives a PowerSeries) or any iterable of PowerPeriods (which
+        gives a list). timezone can also be a dictionary of {site_id: name}.
+        """
+        if isinstance(power, PowerSeries):
+            series = power
+        else:
+            series = PowerSeries.from_periods(list(power))
+        if isinstance(timezone, dict):
+            keep = numpy.zeros(len(series), dtype=bool)
+            for site_id in numpy.unique(series.site_id).tolist():
+                in_site = series.site_id == site_id
+                keep[in_site] = self.mask(series.start_time[in_site],
+                                          timezone.get(site_id, "UTC"))
+        else:
+            keep = self.mask(series.start_time, timezone=timezone)
+        if isinstance(power, PowerSeries):
+            return series[keep]
+        return series[keep].to_periods()
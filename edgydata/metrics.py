@@ -0,0 +1,135 @@
+""" Counting and timing what edgydata does: how long each operation takes,
+how many sql statements are run, rows read and written, calls made to
+SolarEdge (and how much they return), and cache hits and misses.
+
+Everything goes into a Metrics registry (the shared METRICS one, unless a
+backend is given its own), and snapshot() gives it all as a dictionary.
+Hooks can be added to pass each measurement on to something else as it
+happens.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+
+# The upper bounds (in seconds) of the buckets of the latency histograms
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+class _Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        # The last one is for anything longer than all of BUCKETS
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def as_dict(self):
+        buckets = OrderedDict()
+        for bound, count in zip(BUCKETS + ("inf",), self.buckets):
+            buckets[str(bound)] = count
+        return {"count": self.count, "sum": self.total,
+                "mean": self.total / self.count if self.count else None,
+                "min": self.minimum, "max": self.maximum,
+                "buckets": buckets}
+
+
+class Metrics(object):
+    """ A thread safe registry of counters and latency histograms. Hooks are
+    called with (kind, name, value) for every measurement, kind being
+    "counter" or "latency".
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._hooks = []
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        for hook in self._hooks:
+            hook("counter", name, value)
+
+    def observe(self, name, seconds):
+        """ Record that an operation called name took seconds """
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = _Histogram()
+            self._histograms[name].observe(seconds)
+        for hook in self._hooks:
+            hook("latency", name, seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """ Time the code inside a with statement """
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.observe(name, default_timer() - start)
+
+    def get_counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def get_latency(self, name):
+        """ The histogram of the times taken by name, as a dictionary (see
+        snapshot())
+        """
+        with self._lock:
+            histogram = self._histograms.get(name) or _Histogram()
+            return histogram.as_dict()
+
+    def snapshot(self):
+        """ Everything recorded so far, as a dictionary """
+        with self._lock:
+            counters = OrderedDict(sorted(self._counters.items()))
+            histograms = OrderedDict(
+                (name, self._histograms[name].as_dict())
+                for name in sorted(self._histograms))
+        return {"counters": counters, "latencies": histograms}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+# The registry that everything uses, unless told otherwise
+METRICS = Metrics()
+
+
+def timed(name):
+    """ A decorator that times each call of a method into the metrics of the
+    object it's called on (or METRICS, if it doesn't have any)
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = getattr(self, "metrics", None) or METRICS
+            with metrics.timer(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
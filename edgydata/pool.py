@@ -0,0 +1,119 @@
+""" A small pool of sqlite connections to one database: a single writer, and
+a few readers. The database is put into write-ahead log (WAL) mode, so the
+readers never block the writer (or each other), and a web page can be
+served from the database while a sync is adding to it.
+
+Connections are made when they're first needed, and are never shared by two
+threads at once, but can be used by whichever thread has them.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# How many reader connections a pool keeps, by default
+READERS = 4
+# How long (in seconds) to wait for another process to let go of the database
+BUSYTIMEOUT = 30.0
+# The pragmas that every connection gets. In WAL mode, synchronous=NORMAL
+# can lose the last transactions on a power cut, but can't corrupt anything
+PRAGMAS = (("synchronous", "NORMAL"),
+           ("temp_store", "MEMORY"),
+           # Negative means in KiB, rather than pages
+           ("cache_size", -16384),
+           ("mmap_size", 256 * 1024 * 1024))
+MEMORYPATH = ":memory:"
+
+
+class ConnectionPool(object):
+    """ The connections to the sqlite database at path. writer() and
+    reader() are context managers that lend a connection out. There's only
+    one writer, so writes happen one at a time; reader connections can't
+    change anything (they're query_only). Readers are never waited for: if
+    they're all lent out, another is made, but at most `readers` idle
+    connections are kept once they're given back.
+
+    The connections are in autocommit mode: it's up to whoever borrows one
+    to BEGIN and COMMIT transactions. An in memory database can't be
+    shared between connections, so for one of those the readers are the
+    writer.
+    """
+    def __init__(self, path, readers=READERS, timeout=BUSYTIMEOUT):
+        self._path = path
+        self._timeout = timeout
+        self._shared = path == MEMORYPATH
+        self._writer = None
+        # Re-entrant, so that a thread that's writing can also read
+        self._writer_lock = threading.RLock()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._readers = readers
+        self._closed = False
+
+    def _connect(self, query_only=False):
+        connection = sqlite3.connect(self._path, timeout=self._timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        for name, value in PRAGMAS:
+            connection.execute("PRAGMA %s = %s" % (name, value))
+        if query_only:
+            connection.execute("PRAGMA query_only = ON")
+        return connection
+
+    def _get_writer(self):
+        """ The writer connection, which is made first, since it's what puts
+        the database into WAL mode
+        """
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Connection pool is closed")
+            if self._writer is None:
+                self._writer = self._connect()
+                if not self._shared:
+                    self._writer.execute("PRAGMA journal_mode = WAL")
+            return self._writer
+
+    @contextmanager
+    def writer(self):
+        """ Borrow the writer, waiting for whoever has it to finish """
+        connection = self._get_writer()
+        with self._writer_lock:
+            yield connection
+
+    @contextmanager
+    def reader(self):
+        """ Borrow a reader """
+        if self._shared:
+            with self.writer() as connection:
+                yield connection
+            return
+        self._get_writer()
+        with self._lock:
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                connection = None
+        if connection is None:
+            connection = self._connect(query_only=True)
+        try:
+            yield connection
+        finally:
+            with self._lock:
+                if self._closed or len(self._idle) >= self._readers:
+                    connection.close()
+                else:
+                    self._idle.append(connection)
+
+    def close(self):
+        """ Close every connection. Readers that are lent out are closed when
+        they're given back.
+        """
+        with self._lock:
+            self._closed = True
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+            writer = self._writer
+            self._writer = None
+        if writer is not None:
+            with self._writer_lock:
+                writer.close()
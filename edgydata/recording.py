@@ -0,0 +1,62 @@
+""" Saving the responses to calls to SolarEdge, so that they can be played
+back later without the network (or using up the day's quota of calls).
+"""
+import hashlib
+import json
+import os
+import threading
+
+from edgydata.constants import RecordMode
+
+
+class Recording(object):
+    """ A directory of responses to calls to SolarEdge, one file per call.
+    Give one to Remote (or Hybrid) and, in RecordMode.RECORD, every
+    successful call is saved; in RecordMode.REPLAY, calls are answered from
+    the saved responses, and never reach SolarEdge. The api key is never
+    saved.
+    """
+    def __init__(self, path, mode=RecordMode.REPLAY):
+        self._path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        if mode == RecordMode.RECORD and not os.path.isdir(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def _get_key(sub_url, params):
+        params = dict((k, v) for k, v in (params or {}).items()
+                      if k != "api_key")
+        return json.dumps([sub_url, params], sort_keys=True)
+
+    def _get_file(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self._path, "%s.json" % digest)
+
+    def save(self, sub_url, params, response):
+        """ Save response (the decoded json) as the answer to a call """
+        key = self._get_key(sub_url, params)
+        file_path = self._get_file(key)
+        with self._lock:
+            with open(file_path + ".tmp", "w") as file_handle:
+                json.dump({"key": key, "response": response}, file_handle)
+            os.rename(file_path + ".tmp", file_path)
+
+    def load(self, sub_url, params):
+        """ Get the saved response to a call, or None if there isn't one """
+        key = self._get_key(sub_url, params)
+        try:
+            with open(self._get_file(key)) as file_handle:
+                return json.load(file_handle)["response"]
+        except IOError:
+            return None
+
+    def __iter__(self):
+        """ Yield (sub_url, params, response) for every saved call """
+        for file_name in sorted(os.listdir(self._path)):
+            if not file_name.endswith(".json"):
+                continue
+            with open(os.path.join(self._path, file_name)) as file_handle:
+                saved = json.load(file_handle)
+            sub_url, params = json.loads(saved["key"])
+            yield sub_url, params, saved["response"]
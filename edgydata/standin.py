@@ -0,0 +1,223 @@
+""" A local stand-in for the SolarEdge API, so that Remote and Hybrid can be
+tested and load tested without the network. It either plays back a
+Recording, or makes up data for some synthetic sites (see
+edgydata.synthetic), and can be made slow and unreliable on purpose.
+
+    python -m edgydata.standin --sites 3 --years 2 --latency 0.2
+
+then point Remote (or Hybrid) at it with base_url.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+
+import pytz
+
+from edgydata.backend.remote import MAXWINDOWDAYS
+from edgydata.constants import RecordMode, SE_DATETIME_FORMAT
+from edgydata.recording import Recording
+from edgydata.synthetic import (generate_power, make_sites,
+                                power_details_response,
+                                site_details_response, site_list_response)
+from edgydata.time import date_to_datetime
+
+_DETAILS = re.compile(r"^site/(\d+)/details\.json$")
+_POWER_DETAILS = re.compile(r"^site/(\d+)/powerDetails\.json$")
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        sub_url = parsed.path.strip("/")
+        params = dict(parse_qsl(parsed.query))
+        status, body, headers = self.server.stand_in.respond(sub_url, params)
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StandIn(object):
+    """ An http server that answers calls like SolarEdge does. sites is a
+    list of (synthetic) Sites to make up data for; if a Recording is given,
+    that's played back instead.
+
+    Every call takes latency seconds (plus or minus up to jitter), and a
+    fraction error_rate of them fail with a 503 (or a 429, asking to retry
+    straight away). Errors and jitter come from seed, so runs repeat.
+    """
+    def __init__(self, sites=None, recording=None, latency=0.0, jitter=0.0,
+                 error_rate=0.0, seed=0, host="127.0.0.1", port=0):
+        if sites is None and recording is None:
+            sites = make_sites(1, 1)
+        self._sites = dict((s.site_id, s) for s in sites or [])
+        self._recording = recording
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self._host = host
+        self._port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%s" % (host, port)
+
+    def start(self):
+        """ Start serving (in a background thread). Returns the base url """
+        self._server = _Server((self._host, self._port), _Handler)
+        self._server.stand_in = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _chance(self):
+        with self._lock:
+            return (self._random.random(),
+                    self._random.uniform(-self.jitter, self.jitter))
+
+    def respond(self, sub_url, params):
+        """ Work out the answer to a call. Returns (status, body, headers) """
+        kind = sub_url.split("/")[-1]
+        with self._lock:
+            self.calls[kind] += 1
+        failure, jitter = self._chance()
+        delay = max(self.latency + jitter, 0)
+        if delay:
+            time.sleep(delay)
+        if "api_key" not in params:
+            return 403, {"String": "Invalid token"}, {}
+        if failure < self.error_rate:
+            with self._lock:
+                self.errors[kind] += 1
+            if failure < self.error_rate / 2:
+                return 429, {"String": "Too many requests"}, \
+                    {"Retry-After": "0"}
+            return 503, {"String": "Service unavailable"}, {}
+        if self._recording is not None:
+            body = self._recording.load(sub_url, params)
+            if body is None:
+                return 404, {"String": "Not recorded"}, {}
+            return 200, body, {}
+        try:
+            return self._synthesize(sub_url, params)
+        except (KeyError, ValueError) as err:
+            return 400, {"String": str(err)}, {}
+
+    def _synthesize(self, sub_url, params):
+        if sub_url == "sites/list":
+            sites = [self._sites[s] for s in sorted(self._sites)]
+            return 200, site_list_response(sites), {}
+        match = _DETAILS.match(sub_url)
+        if match:
+            site = self._sites.get(int(match.group(1)))
+            if site is None:
+                return 404, {"String": "No such site"}, {}
+            return 200, site_details_response(site), {}
+        match = _POWER_DETAILS.match(sub_url)
+        if match:
+            site = self._sites.get(int(match.group(1)))
+            if site is None:
+                return 404, {"String": "No such site"}, {}
+            start = pytz.utc.localize(datetime.strptime(params["startTime"],
+                                                        SE_DATETIME_FORMAT))
+            end = pytz.utc.localize(datetime.strptime(params["endTime"],
+                                                      SE_DATETIME_FORMAT))
+            if end - start > timedelta(days=MAXWINDOWDAYS + 3):
+                raise ValueError("Time range too long")
+            # There's nothing before the site was installed, or after it was
+            # last updated
+            start = max(start, date_to_datetime(site.start_date))
+            end = min(end, date_to_datetime(site.end_date) +
+                      timedelta(days=1))
+            series = generate_power(site, start=start, end=end)
+            return 200, power_details_response(series), {}
+        return 404, {"String": "Unknown call %s" % sub_url}, {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A local stand-in for the "
+                                     "SolarEdge API")
+    parser.add_argument("--sites", type=int, default=1,
+                        help="How many synthetic sites to serve")
+    parser.add_argument("--years", type=float, default=1,
+                        help="How many years of history each site has")
+    parser.add_argument("--recording", help="Play back the calls saved in "
+                        "this directory instead")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds each call takes")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Seconds each call's latency can vary by")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of calls that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    recording = None
+    sites = None
+    if args.recording is not None:
+        recording = Recording(args.recording, mode=RecordMode.REPLAY)
+    else:
+        sites = make_sites(args.sites, args.years)
+    stand_in = StandIn(sites=sites, recording=recording,
+                       latency=args.latency, jitter=args.jitter,
+                       error_rate=args.error_rate, seed=args.seed,
+                       port=args.port)
+    print("Serving on %s" % stand_in.start())
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stand_in.stop()
+
+
+if __name__ == "__main__":
+    main()
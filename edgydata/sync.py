@@ -0,0 +1,135 @@
+""" Keep the local database up to date with SolarEdge, in the background, so
+that reading from it never has to wait for the network.
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import threading
+
+from edgydata.backend.hybrid import Hybrid
+from edgydata.backend.remote import BASE_URL
+from edgydata.constants import LOG_FORMAT
+from edgydata.time import (date_to_datetime, get_current_datetime,
+                           get_midnight_before)
+
+# How often (in seconds) to sync, by default
+SYNCINTERVAL = 60 * 60
+
+
+class Sync(object):
+    """ Keeps the local mirror of every site current. For each site, we
+    remember the time that it has been synced up to (the high water mark) in
+    the local database, and each sync only fetches the complete days since
+    then. The mark is only moved once the data is safely stored, so if a
+    sync dies part way through, the next one carries on from where it got
+    to.
+
+    Once this is running, readers can use the Local backend directly.
+    """
+    def __init__(self, api_key=None, local_path=None, interval=SYNCINTERVAL,
+                 debug=False, base_url=BASE_URL):
+        self._api_key = api_key
+        self._base_url = base_url
+        self._local_path = local_path
+        self._interval = interval
+        self._debug = debug
+        # The local database can be used from any thread, so the background
+        # thread and whoever calls sync_site() or run_once() share a backend
+        self._hybrid = None
+        self._hybrid_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._logger = logging.getLogger(__name__)
+
+    def _get_backend(self):
+        with self._hybrid_lock:
+            if self._hybrid is None:
+                self._hybrid = Hybrid(api_key=self._api_key,
+                                      local_path=self._local_path,
+                                      debug=self._debug,
+                                      base_url=self._base_url)
+            return self._hybrid
+
+    def sync_site(self, site_id):
+        """ Fetch all the complete days for site_id since it was last synced.
+        Returns the new high water mark.
+        """
+        hybrid = self._get_backend()
+        local = hybrid._local_be
+        start = local.get_high_water_mark(site_id)
+        if start is None:
+            start = date_to_datetime(hybrid.get_site(site_id).start_date)
+        end = get_midnight_before(get_current_datetime())
+        if start >= end:
+            return start
+        hybrid.info("Syncing site %s from %s to %s", site_id, start, end)
+        hybrid._update_power(site_id=site_id, start=start, end=end)
+        local.set_high_water_mark(site_id, end)
+        return end
+
+    def run_once(self):
+        """ Sync every site once. A site failing doesn't stop the others
+        being synced. Returns {site_id: high water mark (or the exception)}
+        """
+        hybrid = self._get_backend()
+        results = {}
+        for site_id in hybrid.get_site_ids():
+            try:
+                results[site_id] = self.sync_site(site_id)
+            except Exception as err:
+                hybrid.warning("Syncing site %s failed: %s", site_id, err)
+                results[site_id] = err
+        return results
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            # Like a site failing, a whole sync failing (if SolarEdge can't
+            # be reached to list the sites, say) is tried again next time
+            try:
+                self.run_once()
+            except Exception:
+                self._logger.exception("Sync failed, will try again in %ss",
+                                       self._interval)
+            self._stop_event.wait(self._interval)
+
+    def start(self):
+        """ Start syncing every interval seconds, in a background thread """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="edgydata-sync")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """ Stop the background sync (after the current one has finished, if
+        wait is True)
+        """
+        self._stop_event.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--local-path", default=None,
+                        help="The sqlite database to sync into")
+    parser.add_argument("--interval", type=float, default=SYNCINTERVAL,
+                        help="Seconds between syncs")
+    parser.add_argument("--once", action="store_true",
+                        help="Sync once, then exit")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(format=LOG_FORMAT,
+                        level=logging.DEBUG if args.debug else logging.INFO)
+    sync = Sync(local_path=args.local_path, interval=args.interval,
+                debug=args.debug)
+    if args.once:
+        print(sync.run_once())
+        return
+    sync._run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+""" Made up, but realistic looking, solar power data, for testing and
+benchmarking without SolarEdge. The same site and time always give the same
+values, however they're asked for, so data fetched in different windows fits
+together.
+
+There are also functions to put the data into the form that SolarEdge's API
+gives it in (see edgydata.standin).
+"""
+from __future__ import division
+
+from datetime import date, timedelta
+
+import numpy
+
+from edgydata.backend.remote import LOOKUP
+from edgydata.constants import (POWER_TYPES, SE_DATE_FORMAT,
+                                SE_DATETIME_FORMAT)
+from edgydata.data import Site, PowerSeries
+from edgydata.time import (date_to_datetime, datetime_to_int, utc_offsets,
+                           ints_to_datetimes)
+
+# The length of each power period (seconds): SolarEdge gives quarter hours
+PERIOD = 900
+LATITUDE = 51.5
+# The names SolarEdge gives each power type's meter
+_METERS = dict((v.name, k) for k, v in LOOKUP.items())
+_MASK = (1 << 64) - 1
+
+
+def _random(site_id, keys, salt):
+    """ A repeatable "random" number in [0, 1) for each of an array of
+    integer keys (a splitmix64 hash), so the same site and time always get
+    the same number
+    """
+    with numpy.errstate(over="ignore"):
+        value = numpy.asarray(keys, dtype=numpy.int64).astype(numpy.uint64)
+        value = value + numpy.uint64((site_id * 0x9E3779B97F4A7C15 + salt)
+                                     & _MASK)
+        value ^= value >> numpy.uint64(30)
+        value *= numpy.uint64(0xBF58476D1CE4E5B9)
+        value ^= value >> numpy.uint64(27)
+        value *= numpy.uint64(0x94D049BB133111EB)
+        value ^= value >> numpy.uint64(31)
+    return (value >> numpy.uint64(11)).astype(numpy.float64) / 2.0 ** 53
+
+
+def make_sites(count, years, end_date=None, timezone="Europe/London",
+               first_id=1):
+    """ Make count Sites, each with years of history up to end_date (or
+    yesterday)
+    """
+    if end_date is None:
+        end_date = date.today() - timedelta(days=1)
+    start_date = end_date - timedelta(days=int(round(365.25 * years)))
+    sites = []
+    for index in range(count):
+        site_id = first_id + index
+        sites.append(Site(site_id=site_id, name="Synthetic site %s" % site_id,
+                          start_date=start_date, end_date=end_date,
+                          peak_power=3000.0 + 500.0 * (index % 6),
+                          country="United Kingdom", timezone=timezone))
+    return sites
+
+
+def generate_power(site, start=None, end=None, latitude=LATITUDE):
+    """ Make the power for site (in W, as SolarEdge gives it) for every
+    quarter hour from start to end (datetimes, both included), or the
+    whole life of the site. Returns a PowerSeries.
+    """
+    if start is None:
+        start = date_to_datetime(site.start_date)
+    if end is None:
+        end = date_to_datetime(site.end_date) + timedelta(days=1)
+    first = -(-datetime_to_int(start) // PERIOD) * PERIOD
+    last = datetime_to_int(end)
+    start_times = numpy.arange(first, last + 1, PERIOD, dtype=numpy.int64)
+    local = start_times + utc_offsets(start_times, site.timezone)
+    hours = (local % 86400) / 3600.0
+    days = local // 86400
+    day_of_year = (days.astype("datetime64[D]") -
+                   days.astype("datetime64[D]").astype("datetime64[Y]")
+                   ).astype(numpy.int64)
+    # How high the sun is, from the time of day and year
+    declination = numpy.radians(23.44) * numpy.sin(
+        2 * numpy.pi * (284 + day_of_year) / 365.0)
+    hour_angle = numpy.radians((hours - 12) * 15)
+    lat = numpy.radians(latitude)
+    elevation = (numpy.sin(lat) * numpy.sin(declination) +
+                 numpy.cos(lat) * numpy.cos(declination) *
+                 numpy.cos(hour_angle))
+    # Some days are cloudier than others, and it changes through the day
+    cloud = 0.15 + 0.85 * _random(site.site_id, days, 1)
+    flicker = 0.85 + 0.3 * _random(site.site_id, start_times, 2)
+    generated = (site.peak_power * numpy.clip(elevation, 0, None) * cloud *
+                 flicker)
+    # A base load, with peaks in the morning and evening
+    consumed = (250 + 600 * numpy.exp(-((hours - 7.5) / 1.0) ** 2) +
+                1400 * numpy.exp(-((hours - 18.5) / 1.5) ** 2) +
+                300 * _random(site.site_id, start_times, 3))
+    self_consumed = numpy.minimum(generated, consumed)
+    return PowerSeries(site_id=numpy.full(len(start_times), site.site_id),
+                       start_time=start_times,
+                       duration=numpy.full(len(start_times), PERIOD),
+                       consumed=consumed, generated=generated,
+                       exported=generated - self_consumed,
+                       imported=consumed - self_consumed,
+                       self_consumed=self_consumed)
+
+
+def site_list_response(sites):
+    """ The response to SolarEdge's sites/list """
+    return {"sites": {"count": len(sites),
+                      "site": [{"id": s.site_id, "name": s.name}
+                               for s in sites]}}
+
+
+def site_details_response(site):
+    """ The response to SolarEdge's site/<id>/details.json """
+    return {"details": {
+        "id": site.site_id, "name": site.name,
+        "installationDate": site.start_date.strftime(SE_DATE_FORMAT),
+        "lastUpdateTime": site.end_date.strftime(SE_DATE_FORMAT),
+        "peakPower": site.peak_power,
+        "location": {"country": site.country, "timeZone": site.timezone}}}
+
+
+def power_details_response(series):
+    """ The response to SolarEdge's site/<id>/powerDetails.json for the
+    power in series. Like SolarEdge, zero values are left out.
+    """
+    dates = [d.strftime(SE_DATETIME_FORMAT)
+             for d in ints_to_datetimes(series.start_time)]
+    meters = []
+    for eachtype in sorted(POWER_TYPES):
+        values = []
+        for date_string, value in zip(dates,
+                                      getattr(series, eachtype).tolist()):
+            if value:
+                values.append({"date": date_string, "value": value})
+            else:
+                values.append({"date": date_string})
+        meters.append({"type": _METERS[eachtype], "values": values})
+    return {"powerDetails": {"timeUnit": "QUARTER_OF_AN_HOUR", "unit": "W",
+                             "meters": meters}}
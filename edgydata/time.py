@@ -1,8 +1,27 @@
 from datetime import datetime, timedelta
+
+import numpy
 import pytz
 
 from edgydata.constants import SE_DATE_FORMAT, SE_DATETIME_FORMAT
 
+_EPOCH = datetime(1970, 1, 1)
+_UTC_EPOCH = pytz.utc.localize(_EPOCH)
+# pytz.timezone() is slow enough to show up when it's called for every row
+_TIMEZONES = {"UTC": pytz.utc}
+# The times at which each timezone's offset from utc changes
+_TRANSITIONS = {}
+
+
+def get_timezone(timezone):
+    """ Get the (cached) tzinfo object for a timezone name """
+    try:
+        return _TIMEZONES[timezone]
+    except KeyError:
+        tz_object = pytz.timezone(timezone)
+        _TIMEZONES[timezone] = tz_object
+        return tz_object
+
 
 def date_to_datetime(input_, timezone="UTC"):
     """ Convert a date into a datetime (midnight) """
@@ -10,20 +29,15 @@ def date_to_datetime(input_, timezone="UTC"):
     utc_datetime = pytz.utc.localize(naive)
     if timezone == "UTC":
         return utc_datetime
-    tz_object = pytz.timezone(timezone)
-    return utc_datetime.astimezone(tz_object)
+    return utc_datetime.astimezone(get_timezone(timezone))
 
 
 def datetime_to_int(mytime):
     """ Convert a datetime.datetime object to a unix timestamp. """
-    # First, see if we have been given a tz naive datetime
-    epoch_time = datetime(1970, 1, 1)
-    try:
-        return int((mytime - epoch_time).total_seconds())
-    except TypeError:
-        # If not, epoch_time is relative to utc
-        epoch_time = pytz.utc.localize(epoch_time)
-        return int((mytime - epoch_time).total_seconds())
+    # If we have been given a tz naive datetime, it's taken to be utc
+    if mytime.tzinfo is None:
+        return int((mytime - _EPOCH).total_seconds())
+    return int((mytime - _UTC_EPOCH).total_seconds())
 
 
 def date_to_int(mydate):
@@ -32,7 +46,7 @@ def date_to_int(mydate):
 
 
 def timedelta_to_int(mytimedelta):
-    return mytimedelta.seconds
+    return int(mytimedelta.total_seconds())
 
 
 def int_to_timedelta(myint):
@@ -41,12 +55,10 @@ def int_to_timedelta(myint):
 
 def int_to_datetime(myint, timezone="UTC"):
     """ Convert a unix timestamp to a datetime.datetime object """
-    naive = datetime.utcfromtimestamp(myint)
-    utc_datetime = pytz.utc.localize(naive)
+    utc_datetime = _UTC_EPOCH + timedelta(seconds=myint)
     if timezone == "UTC":
         return utc_datetime
-    tz_object = pytz.timezone(timezone)
-    return utc_datetime.astimezone(tz_object)
+    return utc_datetime.astimezone(get_timezone(timezone))
 
 
 def int_to_date(myint, timezone="UTC"):
@@ -60,18 +72,84 @@ def date_to_string(input_date):
 
 def string_to_date(input_string, timezone="UTC"):
     naive = datetime.strptime(input_string, SE_DATE_FORMAT)
-    tz_object = pytz.timezone(timezone)
-    return tz_object.localize(naive).date()
+    return get_timezone(timezone).localize(naive).date()
 
 
 def datetime_to_string(input_datetime):
     return input_datetime.strftime(SE_DATETIME_FORMAT)
 
 
+def _parse_se_datetime(input_string):
+    """ Parse a naive datetime in SE_DATETIME_FORMAT. strptime is slow, and
+    we know exactly where everything is, so only fall back to it if the
+    string doesn't look like we expect
+    """
+    try:
+        if len(input_string) == 19:
+            return datetime(int(input_string[0:4]), int(input_string[5:7]),
+                            int(input_string[8:10]),
+                            int(input_string[11:13]),
+                            int(input_string[14:16]),
+                            int(input_string[17:19]))
+    except ValueError:
+        pass
+    return datetime.strptime(input_string, SE_DATETIME_FORMAT)
+
+
 def string_to_datetime(input_string, timezone="UTC"):
-    naive = datetime.strptime(input_string, SE_DATETIME_FORMAT)
-    tz_object = pytz.timezone(timezone)
-    return tz_object.localize(naive)
+    naive = _parse_se_datetime(input_string)
+    return get_timezone(timezone).localize(naive)
+
+
+def ints_to_datetimes(myints, timezone="UTC"):
+    """ Convert an iterable (or array) of unix timestamps to a list of
+    datetime.datetime objects
+    """
+    if isinstance(myints, numpy.ndarray):
+        myints = myints.tolist()
+    utc_datetimes = [_UTC_EPOCH + timedelta(seconds=i) for i in myints]
+    if timezone == "UTC":
+        return utc_datetimes
+    tz_object = get_timezone(timezone)
+    return [d.astimezone(tz_object) for d in utc_datetimes]
+
+
+def datetimes_to_ints(mytimes):
+    """ Convert an iterable of datetime.datetime objects to an array of unix
+    timestamps
+    """
+    return numpy.array([datetime_to_int(t) for t in mytimes],
+                       dtype=numpy.int64)
+
+
+def strings_to_ints(input_strings, timezone="UTC"):
+    """ Convert an iterable of strings in SE_DATETIME_FORMAT (local to
+    timezone) to an array of unix timestamps, without making a datetime for
+    each of them
+    """
+    input_strings = list(input_strings)
+    if not input_strings:
+        return numpy.array([], dtype=numpy.int64)
+    try:
+        as_utc = numpy.array(input_strings, dtype="datetime64[s]")
+    except ValueError:
+        return datetimes_to_ints(string_to_datetime(s, timezone=timezone)
+                                 for s in input_strings)
+    as_utc = as_utc.astype(numpy.int64)
+    if timezone == "UTC":
+        return as_utc
+    # The offset from utc can only change on the hour (or half hour), so we
+    # only need to work it out once for each of those
+    tz_object = get_timezone(timezone)
+    offsets = {}
+    result = numpy.empty(len(input_strings), dtype=numpy.int64)
+    for index, input_string in enumerate(input_strings):
+        key = input_string[:13]
+        if key not in offsets:
+            local = tz_object.localize(_parse_se_datetime(input_string))
+            offsets[key] = int(local.utcoffset().total_seconds())
+        result[index] = as_utc[index] - offsets[key]
+    return result
 
 
 def get_current_datetime():
@@ -85,3 +163,60 @@ def get_midnight_before(time):
 def get_midnight_after(time):
     before = get_midnight_before(time)
     return before + timedelta(days=1)
+
+
+def _get_transitions(timezone):
+    """ Get (and cache) the unix timestamps at which timezone changes its
+    offset from utc, and the offset (in seconds) from each of them onwards
+    """
+    try:
+        return _TRANSITIONS[timezone]
+    except KeyError:
+        pass
+    tz_object = get_timezone(timezone)
+    if hasattr(tz_object, "_utc_transition_times"):
+        times = [datetime_to_int(t) if t > datetime.min else -2 ** 62
+                 for t in tz_object._utc_transition_times]
+        offsets = [int(info[0].total_seconds())
+                   for info in tz_object._transition_info]
+    else:
+        # A fixed offset
+        times = [-2 ** 62]
+        offsets = [int(tz_object.utcoffset(_EPOCH).total_seconds())]
+    result = (numpy.array(times, dtype=numpy.int64),
+              numpy.array(offsets, dtype=numpy.int64))
+    _TRANSITIONS[timezone] = result
+    return result
+
+
+def utc_offsets(myints, timezone="UTC"):
+    """ Get an array of the offsets from utc (in seconds) of timezone at each
+    of an array of unix timestamps. Add them on to get local times.
+    """
+    myints = numpy.asarray(myints, dtype=numpy.int64)
+    if timezone == "UTC":
+        return numpy.zeros(len(myints), dtype=numpy.int64)
+    times, offsets = _get_transitions(timezone)
+    index = numpy.searchsorted(times, myints, side="right") - 1
+    return offsets[numpy.maximum(index, 0)]
+
+
+def utc_offset_ranges(start, end, timezone="UTC"):
+    """ Split the unix timestamps from start to end (inclusive) into a list
+    of (first, last, offset) ranges, over each of which timezone has the same
+    offset from utc (in seconds)
+    """
+    if timezone == "UTC":
+        return [(start, end, 0)]
+    times, offsets = _get_transitions(timezone)
+    first_index = max(numpy.searchsorted(times, start, side="right") - 1, 0)
+    last_index = max(numpy.searchsorted(times, end, side="right") - 1, 0)
+    results = []
+    for index in range(first_index, last_index + 1):
+        first = start if index == first_index else int(times[index])
+        if index == last_index:
+            last = end
+        else:
+            last = int(times[index + 1]) - 1
+        results.append((first, last, int(offsets[index])))
+    return results
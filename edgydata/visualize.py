@@ -5,15 +5,25 @@ Ways to visualise a data set:
 """
 import matplotlib.pyplot as pyplot
 from edgydata.constants import POWER_TYPES
+from edgydata.data import PowerPeriod, PowerSeries
 
 
 def _pyplot(input_data, only_show, output_file, title):
-    sorted_data = sorted(input_data)
-    X = [pp.start_time for pp in sorted_data]
+    if isinstance(input_data, PowerSeries):
+        sorted_data = input_data.sorted()
+        X = sorted_data.start_datetimes()
+        energy = sorted_data.energy
+    else:
+        sorted_data = sorted(input_data, key=PowerPeriod.sort_key)
+        X = [pp.start_time for pp in sorted_data]
+        energy = None
     for eachtype in POWER_TYPES:
         if only_show is not None and eachtype not in only_show:
             continue
-        series = [pp.energy[eachtype] for pp in sorted_data]
+        if energy is not None:
+            series = energy[eachtype]
+        else:
+            series = [pp.energy[eachtype] for pp in sorted_data]
         pyplot.plot(X, series, label=eachtype)
     pyplot.legend()
     if title is not None:
@@ -4,15 +4,20 @@ provide some interesting data
 
 from __future__ import print_function
 
+import logging
 from datetime import datetime, timedelta
 from edgydata.backend.hybrid import Hybrid
 from edgydata.visualize import chart
 from edgydata.aggregate import aggregate
+from edgydata.climatology import Climatology
+from edgydata.constants import LOG_FORMAT
+from edgydata.data import PowerPeriod
 from edgydata.time import get_current_datetime
 
 
 def main():
     """ Generate some interesting information about the data """
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
     myvalues = values()
     graphs()
     print(myvalues)
@@ -41,6 +46,18 @@ def values():
     lowest_day = sorted_data[0]
     value_dict["Lowest generation in a day"] = lowest_day.energy.generated
 
+    timezones = dict((site_id, hdb.get_site(site_id).timezone)
+                     for site_id in hdb.get_site_ids())
+    climatology = Climatology(timezone=timezones)
+    # get_power() gives a set, and climatology needs it in time order
+    climatology.update(sorted(all_raw_data, key=PowerPeriod.sort_key))
+    climatology.flush()
+    for site_id in climatology.site_ids():
+        lowest, highest = climatology.extreme_days(site_id)
+        key = "Day of the year that gives the %s average generation (%s)"
+        value_dict[key % ("lowest", site_id)] = lowest
+        value_dict[key % ("highest", site_id)] = highest
+
     return value_dict
 
 